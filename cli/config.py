@@ -15,3 +15,6 @@ class Config(object):
 
     # the log verbosity level
     LOG_LEVEL = "info"
+
+    # the number of stage files rendered concurrently while parsing a stage
+    PARSE_WORKERS = 1
@@ -18,10 +18,11 @@ import pkg_resources
 from .config import Config
 from .common import PrettyPrinter as PP
 from .common import requires_root_privileges
+from .event_log import EventRecorder, write_synthetic_trace
 from .monitor import Monitor
 from .monitors.terminal_outputter import StepListPrinter, SimplePrinter
 from .stage_executor import run_stage
-from .stage_parser import SLSParser, SaltState, SaltRunner, SaltModule
+from .stage_parser import SLSParser, SaltState, SaltRunner, SaltModule, StepGraph
 
 
 def _setup_logging():
@@ -57,11 +58,12 @@ def _setup_logging():
     })
 
 
-def _run_monitor(show_state_steps, show_dynamic_steps, simple_output):
+def _run_monitor(show_state_steps, show_dynamic_steps, simple_output, record_file=None):
     """
     Run the DeepSea stage monitor and progress visualizer
     """
-    mon = Monitor(show_state_steps, show_dynamic_steps)
+    recorder = EventRecorder(record_file) if record_file else None
+    mon = Monitor(show_state_steps, show_dynamic_steps, recorder)
     listener = SimplePrinter() if simple_output else StepListPrinter()
     mon.add_listener(listener)
 
@@ -106,6 +108,34 @@ def _run_monitor(show_state_steps, show_dynamic_steps, simple_output):
             time.sleep(2)
         mon.wait_to_finish()
 
+    if recorder:
+        recorder.close()
+
+
+def _run_replay(show_state_steps, show_dynamic_steps, simple_output, replay_file, replay_speed):
+    """
+    Replays an event log through the DeepSea stage monitor and prints its throughput
+    """
+    mon = Monitor(show_state_steps, show_dynamic_steps, replay_file=replay_file,
+                  replay_speed=replay_speed)
+    listener = SimplePrinter() if simple_output else StepListPrinter()
+    mon.add_listener(listener)
+
+    start = time.time()
+    mon.start()
+    while mon.is_running():
+        time.sleep(0.1)
+    mon.stop(True)
+    elapsed = time.time() - start
+
+    counters = mon.counters().rates()
+    PP.println()
+    PP.println("Replayed {} events in {:.3f}s ({:.1f} events/s)"
+               .format(counters['seen'], elapsed, counters['seen'] / max(elapsed, 1e-6)))
+    PP.println("  dropped: {}  dispatched: {}".format(counters['dropped'],
+                                                     counters['dispatched']))
+    PP.println("  monitor latency: {}".format(mon.latency))
+
 
 def _validate_stage_file_exists(stage_name):
     """
@@ -129,6 +159,11 @@ def _run_show_stage_steps(stage_name, hide_state_steps, only_visible_steps, use_
     steps, _ = SLSParser.parse_state_steps(stage_name, hide_state_steps, only_visible_steps,
                                            use_cache)
     print()
+    cycle = StepGraph(steps).find_cycle()
+    if cycle:
+        PP.println("{}: circular requisites between steps: {}"
+                   .format(PP.red("WARNING"), " -> ".join(step.desc for step in cycle)))
+        print()
     PP.p_bold("List of steps for stage {}:".format(stage_name))
     print()
     state_count = 1
@@ -202,8 +237,11 @@ def _run_show_stage_steps(stage_name, hide_state_steps, only_visible_steps, use_
 @click.option('--log-file', default='/var/log/deepsea.log',
               type=click.Path(dir_okay=False),
               help="the file path for the log to be stored (default: /var/log/deepsea.log)")
+@click.option('--parse-workers', default=1, type=click.IntRange(1, 64),
+              help="number of stage files rendered concurrently when parsing a stage "
+                   "(default: 1)")
 @click.version_option(pkg_resources.get_distribution('deepsea'), message="%(version)s")
-def cli(log_level, log_file):
+def cli(log_level, log_file, parse_workers):
     """
     DeepSea CLI tool.
 
@@ -213,14 +251,22 @@ def cli(log_level, log_file):
     """
     Config.LOG_LEVEL = log_level
     Config.LOG_FILE_PATH = log_file
+    Config.PARSE_WORKERS = parse_workers
 
 
 @click.command(name='monitor')
 @click.option('--show-state-steps', is_flag=True, help="shows state visible steps progress")
 @click.option('--show-dynamic-steps', is_flag=True, help="shows runtime generated steps")
 @click.option('--simple-output', is_flag=True, help="minimalistic b&w output")
+@click.option('--record', 'record_file', type=click.Path(dir_okay=False),
+              help="appends the received events to an event log file")
+@click.option('--replay', 'replay_file', type=click.Path(exists=True, dir_okay=False),
+              help="replays the events of an event log file instead of listening to Salt")
+@click.option('--replay-speed', default=1.0, type=float,
+              help="replay speed factor, 0 replays as fast as possible (default: 1)")
 @requires_root_privileges
-def monitor(show_state_steps, show_dynamic_steps, simple_output):
+def monitor(show_state_steps, show_dynamic_steps, simple_output, record_file, replay_file,
+            replay_speed):
     """
     Starts DeepSea progress monitor.
 
@@ -228,7 +274,23 @@ def monitor(show_state_steps, show_dynamic_steps, simple_output):
     using salt-run commands in other terminal sessions.
     """
     _setup_logging()
-    _run_monitor(show_state_steps, show_dynamic_steps, simple_output)
+    if replay_file:
+        _run_replay(show_state_steps, show_dynamic_steps, simple_output, replay_file,
+                    replay_speed)
+    else:
+        _run_monitor(show_state_steps, show_dynamic_steps, simple_output, record_file)
+
+
+@click.command(name='synthetic-trace', short_help='writes a synthetic event log')
+@click.argument('trace_file', type=click.Path(dir_okay=False))
+@click.option('--minions', default=1000, type=click.IntRange(1), help="number of minions")
+@click.option('--states', default=10, type=click.IntRange(1), help="number of state steps")
+def synthetic_trace(trace_file, minions, states):
+    """
+    Writes the event log of a synthetic stage execution, to be used with
+    "monitor --replay" as a benchmark of the monitor and outputters.
+    """
+    write_synthetic_trace(trace_file, minions, states)
 
 
 @click.group(short_help='stage related commands')
@@ -313,6 +375,7 @@ def main():
     CLI main function
     """
     cli.add_command(monitor)
+    cli.add_command(synthetic_trace)
     cli.add_command(stage)
     cli.add_command(salt_run)
     stage.add_command(stage_dryrun)
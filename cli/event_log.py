@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Recording and replay of the Salt event stream seen by the DeepSea monitor
+
+An event log is an append-only sequence of records, each one made of a fixed size header
+(record type, timestamp, payload length) followed by the payload:
+    - event records hold the raw packed Salt event, exactly as received from the bus
+    - stage records hold the pickled parsing result of a stage, so that a replay does not
+      need to render the stage files again
+"""
+from __future__ import absolute_import
+
+import bisect
+import logging
+import pickle
+import struct
+import time
+
+import salt.payload
+import salt.utils.event
+
+from .salt_event import SaltEventProcessor
+from .stage_parser import SaltState, SaltRunner
+
+
+# pylint: disable=C0103
+logger = logging.getLogger(__name__)
+
+
+RECORD_EVENT = b'E'
+RECORD_STAGE = b'S'
+
+_HEADER = struct.Struct('>cdI')
+
+
+class EventRecorder(object):
+    """
+    Appends Salt events and stage parsing results to an event log file
+    """
+    def __init__(self, path, truncate=False):
+        """
+        Args:
+            path (str): the event log file path
+            truncate (bool): discard the records already in the file
+        """
+        self.path = path
+        # pylint: disable=W8470
+        self._file = open(path, 'wb' if truncate else 'ab')
+
+    def _write(self, rtype, payload, stamp=None):
+        if stamp is None:
+            stamp = time.time()
+        self._file.write(_HEADER.pack(rtype, stamp, len(payload)))
+        self._file.write(payload)
+
+    def record_event(self, raw, stamp=None):
+        """
+        Appends a raw packed Salt event
+        """
+        self._write(RECORD_EVENT, raw, stamp)
+
+    def record_stage(self, stage_name, steps, output, stamp=None):
+        """
+        Appends the parsing result of a stage
+        """
+        self._write(RECORD_STAGE, pickle.dumps((stage_name, steps, output),
+                                               pickle.HIGHEST_PROTOCOL), stamp)
+
+    def close(self):
+        """
+        Flushes and closes the event log file
+        """
+        self._file.close()
+
+
+def read_event_log(path):
+    """
+    Iterates over the records of an event log file
+    Returns:
+        generator of (record type, timestamp, payload) tuples
+    """
+    # pylint: disable=W8470
+    with open(path, 'rb') as log_file:
+        while True:
+            header = log_file.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            rtype, stamp, length = _HEADER.unpack(header)
+            payload = log_file.read(length)
+            if len(payload) < length:
+                logger.warning("truncated record at the end of %s", path)
+                return
+            yield rtype, stamp, payload
+
+
+class LatencyHistogram(object):
+    """
+    Fixed size histogram of latencies, with logarithmic buckets from 1us to ~1000s
+    """
+
+    _BOUNDS_ = [1e-6 * 2 ** i for i in range(31)]
+
+    def __init__(self):
+        self.buckets = [0] * (len(self._BOUNDS_) + 1)
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, latency):
+        """
+        Adds a latency sample in seconds
+        """
+        self.buckets[bisect.bisect_left(self._BOUNDS_, latency)] += 1
+        self.count += 1
+        if latency > self.max:
+            self.max = latency
+
+    def percentile(self, pct):
+        """
+        Returns the upper bound of the bucket that holds the given percentile
+        """
+        if not self.count:
+            return 0.0
+        threshold = self.count * pct / 100.0
+        acc = 0
+        for idx, count in enumerate(self.buckets[:-1]):
+            acc += count
+            if acc >= threshold:
+                return min(self._BOUNDS_[idx], self.max)
+        return self.max
+
+    def __str__(self):
+        return "p50: {:.3f}ms p99: {:.3f}ms max: {:.3f}ms".format(self.percentile(50) * 1000,
+                                                                   self.percentile(99) * 1000,
+                                                                   self.max * 1000)
+
+
+class ReplayEventProcessor(SaltEventProcessor):
+    """
+    Event processor that feeds the events of an event log instead of listening to the
+    Salt event bus.
+    """
+    def __init__(self, path, speed=1.0):
+        """
+        Args:
+            path (str): the event log file path
+            speed (float): the replay speed factor, 0 replays as fast as possible
+        """
+        super(ReplayEventProcessor, self).__init__()
+        self.speed = speed
+        self.stages = {}
+        self.elapsed = None
+        self._events = []
+        for rtype, stamp, payload in read_event_log(path):
+            if rtype == RECORD_EVENT:
+                self._events.append((stamp, payload))
+            elif rtype == RECORD_STAGE:
+                stage_name, steps, output = pickle.loads(payload)
+                self.stages[stage_name] = (steps, output)
+        logger.info("Loaded %s events and %s stages from %s", len(self._events),
+                    len(self.stages), path)
+
+    def run(self):
+        """
+        Feeds the recorded events to the listeners, keeping their relative timing
+        """
+        start = time.time()
+        first_stamp = self._events[0][0] if self._events else None
+        for stamp, raw in self._events:
+            if not self.running:
+                break
+            if self.speed:
+                delay = start + (stamp - first_stamp) / self.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            self._handle_event_recv(raw)
+        self.elapsed = time.time() - start
+        logger.info("Replay finished in %.3fs: %s", self.elapsed, self.counters)
+        self.running = False
+
+    def stop(self):
+        """
+        Stops the replay
+        """
+        self.running = False
+
+
+def write_synthetic_trace(path, minions=1000, states=10, noise=2):
+    """
+    Writes an event log of a synthetic stage execution, where each state step runs in all
+    minions.  An existing file is overwritten.
+    Args:
+        path (str): the event log file path
+        minions (int): the number of minions
+        states (int): the number of state steps of the stage
+        noise (int): the number of unrelated events (find_job, pillar, auth) per minion
+                     and step
+    """
+    serial = salt.payload.Serial({'serial': 'msgpack'})
+    minion_ids = ["node{:05d}.ceph".format(idx) for idx in range(minions)]
+    stage_name = 'ceph.stage.synthetic'
+    stamp = [time.time()]
+
+    def pack(tag, data):
+        return tag + salt.utils.event.TAGEND + serial.dumps(data)
+
+    def next_stamp():
+        stamp[0] += 0.0005
+        return stamp[0]
+
+    steps = [SaltRunner('ready check', {'name': 'ready.check'})]
+    steps.extend(SaltState('state {}'.format(idx), [{'tgt': '*'},
+                                                    {'sls': 'ceph.synthetic.{}'.format(idx)}])
+                 for idx in range(states))
+
+    recorder = EventRecorder(path, truncate=True)
+    recorder.record_stage(stage_name, steps, "", next_stamp())
+    orch_jid = '20180101000000000000'
+    recorder.record_event(pack('salt/run/{}/new'.format(orch_jid),
+                               {'jid': orch_jid, '_stamp': '', 'fun': 'runner.state.orch',
+                                'fun_args': [stage_name]}), next_stamp())
+    jid = 20180101000000000001
+    recorder.record_event(pack('salt/run/{}/new'.format(jid),
+                               {'jid': str(jid), '_stamp': '', 'fun': 'runner.ready.check',
+                                'fun_args': []}), next_stamp())
+    recorder.record_event(pack('salt/run/{}/ret'.format(jid),
+                               {'jid': str(jid), '_stamp': '', 'fun': 'runner.ready.check',
+                                'fun_args': [], 'success': True, 'return': True}),
+                          next_stamp())
+    for idx in range(states):
+        jid += 1
+        recorder.record_event(pack('salt/job/{}/new'.format(jid),
+                                   {'jid': str(jid), '_stamp': '', 'fun': 'state.sls',
+                                    'arg': ['ceph.synthetic.{}'.format(idx)],
+                                    'minions': minion_ids}), next_stamp())
+        for minion in minion_ids:
+            for _ in range(noise):
+                recorder.record_event(pack('salt/job/{}/ret/{}'.format(jid + 1, minion),
+                                           {'jid': str(jid + 1), '_stamp': '', 'id': minion,
+                                            'fun': 'saltutil.find_job', 'success': True,
+                                            'retcode': 0, 'return': {}}), next_stamp())
+                recorder.record_event(pack('salt/auth', {'id': minion, 'act': 'accept'}),
+                                      next_stamp())
+            recorder.record_event(pack('salt/job/{}/ret/{}'.format(jid, minion),
+                                       {'jid': str(jid), '_stamp': '', 'id': minion,
+                                        'fun': 'state.sls', 'success': True, 'retcode': 0,
+                                        'return': {}}), next_stamp())
+        jid += 1
+    recorder.record_event(pack('salt/run/{}/ret'.format(orch_jid),
+                               {'jid': orch_jid, '_stamp': '', 'fun': 'runner.state.orch',
+                                'fun_args': [stage_name], 'success': True, 'return': {}}),
+                          next_stamp())
+    recorder.close()
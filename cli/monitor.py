@@ -6,16 +6,18 @@ DeepSea stage's progress monitor
 from __future__ import absolute_import
 from __future__ import print_function
 
+from collections import deque
 import logging
-import operator
 import threading
+import time
 
 from .common import PrettyPrinter as PP
+from .event_log import ReplayEventProcessor, LatencyHistogram
 from .salt_event import SaltEventProcessor
 from .salt_event import EventListener
 from .salt_event import NewJobEvent, NewRunnerEvent, RetJobEvent, RetRunnerEvent
 from .stage_parser import SLSParser, SaltRunner, SaltState, SaltModule, SaltBuiltIn, \
-                          RenderingException
+                          RenderingException, StepGraph
 
 
 # pylint: disable=C0111
@@ -82,11 +84,15 @@ class Stage(object):
             super(Stage.TargetedStep, self).__init__(step, name, order)
             self.targets = None
             self.sub_steps = []
+            self._finished_count = 0
+            self._failed_count = 0
 
         # pylint: disable=W0221
         def start(self, event):
             super(Stage.TargetedStep, self).start(event)
             self.targets = {}
+            self._finished_count = 0
+            self._failed_count = 0
             for target in event.targets:
                 self.targets[target] = {
                     'finished': False,
@@ -96,13 +102,21 @@ class Stage(object):
                 }
 
         def finish(self, event):
-            self.targets[event.minion]['finished'] = True
-            self.targets[event.minion]['success'] = event.success and event.retcode == 0
-            self.targets[event.minion]['event'] = event
-
-            if reduce(operator.__and__, [t['finished'] for t in self.targets.values()]):
-                self.success = reduce(
-                    operator.__and__, [t['success'] for t in self.targets.values()])
+            target = self.targets[event.minion]
+            if target['finished']:
+                # duplicated return, discount the previous one
+                self._finished_count -= 1
+                if not target['success']:
+                    self._failed_count -= 1
+            target['finished'] = True
+            target['success'] = event.success and event.retcode == 0
+            target['event'] = event
+            self._finished_count += 1
+            if not target['success']:
+                self._failed_count += 1
+
+            if self._finished_count == len(self.targets):
+                self.success = self._failed_count == 0
                 self.finished = True
 
         def state_result(self, event):
@@ -152,6 +166,12 @@ class Stage(object):
             assert wrapper
             self._steps.append(wrapper)
 
+        self._step_wrappers = dict((id(wrapper.step), wrapper) for wrapper in self._steps)
+        cycle = StepGraph(self._parsed_steps).find_cycle()
+        if cycle:
+            logger.warning("Stage %s has circular requisites: %s", name,
+                           " -> ".join(step.desc for step in cycle))
+
     def total_steps(self):
         return len(self._steps)
 
@@ -323,21 +343,17 @@ class Stage(object):
 
         curr_step = self._steps[self.current_step]
         for dep in curr_step.step.on_success_deps:
-            for i in range(1, self.current_step+1):
-                dep_step = self._steps[self.current_step-i]
-                if dep_step.step.desc == dep.desc:
-                    if not dep_step.success:
-                        curr_step.skipped = True
-                        self.current_step += 1
-                        return curr_step
+            dep_step = self._step_wrappers.get(id(dep))
+            if dep_step and dep_step.order <= self.current_step and not dep_step.success:
+                curr_step.skipped = True
+                self.current_step += 1
+                return curr_step
         for dep in curr_step.step.on_fail_deps:
-            for i in range(1, self.current_step+1):
-                dep_step = self._steps[self.current_step-i]
-                if dep_step.step.desc == dep.desc:
-                    if dep_step.success:
-                        curr_step.skipped = True
-                        self.current_step += 1
-                        return curr_step
+            dep_step = self._step_wrappers.get(id(dep))
+            if dep_step and dep_step.order <= self.current_step and dep_step.success:
+                curr_step.skipped = True
+                self.current_step += 1
+                return curr_step
 
         return None
 
@@ -419,6 +435,17 @@ class MonitorListener(object):
         """
         pass
 
+    def step_state_minions_finished(self, step, minions):
+        """
+        This function is called when a Salt state finishes in a set of minions whose returns
+        arrived together. By default it calls step_state_minion_finished for each minion.
+        Args:
+            step (Stage.Step): the step object
+            minions (list): the minion ids
+        """
+        for minion in minions:
+            self.step_state_minion_finished(step, minion)
+
     def step_state_result(self, step, event):
         """
         This function is called when a Salt state result is received
@@ -455,6 +482,7 @@ class Monitor(threading.Thread):
             self.monitor = monitor
             self.func = func
             self.event = event
+            self.created = time.time()
 
         def call(self):
             logger.debug("handle: %s", self.event)
@@ -468,8 +496,6 @@ class Monitor(threading.Thread):
             self.monitor = monitor
 
         def handle_new_runner_event(self, event):
-            if 'pillar' in event.fun or 'saltutil.find_job' in event.fun:
-                return
             logger.debug("buffer: %s", event)
             if event.fun == 'runner.state.orch':
                 self.monitor.append_event(Monitor.Event(self.monitor, 'start_stage', event))
@@ -477,8 +503,6 @@ class Monitor(threading.Thread):
                 self.monitor.append_event(Monitor.Event(self.monitor, 'start_step', event))
 
         def handle_ret_runner_event(self, event):
-            if 'pillar' in event.fun or 'saltutil.find_job' in event.fun:
-                return
             logger.debug("buffer: %s", event)
             if event.fun == 'runner.state.orch':
                 self.monitor.append_event(Monitor.Event(self.monitor, 'end_stage', event))
@@ -486,16 +510,12 @@ class Monitor(threading.Thread):
                 self.monitor.append_event(Monitor.Event(self.monitor, 'end_step', event))
 
         def handle_new_job_event(self, event):
-            if 'pillar' in event.fun or 'saltutil.find_job' in event.fun or 'grains' in event.fun:
-                return
             if event.fun == 'deepsea.render_sls':
                 return
             logger.debug("buffer: %s", event)
             self.monitor.append_event(Monitor.Event(self.monitor, 'start_step', event))
 
         def handle_ret_job_event(self, event):
-            if 'pillar' in event.fun or 'saltutil.find_job' in event.fun or 'grains' in event.fun:
-                return
             if event.fun == 'deepsea.render_sls':
                 return
             logger.debug("buffer: %s", event)
@@ -505,35 +525,59 @@ class Monitor(threading.Thread):
             logger.debug("buffer: %s", event)
             self.monitor.append_event(Monitor.Event(self.monitor, 'state_result_step', event))
 
-    def __init__(self, show_state_steps, show_dynamic_steps):
+    # functions whose events are irrelevant for the stage progress, the event processor
+    # does not pass them to the DeepSea listener
+    _IGNORED_JOB_FUNS_ = ['pillar', 'saltutil.find_job', 'grains']
+    _IGNORED_RUNNER_FUNS_ = ['pillar', 'saltutil.find_job']
+
+    def __init__(self, show_state_steps, show_dynamic_steps, recorder=None, replay_file=None,
+                 replay_speed=1.0):
+        """
+        Args:
+            show_state_steps (bool): track the state steps
+            show_dynamic_steps (bool): track runtime generated steps
+            recorder (event_log.EventRecorder): records the received events and parsed stages
+            replay_file (str): replay the events of this event log instead of listening to the
+                               Salt event bus
+            replay_speed (float): the replay speed factor, 0 replays as fast as possible
+        """
         super(Monitor, self).__init__()
-        self._processor = SaltEventProcessor()
-        self._processor.add_listener(Monitor.DeepSeaEventListener(self))
+        self._recorder = recorder
+        self._stage_steps = {}
+        self.latency = None
+        if replay_file:
+            self._processor = ReplayEventProcessor(replay_file, replay_speed)
+            self._stage_steps.update(self._processor.stages)
+            self.latency = LatencyHistogram()
+        else:
+            self._processor = SaltEventProcessor(recorder)
+        self._processor.add_listener(Monitor.DeepSeaEventListener(self),
+                                     Monitor._IGNORED_JOB_FUNS_, Monitor._IGNORED_RUNNER_FUNS_)
         self._show_state_steps = show_state_steps
         self._show_dynamic_steps = show_dynamic_steps
         self._running_stage = None
         self._monitor_listeners = []
-        self._event_lock = threading.Lock()
-        self._event_cond = threading.Condition(self._event_lock)
-        self._event_buffer = []
+        self._event_flag = threading.Event()
+        self._event_buffer = deque()
         self._running = False
-        self._stage_steps = {}
 
     def parse_stage(self, stage_name):
         self._fire_event('stage_started', stage_name)
         self._fire_event('stage_parsing_started', stage_name)
         try:
             parsed_steps, out = SLSParser.parse_state_steps(stage_name, not self._show_state_steps,
-                                                            True, False)
+                                                            True, True)
         except RenderingException as ex:
             self._fire_event('stage_parsing_finished', None, None, ex)
             raise ex
         self._stage_steps[stage_name] = (parsed_steps, out)
+        if self._recorder:
+            self._recorder.record_stage(stage_name, parsed_steps, out)
 
     def append_event(self, event):
-        with self._event_cond:
-            self._event_buffer.append(event)
-            self._event_cond.notify()
+        # deque.append is thread-safe, the flag only wakes up the monitor thread
+        self._event_buffer.append(event)
+        self._event_flag.set()
 
     def start(self):
         """
@@ -549,6 +593,7 @@ class Monitor(threading.Thread):
         """
         logger.info("Stopping the DeepSea event monitoring")
         self._running = False
+        self._event_flag.set()
         self._processor.stop()
 
         if wait:
@@ -567,15 +612,52 @@ class Monitor(threading.Thread):
         """
         return self._processor.is_running() and self._running
 
+    def counters(self):
+        """
+        Returns the event counters of the Salt event processor
+        """
+        return self._processor.counters
+
+    def _drain_events(self):
+        """
+        Removes all buffered events and groups consecutive 'ret' events of the same salt job
+        so that they can be handled at once
+        """
+        batch = []
+        while True:
+            try:
+                event = self._event_buffer.popleft()
+            except IndexError:
+                break
+            if event.func == 'end_step' and isinstance(event.event, RetJobEvent):
+                last = batch[-1] if batch else None
+                if last and last.func == 'end_state_step' and \
+                   last.event[0].jid == event.event.jid:
+                    last.event.append(event.event)
+                else:
+                    batch.append(Monitor.Event(self, 'end_state_step', [event.event]))
+            else:
+                batch.append(event)
+        return batch
+
+    def _handle_events(self):
+        """
+        Handles all buffered events
+        """
+        for event in self._drain_events():
+            event.call()
+            if self.latency is not None:
+                self.latency.add(time.time() - event.created)
+
     def run(self):
         self._running = True
         while self._running:
-            with self._event_cond:
-                if self._event_buffer:
-                    event = self._event_buffer.pop(0)
-                    event.call()
-                else:
-                    self._event_cond.wait(0.2)
+            self._event_flag.wait(1.0)
+            # clear before draining, so that events appended afterwards set it again
+            self._event_flag.clear()
+            self._handle_events()
+        # handle the events received before stopping
+        self._handle_events()
 
     def add_listener(self, listener):
         """
@@ -606,10 +688,12 @@ class Monitor(threading.Thread):
             try:
                 parsed_steps, out = SLSParser.parse_state_steps(stage_name,
                                                                 not self._show_state_steps,
-                                                                True, False)
+                                                                True, True)
             except RenderingException as ex:
                 self._fire_event('stage_parsing_finished', None, None, ex)
                 return
+            if self._recorder:
+                self._recorder.record_stage(stage_name, parsed_steps, out)
         self._running_stage = Stage(stage_name, parsed_steps, self._show_dynamic_steps)
 
         self._fire_event('stage_parsing_finished', self._running_stage, out, None)
@@ -696,29 +780,57 @@ class Monitor(threading.Thread):
         Args:
             event (RetJobEvent | RetRunnerEvent): the salt end event
         """
+        if isinstance(event, RetJobEvent):
+            self.end_state_step([event])
+            return
+
         if not self._running_stage:
             # not inside a running stage, igore step
             return
         step = self._running_stage.finish_step(event)
         if not step:
             return
-        if isinstance(step, Stage.TargetedStep):
+        logger.info("Finished Runner step: [%s/%s] name=%s(%s) success=%s", step.order,
+                    self._running_stage.total_steps(), step.name, step.args_str,
+                    event.success)
+        if not event.success:
+            logger.info("State step error:\n%s", PP.format_dict(event.raw_event))
+        self._fire_event('step_runner_finished', step)
+        self._skip_steps()
+
+    def end_state_step(self, events):
+        """
+        Marks a state step as finished in the minions of a set of returns of the same job
+        Args:
+            events (list(RetJobEvent)): the salt end events
+        """
+        if not self._running_stage:
+            # not inside a running stage, igore step
+            return
+        step = None
+        minions = []
+        for event in events:
+            ret_step = self._running_stage.finish_step(event)
+            if not ret_step:
+                continue
+            step = ret_step
+            minions.append(event.minion)
             logger.info("Finished State step: [%s/%s] name=%s(%s) in=%s success=%s", step.order,
                         self._running_stage.total_steps(), step.name, step.args_str,
                         event.minion, step.targets[event.minion]['success'])
             if not step.targets[event.minion]['success']:
                 logger.info("State step error:\n%s", PP.format_dict(event.raw_event))
-            self._fire_event('step_state_minion_finished', step, event.minion)
-            if step.finished:
-                self._fire_event('step_state_finished', step)
-        else:
-            logger.info("Finished Runner step: [%s/%s] name=%s(%s) success=%s", step.order,
-                        self._running_stage.total_steps(), step.name, step.args_str,
-                        event.success)
-            if not event.success:
-                logger.info("State step error:\n%s", PP.format_dict(event.raw_event))
-            self._fire_event('step_runner_finished', step)
+        if not step:
+            return
+        self._fire_event('step_state_minions_finished', step, minions)
+        if step.finished:
+            self._fire_event('step_state_finished', step)
+        self._skip_steps()
 
+    def _skip_steps(self):
+        """
+        Skips the following steps whose requisites were not met
+        """
         skipped = self._running_stage.check_if_current_step_will_run()
         while skipped:
             if isinstance(skipped, Stage.TargetedStep):
@@ -820,11 +820,16 @@ class StepListPrinter(MonitorListener):
             self.print_step(self.step)
 
     def step_state_minion_finished(self, step, minion):
-        if not step.targets[minion]['success']:
-            if step.name not in self.errors:
-                self.errors[step.name] = OrderedDict()
-            self.errors[step.name][minion] = step.targets[minion]['event']
+        self.step_state_minions_finished(step, [minion])
+
+    def step_state_minions_finished(self, step, minions):
+        for minion in minions:
+            if not step.targets[minion]['success']:
+                if step.name not in self.errors:
+                    self.errors[step.name] = OrderedDict()
+                self.errors[step.name][minion] = step.targets[minion]['event']
 
+        # a burst of returns only needs to redraw the step once
         with self.print_lock:
             if self.step and self.step.step.jid != step.jid:
                 # maybe it's a substep
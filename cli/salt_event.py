@@ -4,11 +4,13 @@ Salt Event Processor module
 """
 from __future__ import absolute_import
 
-import fnmatch
 import logging
+import re
 import threading
+import time
 
 import salt.config
+import salt.payload
 import salt.utils.event
 from tornado.ioloop import IOLoop
 
@@ -17,6 +19,19 @@ from tornado.ioloop import IOLoop
 logger = logging.getLogger(__name__)
 
 
+# tag prefixes of the events handled by the processor, all other events are dropped before
+# being deserialized
+_TAG_PREFIXES = ('salt/job/', 'salt/run/', 'salt/state_result/')
+_RAW_TAG_PREFIXES = tuple(prefix.encode('ascii') for prefix in _TAG_PREFIXES)
+
+# single-pass tag classifier, alternatives are tried in the same order as the previous
+# fnmatch patterns: salt/job/*/new, salt/run/*/new, salt/job/*/ret/*, salt/run/*/ret,
+# salt/state_result/*
+_TAG_CLASSIFIER = re.compile(r'salt/(?:(?P<new_job>job/.*/new)|(?P<new_runner>run/.*/new)|'
+                             r'(?P<ret_job>job/.*/ret/.*)|(?P<ret_runner>run/.*/ret)|'
+                             r'(?P<state_result>state_result/.*))\Z', re.DOTALL)
+
+
 class SaltEvent(object):
     """
     Base class of a Salt Event
@@ -166,22 +181,89 @@ class EventListener(object):
         pass
 
 
+class EventCounters(object):
+    """
+    Counters of the events received by the SaltEventProcessor
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.seen = 0
+        self.dropped = 0
+        self.dispatched = 0
+
+    def rates(self):
+        """
+        Returns the counters and their per second rates since the processor started
+        """
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        return {
+            'seen': self.seen,
+            'dropped': self.dropped,
+            'dispatched': self.dispatched,
+            'seen_per_sec': self.seen / elapsed,
+            'dropped_per_sec': self.dropped / elapsed,
+            'dispatched_per_sec': self.dispatched / elapsed
+        }
+
+    def __str__(self):
+        return "seen: {seen} ({seen_per_sec:.1f}/s) dropped: {dropped} ({dropped_per_sec:.1f}/s) " \
+               "dispatched: {dispatched} ({dispatched_per_sec:.1f}/s)".format(**self.rates())
+
+
 class SaltEventProcessor(threading.Thread):
     """
     This class implements an execution loop to listen for the Salt event BUS.
     """
-    def __init__(self):
+
+    _DISPATCH_ = {
+        'new_job': (NewJobEvent, 'handle_new_job_event'),
+        'new_runner': (NewRunnerEvent, 'handle_new_runner_event'),
+        'ret_job': (RetJobEvent, 'handle_ret_job_event'),
+        'ret_runner': (RetRunnerEvent, 'handle_ret_runner_event'),
+        'state_result': (StateResultEvent, 'handle_state_result_event')
+    }
+
+    def __init__(self, recorder=None):
+        """
+        Args:
+            recorder (event_log.EventRecorder): records all received raw events
+        """
         super(SaltEventProcessor, self).__init__()
         self.running = False
         self.listeners = []
         self.io_loop = None
+        self.recorder = recorder
+        self.counters = EventCounters()
+        self._serial = salt.payload.Serial({'serial': 'msgpack'})
+        self._fun_filters = []
 
-    def add_listener(self, listener):
+    @staticmethod
+    def _compile_filter(substrings):
+        """
+        Compiles a list of substrings into a single regular expression
+        """
+        if not substrings:
+            return None
+        return re.compile("|".join(re.escape(substr) for substr in substrings))
+
+    def add_listener(self, listener, ignored_job_funs=None, ignored_runner_funs=None):
         """Adds an event listener to the listener list
         Args:
             listener (EventListener): the listener object
+            ignored_job_funs (list): job events whose function name contains any of these
+                                     strings are not passed to this listener
+            ignored_runner_funs (list): runner events whose function name contains any of
+                                        these strings are not passed to this listener
         """
         self.listeners.append(listener)
+        job_filter = self._compile_filter(ignored_job_funs)
+        runner_filter = self._compile_filter(ignored_runner_funs)
+        self._fun_filters.append({
+            'new_job': job_filter,
+            'ret_job': job_filter,
+            'new_runner': runner_filter,
+            'ret_runner': runner_filter
+        })
 
     def is_running(self):
         """
@@ -191,6 +273,7 @@ class SaltEventProcessor(threading.Thread):
 
     def start(self):
         self.running = True
+        self.counters = EventCounters()
         super(SaltEventProcessor, self).start()
 
     def run(self):
@@ -212,46 +295,53 @@ class SaltEventProcessor(threading.Thread):
         """
         self.running = False
         self.io_loop.stop()
+        logger.info("Salt event processor stopped: %s", self.counters)
 
     def _handle_event_recv(self, raw):
         """
         Handles the asynchronous reception of raw events
         """
-        mtag, data = salt.utils.event.SaltEvent.unpack(raw)
-        self._process({'tag': mtag, 'data': data})
-
-    def _process(self, event):
+        self.counters.seen += 1
+        if self.recorder:
+            self.recorder.record_event(raw)
+        if not raw.startswith(_RAW_TAG_PREFIXES):
+            self.counters.dropped += 1
+            return
+        mtag, data = salt.utils.event.SaltEvent.unpack(raw, self._serial)
+        self._process({'tag': mtag, 'data': data}, False)
+
+    def _process(self, event, count=True):
         """Processes a raw event
 
-        Creates the proper salt event class wrapper and notifies listeners
+        Classifies the event tag, selects the listeners that do not ignore the event
+        function, and only then creates the proper salt event class wrapper and notifies
+        these listeners.  Events that no listener wants are dropped.
 
         Args:
             event (dict): the raw event data
+            count (bool): whether the event was not yet counted as seen
         """
+        if count:
+            self.counters.seen += 1
+        match = _TAG_CLASSIFIER.match(event['tag'])
+        if not match:
+            self.counters.dropped += 1
+            return
+        kind = match.lastgroup
+        fun = event['data'].get('fun')
+        if not fun or isinstance(fun, list):
+            listeners = self.listeners
+        else:
+            listeners = [listener for listener, filters in zip(self.listeners, self._fun_filters)
+                         if not filters.get(kind) or not filters[kind].search(fun)]
+        if not listeners:
+            self.counters.dropped += 1
+            return
+
         logger.debug("Process event -> %s", event)
-        wrapper = None
-        if fnmatch.fnmatch(event['tag'], 'salt/job/*/new'):
-            wrapper = NewJobEvent(event)
-            for listener in self.listeners:
-                listener.handle_salt_event(wrapper)
-                listener.handle_new_job_event(wrapper)
-        elif fnmatch.fnmatch(event['tag'], 'salt/run/*/new'):
-            wrapper = NewRunnerEvent(event)
-            for listener in self.listeners:
-                listener.handle_salt_event(wrapper)
-                listener.handle_new_runner_event(wrapper)
-        elif fnmatch.fnmatch(event['tag'], 'salt/job/*/ret/*'):
-            wrapper = RetJobEvent(event)
-            for listener in self.listeners:
-                listener.handle_salt_event(wrapper)
-                listener.handle_ret_job_event(wrapper)
-        elif fnmatch.fnmatch(event['tag'], 'salt/run/*/ret'):
-            wrapper = RetRunnerEvent(event)
-            for listener in self.listeners:
-                listener.handle_salt_event(wrapper)
-                listener.handle_ret_runner_event(wrapper)
-        elif fnmatch.fnmatch(event['tag'], 'salt/state_result/*'):
-            wrapper = StateResultEvent(event)
-            for listener in self.listeners:
-                listener.handle_salt_event(wrapper)
-                listener.handle_state_result_event(wrapper)
+        wrapper_class, handler = self._DISPATCH_[kind]
+        wrapper = wrapper_class(event)
+        self.counters.dispatched += 1
+        for listener in listeners:
+            listener.handle_salt_event(wrapper)
+            getattr(listener, handler)(wrapper)
@@ -5,7 +5,9 @@ This module is responsible for the parsing of DeepSea stage files
 from __future__ import absolute_import
 from __future__ import print_function
 
+import collections
 import glob
+import hashlib
 import logging
 import os
 import pickle
@@ -13,12 +15,13 @@ import pwd
 import StringIO
 
 from collections import OrderedDict, defaultdict
-from multiprocessing import Process, Queue
+from multiprocessing import Pool, Process, Queue
 
 import salt.client
 import salt.exceptions
 
 from .common import redirect_stdout, redirect_stderr
+from .config import Config
 
 
 # pylint: disable=C0103
@@ -162,23 +165,53 @@ class SLSRenderer(object):
             result[key] = SLSRenderer._deserialize_ordered_dict(val['__val__'])
         return result
 
+    @staticmethod
+    def _collect_returns(pub_data, target):
+        """
+        Collects the returns of a published job
+        Args:
+            pub_data (dict): the publish data returned by LocalClient.run_job
+            target (str): the compound target expression used to publish the job
+        Returns:
+            dict: the return of each minion, minions that did not return are left out
+        """
+        ret = {}
+        for fn_ret in SLSRenderer.local.get_cli_returns(pub_data['jid'], pub_data['minions'],
+                                                        tgt=target, tgt_type="compound"):
+            if fn_ret:
+                for minion, data in fn_ret.items():
+                    ret[minion] = data.get('ret', {})
+        for missing in sorted(set(pub_data['minions']) - set(ret)):
+            logger.warning("minion %s did not return the rendered states", missing)
+        return ret
+
     @staticmethod
     def render_states(target_states, retry=False):
         """
         This function makes use of slsutil salt module to render state sls in the target minions
+        The render jobs of all targets are published at once, and only then their returns are
+        collected, so that the minions render the states concurrently.
         Args:
             target_states (dict): dictionary where key is the minion target and value the
                                   list of states
         """
         result = {}
-        for target, states in target_states.items():
-            logger.info("Rendering states=%s on=%s", states, target)
-            # pylint: disable=W8470,E1101
-            with open('/dev/null', 'w') as fnull:
-                with redirect_stderr(fnull):
-                    with redirect_stdout(fnull):
-                        out = SLSRenderer.local.cmd(target, 'deepsea.render_sls', [states],
-                                                    expr_form="compound")
+        outs = []
+        # pylint: disable=W8470,E1101
+        with open('/dev/null', 'w') as fnull:
+            with redirect_stderr(fnull):
+                with redirect_stdout(fnull):
+                    jobs = []
+                    for target, states in target_states.items():
+                        logger.info("Rendering states=%s on=%s", states, target)
+                        pub_data = SLSRenderer.local.run_job(target, 'deepsea.render_sls',
+                                                             [states], expr_form="compound")
+                        jobs.append((target, states, pub_data))
+                    for target, states, pub_data in jobs:
+                        out = SLSRenderer._collect_returns(pub_data, target) if pub_data else {}
+                        outs.append((target, states, out))
+
+        for target, states, out in outs:
             for key, val in out.items():
                 if isinstance(val, str):
                     logger.info("call to deepsea module returned: %s", val)
@@ -202,6 +235,169 @@ class SLSRenderer(object):
         return result
 
 
+def _render_worker(file_name):
+    """
+    Renders an sls file in a worker process of the parser pool.
+    Rendering errors are returned instead of raised, so that they are only reported if the
+    parser actually reaches the file during the traversal.
+    """
+    try:
+        return SLSRenderer.render(file_name)
+    except RenderingException as ex:
+        return ex
+
+
+class StageCache(object):
+    """
+    Persistent cache of stage parsing results
+
+    Each traversed state is stored in its own cache file together with the list of SLS files
+    that were touched while rendering it (including the files of its includes and of the
+    states rendered in the minions), and a fingerprint of those files plus the pillar
+    revision. An entry is only used while its fingerprint still matches the filesystem.
+
+    Entries are evicted in least-recently-used order whenever the cache grows beyond
+    `max_size` bytes.
+    """
+
+    _PILLAR_DIR_PATH_ = "/srv/pillar"
+    _MINION_KEYS_DIR_PATH_ = "/etc/salt/pki/master/minions"
+
+    def __init__(self, cache_dir, prefix, max_size):
+        self.cache_dir = cache_dir
+        self.prefix = prefix
+        self.max_size = max_size
+        self._signatures = {}
+        self._revision = None
+        self._entries = {}
+
+    def entry_path(self, state_name, stages_only, only_visible_steps):
+        """
+        Returns the cache file path of a state
+        """
+        return '{}/{}_{}_{}_{}.bin'.format(self.cache_dir, self.prefix, stages_only,
+                                           only_visible_steps, state_name)
+
+    def _signature(self, path):
+        """
+        Returns the (mtime, size) signature of a file, or None if it does not exist
+        """
+        if path not in self._signatures:
+            try:
+                stat = os.stat(path)
+                self._signatures[path] = (stat.st_mtime, stat.st_size)
+            except OSError:
+                self._signatures[path] = None
+        return self._signatures[path]
+
+    def revision(self):
+        """
+        Returns a digest of the pillar tree and of the set of accepted minion keys.
+        The proposals directory is not part of the pillar and is skipped.
+        """
+        if self._revision is None:
+            digest = hashlib.sha1()
+            for root, dirs, files in os.walk(self._PILLAR_DIR_PATH_):
+                dirs[:] = sorted(d for d in dirs if d != 'proposals')
+                for file_name in sorted(files):
+                    path = os.path.join(root, file_name)
+                    digest.update("{}:{}\n".format(path, self._signature(path)))
+            for key in sorted(os.listdir(self._MINION_KEYS_DIR_PATH_)
+                              if os.path.isdir(self._MINION_KEYS_DIR_PATH_) else []):
+                digest.update("key:{}\n".format(key))
+            self._revision = digest.hexdigest()
+        return self._revision
+
+    def fingerprint(self, deps):
+        """
+        Computes the fingerprint of a set of files
+        Args:
+            deps (iterable): the file paths
+        """
+        digest = hashlib.sha1(self.revision())
+        for path in sorted(deps):
+            digest.update("{}:{}\n".format(path, self._signature(path)))
+        return digest.hexdigest()
+
+    def load(self, state_name, stages_only, only_visible_steps):
+        """
+        Loads a state parsing result from the cache
+        Returns:
+            tuple: (steps, output, deps) or None if there is no valid entry
+        """
+        path = self.entry_path(state_name, stages_only, only_visible_steps)
+        if path in self._entries:
+            return self._entries[path]
+        try:
+            # pylint: disable=W8470
+            with open(path, mode='rb') as binfile:
+                entry = pickle.load(binfile)
+        except (IOError, EOFError, pickle.UnpicklingError, AttributeError, ImportError,
+                IndexError, TypeError, ValueError):
+            return None
+
+        if not isinstance(entry, dict) or \
+           entry.get('fingerprint') != self.fingerprint(entry.get('deps', [])):
+            logger.info("cache entry of state %s is stale", state_name)
+            return None
+
+        try:
+            # mark entry as recently used
+            os.utime(path, None)
+        except OSError:
+            pass
+        self._entries[path] = (entry['result'], entry['out'], entry['deps'])
+        return self._entries[path]
+
+    def store(self, state_name, stages_only, only_visible_steps, result, out, deps):
+        """
+        Stores a state parsing result in the cache
+        """
+        path = self.entry_path(state_name, stages_only, only_visible_steps)
+        entry = {
+            'fingerprint': self.fingerprint(deps),
+            'deps': sorted(deps),
+            'result': result,
+            'out': out
+        }
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            # pylint: disable=W8470
+            with open(tmp_path, mode='wb') as binfile:
+                pickle.dump(entry, binfile, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except (IOError, OSError, pickle.PicklingError) as ex:
+            logger.warning("failed to store state %s in cache: %s", state_name, ex)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._evict()
+
+    def _evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_size
+        """
+        entries = []
+        total = 0
+        for path in glob.glob('{}/{}_*.bin'.format(self.cache_dir, self.prefix)):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        while total > self.max_size and entries:
+            _, size, path = entries.pop(0)
+            logger.info("evicting cache entry: %s", path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
 class SLSParser(object):
     """
     SLS files parser
@@ -209,6 +405,24 @@ class SLSParser(object):
 
     _CACHE_FILE_PREFIX_ = "_deepsea"
     _CACHE_DIR_PATH_ = "/tmp"
+    _CACHE_MAX_SIZE_ = 64 * 1024 * 1024
+
+    @staticmethod
+    def _state_files(state_name):
+        """
+        Returns the set of SLS files that belong to a state.
+        If the state is a directory, all files below it are returned, so that changes to
+        files included via Jinja are also taken into account.
+        """
+        path = "/srv/salt/{}".format(state_name.replace(".", "/"))
+        if not os.path.isdir(path):
+            return set(["{}.sls".format(path)])
+
+        result = set()
+        for root, _, files in os.walk(path):
+            for file_name in files:
+                result.add(os.path.join(root, file_name))
+        return result
 
     @staticmethod
     def _state_name_is_dir(state_name):
@@ -302,7 +516,51 @@ class SLSParser(object):
         return result
 
     @staticmethod
-    def _traverse_stage(state_name, stages_only, only_visible_steps, cache):
+    def _render_stage_tree(state_name, stages_only, only_visible_steps, cache, pool):
+        """
+        Renders all stage files reachable from state_name through "include" directives.
+        The tree is rendered breadth-first, and all files of the same depth are rendered
+        concurrently by the worker pool. Sub-trees with a valid cache entry are skipped.
+        Args:
+            state_name (str): the salt state name, e.g., ceph.stage.1
+            stages_only (bool): only parse stages sls files
+            only_visible_steps (bool): wheather to parse state declarations that have
+                                       fire_event=True
+            cache (StageCache): the cache used to load/store the results, or None
+            pool (multiprocessing.Pool): the worker pool
+
+        Returns:
+            dict: the render results (or RenderingException) indexed by file path
+        """
+        rendered = {}
+        level = [state_name]
+        while level:
+            names = []
+            paths = []
+            for name in level:
+                if cache and cache.load(name, stages_only, only_visible_steps):
+                    continue
+                try:
+                    path = SLSParser._state_file_path(name)
+                except OrchestrationNotFound:
+                    # will be reported by the traversal
+                    continue
+                if path not in rendered and path not in paths:
+                    names.append(name)
+                    paths.append(path)
+
+            logger.info("Rendering %s stage files concurrently", len(paths))
+            level = []
+            for name, path, res in zip(names, paths, pool.map(_render_worker, paths)):
+                rendered[path] = res
+                if isinstance(res, RenderingException) or not res[0]:
+                    continue
+                for inc in res[0].get('include', []):
+                    level.append(SLSParser._gen_state_name_from_include(name, inc))
+        return rendered
+
+    @staticmethod
+    def _traverse_stage(state_name, stages_only, only_visible_steps, cache, rendered=None):
         """
         Parses the all steps (actions) triggered by the execution of a state file.
         It recursevely follows "include" directives, and state files.
@@ -311,35 +569,44 @@ class SLSParser(object):
             stages_only (bool): only parse stages sls files
             only_visible_steps (bool): wheather to parse state declarations that have
                                        fire_event=True
-            cache (bool): wheather load/store the results in a cache file
+            cache (StageCache): the cache used to load/store the results, or None
+            rendered (dict): stage files already rendered by _render_stage_tree
 
         Returns:
             list(StepType): a list of steps
+            str: the parsing stdout
+            set(str): the SLS files touched while parsing
         """
-        cache_file_path = '{}/{}_{}_{}_{}.bin'.format(SLSParser._CACHE_DIR_PATH_,
-                                                      SLSParser._CACHE_FILE_PREFIX_,
-                                                      stages_only, only_visible_steps,
-                                                      state_name)
         if cache:
-            if os.path.exists(cache_file_path):
+            entry = cache.load(state_name, stages_only, only_visible_steps)
+            if entry:
                 logger.info("state %s found in cache, loading from cache...", state_name)
-                # pylint: disable=W8470
-                with open(cache_file_path, mode='rb') as binfile:
-                    return pickle.load(binfile)
+                result, out, deps = entry
+                return result, out, set(deps)
 
         result = []
+        deps = SLSParser._state_files(state_name)
         path = SLSParser._state_file_path(state_name)
         logger.info("Parsing state file: %s", path)
-        state_dict, out, _ = SLSRenderer.render(path)
+        if rendered and path in rendered:
+            render_result = rendered[path]
+            if isinstance(render_result, RenderingException):
+                raise render_result
+            state_dict, out, _ = render_result
+        else:
+            state_dict, out, _ = SLSRenderer.render(path)
         for key, steps in state_dict.items():
             if key == 'include':
                 for inc in state_dict['include']:
                     logger.debug("Handling include of: parent={} include={}"
                                  .format(state_name, inc))
                     include_state_name = SLSParser._gen_state_name_from_include(state_name, inc)
-                    sub_res, sub_out = SLSParser._traverse_stage(include_state_name, stages_only,
-                                                                 only_visible_steps, cache)
+                    sub_res, sub_out, sub_deps = SLSParser._traverse_stage(include_state_name,
+                                                                           stages_only,
+                                                                           only_visible_steps,
+                                                                           cache, rendered)
                     result.extend(sub_res)
+                    deps.update(sub_deps)
                     if sub_out:
                         out += "\n{}".format(sub_out)
             else:
@@ -367,6 +634,7 @@ class SLSParser(object):
             for state in result:
                 if isinstance(state, SaltState) and not state.rendered:
                     render_states[state.target].append(state.state)
+                    deps.update(SLSParser._state_files(state.state))
 
             rendered_states = SLSRenderer.render_states(render_states)
             if rendered_states:
@@ -386,46 +654,53 @@ class SLSParser(object):
                 result = nresult
 
         if cache:
-            # pylint: disable=W8470
-            with open(cache_file_path, mode='wb') as binfile:
-                pickle.dump((result, out), binfile)
+            cache.store(state_name, stages_only, only_visible_steps, result, out, deps)
 
-        return result, out
+        return result, out, deps
+
+    @staticmethod
+    def _step_module(step):
+        """
+        Returns the salt module name used to reference a step in requisites
+        """
+        if isinstance(step, (SaltRunner, SaltState)):
+            return 'salt'
+        return step.fun[:step.fun.find('.')]
 
     @staticmethod
-    def _search_step(steps, mod_name, sid):
+    def _build_step_index(steps):
         """
-        Searches a step that matches the module name and state id
+        Builds an index to search steps by state id or name, with or without module name.
+        When several steps match the same key, the first one in execution order is kept.
         Args:
             steps (list): list of steps
-            mod_name (str): salt module name, can be None
-            sid (str): state id
+
+        Returns:
+            dict: the steps indexed by (module name or None, state id)
         """
+        index = {}
         for step in steps:
-            if mod_name:
-                if isinstance(step, SaltRunner):
-                    if mod_name != 'salt':
-                        continue
-                elif isinstance(step, SaltState):
-                    if mod_name != 'salt':
-                        continue
-                else:
-                    step_mod = step.fun[:step.fun.find('.')]
-                    if mod_name != step_mod:
-                        continue
+            mod_name = SLSParser._step_module(step)
+            sids = [step.desc]
             name_arg = step.get_arg('name')
-            if step.desc == sid or (name_arg and name_arg == sid):
-                return step
-        return None
+            if name_arg and isinstance(name_arg, collections.Hashable):
+                sids.append(name_arg)
+            for sid in sids:
+                index.setdefault((mod_name, sid), step)
+                index.setdefault((None, sid), step)
+        return index
 
     @staticmethod
-    def parse_state_steps(state_name, stages_only=True, only_visible_steps=True, cache=True):
+    def parse_state_steps(state_name, stages_only=True, only_visible_steps=True, cache=True,
+                          workers=None):
         """
         Parses the all steps (actions) triggered by the execution of a state file
         Args:
             state_name (str): the salt state name, e.g., ceph.stage.1
             only_events (bool): wheather to parse state declarations that have fire_event=True
-            cache (bool): wheather load/store the results in a cache file
+            cache (bool): wheather load/store the results in the stage cache
+            workers (int): the number of stage files rendered concurrently, defaults to
+                           Config.PARSE_WORKERS
 
         Returns:
             list(StepType): a list of steps
@@ -446,9 +721,25 @@ class SLSParser(object):
             os.setgid(pw.pw_gid)
             os.setuid(pw.pw_uid)
 
+            stage_cache = None
+            if cache:
+                stage_cache = StageCache(SLSParser._CACHE_DIR_PATH_,
+                                         SLSParser._CACHE_FILE_PREFIX_,
+                                         SLSParser._CACHE_MAX_SIZE_)
             try:
-                result, out = SLSParser._traverse_stage(state_name, stages_only, only_visible_steps,
-                                                        cache)
+                rendered = None
+                if workers > 1:
+                    pool = Pool(workers)
+                    try:
+                        rendered = SLSParser._render_stage_tree(state_name, stages_only,
+                                                                only_visible_steps, stage_cache,
+                                                                pool)
+                    finally:
+                        pool.close()
+                        pool.join()
+                result, out, _ = SLSParser._traverse_stage(state_name, stages_only,
+                                                           only_visible_steps, stage_cache,
+                                                           rendered)
                 queue.put(result)
                 queue.put(out)
                 queue.put(None)
@@ -457,6 +748,9 @@ class SLSParser(object):
                 queue.put(None)
                 queue.put(ex)
 
+        if workers is None:
+            workers = Config.PARSE_WORKERS
+
         queue = Queue()
         p = Process(target=subproc_fun, args=[queue])
         p.start()
@@ -468,6 +762,8 @@ class SLSParser(object):
         if exception:
             raise exception
 
+        step_index = SLSParser._build_step_index(result)
+
         def process_requisite_directive(step, directive):
             """
             Processes a requisite directive
@@ -483,14 +779,14 @@ class SLSParser(object):
                 for req in req:
                     if isinstance(req, dict):
                         for mod, sid in req.items():
-                            req_step = SLSParser._search_step(result, mod, sid)
+                            req_step = step_index.get((mod or None, sid))
                             assert req_step
                             if directive in ['require', 'watch', 'onchanges']:
                                 step.on_success_deps.append(req_step)
                             elif directive == 'onfail':
                                 step.on_fail_deps.append(req_step)
                     else:
-                        req_step = SLSParser._search_step(result, None, req)
+                        req_step = step_index.get((None, req))
                         assert req_step
                         if directive in ['require', 'watch', 'onchanges']:
                             step.on_success_deps.append(req_step)
@@ -668,3 +964,72 @@ class SaltBuiltIn(SaltStep):
 
     def __str__(self):
         return "SaltBuiltIn(desc: {}, fun: {}, args: {})".format(self.desc, self.fun, self.args)
+
+
+class StepGraph(object):
+    """
+    Dependency graph of the steps of a stage, built from the requisites resolved by
+    SLSParser.parse_state_steps.
+
+    An edge goes from a step to each of the steps it depends on, either on success
+    (require, watch, onchanges) or on failure (onfail).
+    """
+    def __init__(self, steps):
+        self.steps = steps
+        self._order = {}
+        self._dependents = {}
+        for idx, step in enumerate(steps):
+            self._order[id(step)] = idx
+            self._dependents[id(step)] = []
+        for step in steps:
+            for dep in self.dependencies(step):
+                if id(dep) in self._dependents:
+                    self._dependents[id(dep)].append(step)
+
+    def order(self, step):
+        """
+        Returns the position of the step in the stage execution order
+        """
+        return self._order[id(step)]
+
+    @staticmethod
+    def dependencies(step):
+        """
+        Returns the steps the step depends on
+        """
+        return step.on_success_deps + step.on_fail_deps
+
+    def dependents(self, step):
+        """
+        Returns the steps that depend on the step
+        """
+        return self._dependents[id(step)]
+
+    def find_cycle(self):
+        """
+        Searches for a circular dependency between steps
+
+        Returns:
+            list(SaltStep): the steps that form the cycle, where the first step is repeated
+                            at the end, or None if the graph is acyclic
+        """
+        visiting, visited = 1, 2
+        state = {}
+        for root in self.steps:
+            if id(root) in state:
+                continue
+            path = [root]
+            stack = [iter(self.dependencies(root))]
+            state[id(root)] = visiting
+            while stack:
+                dep = next(stack[-1], None)
+                if dep is None:
+                    state[id(path.pop())] = visited
+                    stack.pop()
+                elif state.get(id(dep)) == visiting:
+                    return path[[id(s) for s in path].index(id(dep)):] + [dep]
+                elif id(dep) not in state:
+                    state[id(dep)] = visiting
+                    path.append(dep)
+                    stack.append(iter(self.dependencies(dep)))
+        return None
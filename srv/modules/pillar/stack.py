@@ -363,18 +363,120 @@ You can also select a custom merging strategy using a ``__`` object in a list:
 '''
 
 from __future__ import absolute_import
+import copy
 import os
 import logging
 from functools import partial
 
 import yaml
 from jinja2 import FileSystemLoader, Environment, TemplateNotFound
+from jinja2.bccache import BytecodeCache
+from jinja2.loaders import split_template_path
 
 
 log = logging.getLogger(__name__)
 strategies = ('overwrite', 'merge-first', 'merge-last', 'remove')
 
 
+class StackCache(object):
+    '''
+    Process wide cache of the stack files, shared by the pillar refreshes of
+    all minions.
+
+    - the compiled templates, so that the Jinja environment of each render
+      does not compile them again
+    - the parsed YAML of files without any Jinja markup, keyed by path,
+      mtime and size
+    - the merged stack of leading layers that are neither templates nor
+      specific to a minion, keyed by the cfg and the signatures of these
+      layers
+    '''
+
+    max_files = 16384
+    max_layers = 4096
+
+    def __init__(self):
+        self.enabled = True
+        self.clear()
+
+    def clear(self):
+        '''
+        Forget all cached files and merged layers
+        '''
+        self.bytecode = _MemoryBytecodeCache(self.max_files)
+        self.files = {}
+        self.layers = {}
+
+    def environment(self, basedir):
+        '''
+        Return a new Jinja environment of a stack directory.  Environments
+        are not shared between minions, since their globals belong to one
+        minion and templates imported without context keep the globals of
+        their first render.
+        '''
+        if not self.enabled:
+            return Environment(loader=FileSystemLoader(basedir))
+        return Environment(loader=FileSystemLoader(basedir), bytecode_cache=self.bytecode)
+
+    def static_file(self, basedir, path):
+        '''
+        Return the signature and the parsed content of a file without Jinja
+        markup, or None for templates.  Raises TemplateNotFound like the
+        Jinja loader.
+        '''
+        filename = os.path.join(basedir, *split_template_path(path))
+        if not os.path.isfile(filename):
+            raise TemplateNotFound(path)
+        stat = os.stat(filename)
+        signature = (filename, stat.st_mtime, stat.st_size)
+        if signature not in self.files:
+            if len(self.files) >= self.max_files:
+                self.files.clear()
+            with open(filename) as content_file:
+                content = content_file.read()
+            if '{{' in content or '{%' in content or '{#' in content:
+                self.files[signature] = None
+            else:
+                self.files[signature] = (signature, yaml.safe_load(content))
+        return self.files[signature]
+
+    def store_layers(self, key, stack):
+        '''
+        Keep a copy of the stack merged from the layers of key
+        '''
+        if len(self.layers) >= self.max_layers:
+            self.layers.clear()
+        self.layers[key] = copy.deepcopy(stack)
+
+
+class _MemoryBytecodeCache(BytecodeCache):
+    '''
+    Keep the compiled templates in memory.  Jinja checks the source
+    checksum of a bucket, modified templates are compiled again.
+    '''
+
+    def __init__(self, max_templates):
+        self.max_templates = max_templates
+        self.buckets = {}
+
+    def load_bytecode(self, bucket):
+        code = self.buckets.get(bucket.key)
+        if code is not None:
+            bucket.bytecode_from_string(code)
+
+    def dump_bytecode(self, bucket):
+        if len(self.buckets) >= self.max_templates:
+            self.buckets.clear()
+        self.buckets[bucket.key] = bucket.bytecode_to_string()
+
+    def clear(self):
+        self.buckets.clear()
+
+
+_CACHE = StackCache()
+_MISSING = object()
+
+
 def ext_pillar(minion_id, pillar, *args, **kwargs):
     import salt.utils
     stack = {}
@@ -405,7 +507,7 @@ def ext_pillar(minion_id, pillar, *args, **kwargs):
 def _process_stack_cfg(cfg, stack, minion_id, pillar):
     log.debug('Config: {0}'.format(cfg))
     basedir, filename = os.path.split(cfg)
-    jenv = Environment(loader=FileSystemLoader(basedir))
+    jenv = _CACHE.environment(basedir)
     jenv.globals.update({
         "__opts__": __opts__,
         "__salt__": __salt__,
@@ -413,18 +515,43 @@ def _process_stack_cfg(cfg, stack, minion_id, pillar):
         "minion_id": minion_id,
         "pillar": pillar,
         })
-    for path in _parse_stack_cfg(jenv.get_template(filename).render(stack=stack)):
+    paths = _parse_stack_cfg(jenv.get_template(filename).render(stack=stack))
+    shared = []
+    first = 0
+    # Shared layers can only be reused when this cfg starts from scratch
+    if _CACHE.enabled and not stack:
+        shared = _shared_layers(basedir, paths, minion_id)
+        for count in range(len(shared), 0, -1):
+            key = _layers_key(cfg, shared, count)
+            if key in _CACHE.layers:
+                log.debug('Reusing {0} merged layers of {1}'.format(count, cfg))
+                stack = copy.deepcopy(_CACHE.layers[key])
+                first = count
+                break
+    for index in range(first, len(paths)):
+        path = paths[index]
         try:
             log.debug('YAML: basedir={0}, path={1}'.format(basedir, path))
-            obj = yaml.safe_load(jenv.get_template(path).render(stack=stack))
+            if index < len(shared):
+                static = shared[index]
+            elif _CACHE.enabled:
+                static = _CACHE.static_file(basedir, path)
+            else:
+                static = None
+            if static is None:
+                obj = yaml.safe_load(jenv.get_template(path).render(stack=stack))
+            elif static[1] is _MISSING:
+                raise TemplateNotFound(path)
+            else:
+                obj = copy.deepcopy(static[1])
             log.debug('obj: {0}'.format(obj))
-            
+
             if not isinstance(obj, dict):
                 log.info('Ignoring pillar stack template "{0}": Can\'t parse '
                          'as a valid yaml dictionary'.format(path))
-                continue
-            stack = _merge_dict(stack, obj)
-            log.debug('stack: {0}'.format(stack))
+            else:
+                stack = _merge_dict(stack, obj)
+                log.debug('stack: {0}'.format(stack))
         except TemplateNotFound as e:
             if hasattr(e, 'name') and e.name != path:
                 log.info('Jinja include file "{0}" not found '
@@ -434,10 +561,37 @@ def _process_stack_cfg(cfg, stack, minion_id, pillar):
             else:
                 log.info('Ignoring pillar stack template "{0}": can\'t find from '
                          'root dir "{1}"'.format(path, basedir))
-            continue
+        if index < len(shared):
+            _CACHE.store_layers(_layers_key(cfg, shared, index + 1), stack)
     return stack
 
 
+def _shared_layers(basedir, paths, minion_id):
+    '''
+    Return the signature and parsed content of the leading stack files that
+    are neither templates nor specific to the minion
+    '''
+    layers = []
+    for path in paths:
+        if minion_id in path:
+            break
+        try:
+            static = _CACHE.static_file(basedir, path)
+        except TemplateNotFound:
+            static = ((basedir, path, None), _MISSING)
+        if static is None:
+            break
+        layers.append(static)
+    return layers
+
+
+def _layers_key(cfg, layers, count):
+    '''
+    Return the key of the stack merged from the first count layers
+    '''
+    return (cfg,) + tuple(signature for signature, _ in layers[:count])
+
+
 def _cleanup(obj):
     if obj:
         if isinstance(obj, dict):
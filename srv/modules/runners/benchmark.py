@@ -4,12 +4,16 @@
 import salt.client
 import salt.config
 
-import ast
+import glob
 import logging
 import datetime
+import math
 import ipaddress
 import jinja2
+import json
+import multiprocessing.dummy
 import os
+import re
 import subprocess
 import sys
 import yaml
@@ -17,6 +21,13 @@ import yaml
 log = logging.getLogger(__name__)
 local_client = salt.client.LocalClient()
 
+BASELINE_HISTORY = '/var/cache/salt/master/benchmark/baseline.json'
+
+FIO_PERCENTILES = ['50.000000', '90.000000', '99.000000', '99.900000']
+FIO_DIRECTIONS = ['read', 'write', 'trim']
+# e.g. output_bw.1.log or output_clat.2.log.10.0.0.1 in client mode
+FIO_LOG = re.compile(r'_(bw|iops|lat|clat|slat)\.\d+\.log')
+
 
 class bcolors:
     HEADER = '\033[95m'
@@ -97,10 +108,10 @@ class Fio(object):
             client_jobs.extend(['--client={}'.format(client)])
             client_jobs.extend([jobfile])
 
-        output = subprocess.check_output(
+        subprocess.check_output(
             [self.cmd] + self.cmd_global_args + log_args + client_jobs)
 
-        return output
+        return summary(job_log_dir)
 
     def _parse_job(self, job_spec, job_name, job_log_dir, client):
         # parse yaml and get job spec
@@ -132,12 +143,188 @@ class Fio(object):
         write_lat_log={logdir}/output
         write_hist_log={logdir}/output
         write_iops_log={logdir}/output
+        log_avg_msec=1000
         '''.format(logdir=job_log_dir)
         job.update({'dir': self.work_dir, 'output_options': output_options,
                     'client': client})
         return job
 
 
+def _fio_jobs(output):
+    '''
+    return the per-job entries of a fio json output.  In client mode every
+    client reports its own jobs plus an 'All clients' entry, which is skipped
+    since the jobs are combined here.
+    '''
+    jobs = output.get('client_stats') or output.get('jobs') or []
+    return [job for job in jobs if job.get('jobname') != 'All clients']
+
+
+def _fio_clat(stats):
+    '''
+    return the completion latency of one direction of a job in usec
+    '''
+    if 'clat_ns' in stats:
+        return stats['clat_ns'], 1000.0
+    return stats.get('clat', {}), 1.0
+
+
+def _merge_percentiles(curves, pct):
+    '''
+    approximate the percentile pct of the mixture of several latency
+    distributions, each one given by its weight and fio percentile table
+    '''
+    total = float(sum(weight for weight, _ in curves))
+    if not total:
+        return 0.0
+    target = float(pct)
+    for value in sorted(set(v for _, table in curves for v in table.values())):
+        below = 0.0
+        for weight, table in curves:
+            reached = [float(p) for p, v in table.items() if v <= value]
+            below += weight * (max(reached) if reached else 0.0)
+        if below / total >= target:
+            return value
+    return max(v for _, table in curves for v in table.values())
+
+
+def _combine(jobs):
+    '''
+    combine the jobs of all clients into cluster wide iops, bandwidth (KiB/s)
+    and latency (usec) for each direction
+    '''
+    result = {}
+    for direction in FIO_DIRECTIONS:
+        active = [job[direction] for job in jobs
+                  if job.get(direction, {}).get('total_ios')]
+        if not active:
+            continue
+        ios = float(sum(stats['total_ios'] for stats in active))
+        curves = []
+        mean = 0.0
+        maximum = 0.0
+        for stats in active:
+            clat, scale = _fio_clat(stats)
+            mean += stats['total_ios'] * clat.get('mean', 0) / scale
+            maximum = max(maximum, clat.get('max', 0) / scale)
+            curves.append((stats['total_ios'],
+                           dict((p, v / scale) for p, v in
+                                clat.get('percentile', {}).items())))
+        result[direction] = {
+            'iops': sum(stats['iops'] for stats in active),
+            'bw': sum(stats['bw'] for stats in active),
+            'ios': int(ios),
+            'lat': {'mean': mean / ios, 'max': maximum}}
+        for pct in FIO_PERCENTILES:
+            if any(pct in table for _, table in curves):
+                result[direction]['lat']['p{}'.format(pct.rstrip('0').rstrip('.'))] = \
+                    _merge_percentiles(curves, pct)
+    return result
+
+
+def _timeseries(job_log_dir, scale=1000.0):
+    '''
+    read the bw, iops and latency logs of all clients and summarize them per
+    one second interval.  The bandwidth and iops samples of each client are
+    averaged per interval and then add up across clients, latencies are
+    averaged.  Latencies are converted to usec with scale.
+    '''
+    buckets = {}
+    for path in sorted(glob.glob('{}/*.log*'.format(job_log_dir))):
+        match = FIO_LOG.search(os.path.basename(path))
+        if not match:
+            continue
+        kind = match.group(1)
+        with open(path, 'r') as log_file:
+            for line in log_file:
+                fields = line.split(',')
+                try:
+                    msec, value, direction = [int(field) for field in fields[:3]]
+                except ValueError:
+                    continue
+                if direction >= len(FIO_DIRECTIONS):
+                    continue
+                key = (kind, FIO_DIRECTIONS[direction])
+                entry = buckets.setdefault(key, {}).setdefault(
+                    msec // 1000, {}).setdefault(path, [0, 0])
+                entry[0] += value if kind in ('bw', 'iops') else value / scale
+                entry[1] += 1
+
+    series = {}
+    for (kind, direction), seconds in buckets.items():
+        if kind in ('bw', 'iops'):
+            values = [sum(total / float(count) for total, count in clients.values())
+                      for clients in seconds.values()]
+        else:
+            values = [sum(total for total, _ in clients.values()) /
+                      float(sum(count for _, count in clients.values()))
+                      for clients in seconds.values()]
+        mean = sum(values) / float(len(values))
+        series.setdefault(direction, {})[kind] = {
+            'seconds': len(values), 'min': min(values), 'max': max(values),
+            'mean': mean,
+            'stddev': math.sqrt(sum((v - mean) ** 2 for v in values) / len(values))}
+    return series
+
+
+def summary(job_log_dir, **kwargs):
+    '''
+    summarize the fio output and logs of a benchmark run and store the result
+    as summary.json next to them
+    '''
+    with open('{}/output.json'.format(job_log_dir), 'r') as output_file:
+        output = json.load(output_file)
+    jobs = _fio_jobs(output)
+    nanoseconds = any('clat_ns' in job.get(direction, {})
+                      for job in jobs for direction in FIO_DIRECTIONS)
+    result = {'path': job_log_dir,
+              'clients': len(set(job.get('hostname') for job in jobs)),
+              'jobs': len(jobs),
+              'results': _combine(jobs),
+              'timeseries': _timeseries(job_log_dir,
+                                        1000.0 if nanoseconds else 1.0)}
+    with open('{}/summary.json'.format(job_log_dir), 'w') as summary_file:
+        json.dump(result, summary_file, indent=4, sort_keys=True)
+    return result
+
+
+def _load_summary(path):
+    if os.path.isfile('{}/summary.json'.format(path)):
+        with open('{}/summary.json'.format(path), 'r') as summary_file:
+            return json.load(summary_file)
+    return summary(path)
+
+
+def _delta(first, second):
+    if not first:
+        return None
+    return (second - first) / float(first) * 100
+
+
+def compare(first, second, **kwargs):
+    '''
+    compare two stored benchmark runs, given by their log directories, and
+    return the change of each metric in percent
+    '''
+    results = [_load_summary(path)['results'] for path in (first, second)]
+    deltas = {}
+    for direction in FIO_DIRECTIONS:
+        if direction not in results[0] or direction not in results[1]:
+            continue
+        before, after = results[0][direction], results[1][direction]
+        entry = {}
+        for metric in ('iops', 'bw'):
+            entry[metric] = {'before': before[metric], 'after': after[metric],
+                             'change': _delta(before[metric], after[metric])}
+        for metric in sorted(set(before['lat']) & set(after['lat'])):
+            entry['lat_' + metric] = {'before': before['lat'][metric],
+                                      'after': after['lat'][metric],
+                                      'change': _delta(before['lat'][metric],
+                                                       after['lat'][metric])}
+        deltas[direction] = entry
+    return deltas
+
+
 def __parse_and_set_dirs(kwargs):
     '''
     check kwargs for passed directory locations and return a dict with the
@@ -188,12 +375,21 @@ def help():
              'salt-run benchmark.cephfs work_dir=/path log_dir=/path job_dir=/path default_collection=simple.yml client_glob=target:\n\n'
              '    Run CephFS benchmarks\n'
              '\n\n'
-             'salt-run benchmark.baseline work_dir=/path log_dir=/path job_dir=/path default_collection=simple.yml client_glob=target:\n\n'
-             '    Run Baseline benchmarks\n'
+             'salt-run benchmark.baseline work_dir=/path log_dir=/path job_dir=/path default_collection=simple.yml client_glob=target:\n'
+             'salt-run benchmark.baseline concurrency=8 failure_domain=rack:\n'
+             'salt-run benchmark.baseline regression=15:\n\n'
+             '    Run Baseline benchmarks, never more than one OSD per failure domain at a time.\n'
+             '    With regression, report OSDs slower than their history by more than the given percentage\n'
              '\n\n'
              'salt-run benchmark.blockdev work_dir=/path log_dir=/path job_dir=/path default_collection=simple.yml client_glob=target:\n\n'
              '    Run local block device benchmarks (e.g. premapped kRBD or iSCSI)\n'
              '\n\n'
+             'salt-run benchmark.summary /path/to/job_log_dir:\n\n'
+             '    Summarize the fio output and logs of a run\n'
+             '\n\n'
+             'salt-run benchmark.compare /path/to/job_log_dir /path/to/other_job_log_dir:\n\n'
+             '    Show the change in percent of every metric between two runs\n'
+             '\n\n'
     )
     print usage
     return ""
@@ -219,7 +415,7 @@ def rbd(**kwargs):
               dir_options['job_dir'])
 
     for job_spec in default_collection['rbd']:
-        print(fio.run(job_spec))
+        __print_summary(job_spec, fio.run(job_spec))
 
     return True
 
@@ -245,15 +441,21 @@ def cephfs(**kwargs):
               dir_options['job_dir'])
 
     for job_spec in default_collection['fs']:
-        print(fio.run(job_spec))
+        __print_summary(job_spec, fio.run(job_spec))
 
     return True
 
 
-def baseline(margin=10, verbose=False, **kwargs):
+def baseline(margin=10, verbose=False, concurrency=8, failure_domain='host',
+             history=BASELINE_HISTORY, regression=None, **kwargs):
     '''
     trigger 'ceph tell osd.$n bench' on all $n OSDs and check the results for
     slow outliers
+
+    OSDs run concurrently in batches of at most concurrency OSDs, never two
+    from the same CRUSH failure domain.  Results are appended to the history
+    file.  With regression set to a percentage, OSDs whose throughput dropped
+    by more than that compared to their own history are reported.
     '''
     client_glob = kwargs.get('client_glob',
                              'I@roles:storage and I@cluster:ceph')
@@ -266,27 +468,48 @@ def baseline(margin=10, verbose=False, **kwargs):
     if not osd_list:
         raise Exception('No OSDs found for glob {}'.format(client_glob))
 
-    ids = [osd_id for (osd, osd_ids) in osd_list.items() for osd_id in osd_ids]
-
     # gotta get the master_minion...not pretty but works
     master_minion = local_client.cmd(
         'I@roles:master', 'pillar.get',
         ['master_minion'], expr_form='compound').items()[0][1]
 
-    sys.stdout.write('\nRunning osd benchmarks')
+    domains = dict((int(osd_id), minion) for (minion, osd_ids) in osd_list.items()
+                   for osd_id in osd_ids)
+    tree = local_client.cmd(master_minion, 'cmd.shell',
+                            ['ceph osd tree -f json'])
+    try:
+        tree_domains = _failure_domains(json.loads(tree[master_minion]), failure_domain)
+        # only the OSDs of client_glob are benchmarked
+        domains.update((osd_id, domain) for osd_id, domain in tree_domains.items()
+                       if osd_id in domains)
+    except (KeyError, ValueError) as error:
+        log.warning('osd tree unavailable, batching by minion: {}'.format(error))
+
+    batches = _batches(domains, int(concurrency))
+    sys.stdout.write('\nRunning osd benchmarks in {} batches'.format(len(batches)))
     sys.stdout.flush()
-    results = []
-    for id in ids:
-        sys.stdout.write('.')
-        sys.stdout.flush()
-        output = local_client.cmd(master_minion, 'cmd.shell',
-                                  ['ceph tell osd.{} bench'.format(id)])
-        results.append(output)
-
-    # minion output is a string, so must be parsed; ditch the key
-    parsed_results = [ast.literal_eval(r[master_minion]) for r in results]
-
-    perf_abs = [r['bytes_per_sec'] for r in parsed_results]
+    results = {}
+    pool = multiprocessing.dummy.Pool(int(concurrency))
+    try:
+        for batch in batches:
+            for osd_id, result in pool.imap_unordered(
+                    _bench, [(master_minion, osd_id) for osd_id in batch]):
+                sys.stdout.write('.')
+                sys.stdout.flush()
+                results[osd_id] = result
+    finally:
+        pool.close()
+
+    failed = sorted(osd_id for osd_id in results if results[osd_id] is None)
+    ids = sorted(osd_id for osd_id in results if results[osd_id] is not None)
+    if failed:
+        print('\n\n{}Benchmark failed on {}{}'.format(
+            bcolors.FAIL, ', '.join('osd.{}'.format(osd_id) for osd_id in failed),
+            bcolors.ENDC))
+    if not ids:
+        return False
+
+    perf_abs = [results[osd_id] for osd_id in ids]
 
     avg = reduce(lambda r1, r2: r1 + r2, perf_abs)/len(perf_abs)
 
@@ -300,9 +523,133 @@ def baseline(margin=10, verbose=False, **kwargs):
     else:
         __print_outliers(dev_percent, perf_abs, ids, margin)
 
+    previous = _read_history(history) if regression is not None else []
+    if history:
+        _append_history(history, dict((osd_id, results[osd_id]) for osd_id in ids))
+    if regression is not None:
+        regressions = _regressions(previous, results, float(regression))
+        __print_regressions(regressions, float(regression))
+        return not regressions
+
     return True
 
 
+def _failure_domains(tree, failure_domain='host'):
+    '''
+    map each OSD id of an 'osd tree' to the name of the bucket of type
+    failure_domain above it
+    '''
+    nodes = dict((node['id'], node) for node in tree.get('nodes', []))
+    domains = {}
+    stack = [(node['id'], None) for node in tree.get('nodes', [])
+             if node['type'] == 'root']
+    while stack:
+        node_id, domain = stack.pop()
+        node = nodes.get(node_id)
+        if node is None:
+            continue
+        if node['type'] == 'osd':
+            if domain is not None:
+                domains.setdefault(node_id, domain)
+            continue
+        if node['type'] == failure_domain:
+            domain = node['name']
+        stack.extend((child, domain) for child in node.get('children', []))
+    return domains
+
+
+def _batches(domains, concurrency):
+    '''
+    split the OSDs into batches of at most concurrency OSDs with at most one
+    OSD per failure domain.  The largest domains are drained first, which
+    keeps the number of batches at the minimum.
+    '''
+    groups = {}
+    for osd_id in sorted(domains):
+        groups.setdefault(domains[osd_id], []).append(osd_id)
+    batches = []
+    while groups:
+        order = sorted(groups, key=lambda domain: (-len(groups[domain]), domain))
+        batch = [groups[domain].pop(0) for domain in order[:max(concurrency, 1)]]
+        for domain in order:
+            if not groups[domain]:
+                del groups[domain]
+        batches.append(sorted(batch))
+    return batches
+
+
+def _bench(args):
+    '''
+    run 'ceph tell osd.$n bench' from the master minion, return the osd id
+    and its throughput in bytes per second or None
+    '''
+    master_minion, osd_id = args
+    # LocalClient is not thread safe, each bench uses its own
+    local = salt.client.LocalClient()
+    output = local.cmd(master_minion, 'cmd.shell',
+                       ['ceph tell osd.{} bench -f json'.format(osd_id)])
+    try:
+        return osd_id, json.loads(output[master_minion])['bytes_per_sec']
+    except (KeyError, TypeError, ValueError):
+        log.error('osd.{} bench failed: {}'.format(osd_id, output))
+        return osd_id, None
+
+
+def _read_history(path):
+    '''
+    return the entries of the baseline history file, oldest first
+    '''
+    entries = []
+    if not path or not os.path.exists(path):
+        return entries
+    with open(path, 'r') as history:
+        for line in history:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                log.warning('skipping corrupt history entry in {}'.format(path))
+                continue
+            entry['results'] = dict((int(osd_id), value)
+                                    for osd_id, value in entry['results'].items())
+            entries.append(entry)
+    return entries
+
+
+def _append_history(path, results):
+    '''
+    append the throughput of each OSD to the history file, one timestamped
+    json entry per line
+    '''
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'a') as history:
+        history.write(json.dumps({
+            'timestamp': datetime.datetime.now().strftime('%y-%m-%d_%H:%M:%S'),
+            'results': dict((str(osd_id), value) for osd_id, value in results.items())},
+            sort_keys=True) + '\n')
+
+
+def _regressions(entries, results, threshold, window=5):
+    '''
+    compare each OSD to the median of its last window history entries and
+    return the OSDs that dropped by more than threshold percent
+    '''
+    regressions = {}
+    for osd_id, current in results.items():
+        if current is None:
+            continue
+        previous = sorted(entry['results'][osd_id] for entry in entries[-window:]
+                          if entry['results'].get(osd_id))
+        if not previous:
+            continue
+        reference = previous[(len(previous) - 1) // 2]
+        change = (current - reference) / float(reference) * 100
+        if change < -threshold:
+            regressions[osd_id] = {'baseline': reference, 'current': current,
+                                   'change': change}
+    return regressions
+
+
 def blockdev(**kwargs):
     """
     Run block device benchmark job
@@ -324,7 +671,7 @@ def blockdev(**kwargs):
               dir_options['job_dir'])
 
     for job_spec in default_collection['blockdev']:
-        print(fio.run(job_spec))
+        __print_summary(job_spec, fio.run(job_spec))
 
     return True
 
@@ -356,6 +703,35 @@ def __print_outliers(dev_percent, perf_abs, ids, margin):
     print('\n')
 
 
+def __print_summary(job_spec, result):
+    print('{}{}{} on {} clients ({}){}'.format(
+        bcolors.BOLD, job_spec, bcolors.ENDC, result['clients'], result['path'],
+        bcolors.ENDC))
+    for direction in FIO_DIRECTIONS:
+        if direction not in result['results']:
+            continue
+        stats = result['results'][direction]
+        print('    {}: {:.0f} iops {}/s lat mean {:.0f}us {}'.format(
+            direction, stats['iops'], __human_size(stats['bw'] * 1024),
+            stats['lat']['mean'],
+            ' '.join('{} {:.0f}us'.format(key, stats['lat'][key])
+                     for key in sorted(stats['lat']) if key.startswith('p'))))
+    print('\n')
+
+
+def __print_regressions(regressions, threshold):
+    if not regressions:
+        print('{}No osd dropped more than {}% below its history{}'.format(
+            bcolors.OKGREEN, threshold, bcolors.ENDC))
+    for osd_id in sorted(regressions):
+        entry = regressions[osd_id]
+        print('{}osd.{} dropped {}{:2.2f}%{}{} ({}/s, was {}/s){}'.format(
+            bcolors.FAIL, osd_id, bcolors.BOLD, -entry['change'], bcolors.ENDC,
+            bcolors.FAIL, __human_size(entry['current']),
+            __human_size(entry['baseline']), bcolors.ENDC))
+    print('\n')
+
+
 def __print_osd_deviation(id, dev, perf_abs, color=bcolors.OKGREEN):
     print('{}osd.{} deviates {}{:2.2f}%{}{} from the average ({}/s){}'.format(
         color,
@@ -7,11 +7,19 @@
 The deepsea_minions variable is in /srv/pillar/ceph/deepsea_minions.sls.  For
 those sites with existing Salt minions that should not be storage hosts, this
 variable can be customized to any Salt target.
+
+Resolving the target refreshes the pillar of every minion, so the value is
+cached on the master until the pillar file or the accepted minion keys
+change.  The matching minions are not cached, since grains such as the
+default G@deepsea:* target and the responding minions change at any time.
+Pass refresh=True to resolve the target anyway.
 """
 
 import sys
 import os
+import json
 import logging
+import tempfile
 import salt.client
 
 log = logging.getLogger(__name__)
@@ -22,14 +30,71 @@ class DeepseaMinions(object):
     The deepsea_minions pillar variable constrains which minions to use.
     """
 
+    CACHE_FILE = '/var/cache/salt/master/deepsea_minions.json'
+    SOURCES = ['/srv/pillar/ceph/deepsea_minions.sls', '/etc/salt/pki/master/minions']
+
     def __init__(self, **kwargs):
         """
         Initialize client and variables
         """
         self.local = salt.client.LocalClient()
-        self.deepsea_minions = self._query()
+        self.cache_file = kwargs.get('cache_file', self.CACHE_FILE)
+        self.sources = kwargs.get('sources', self.SOURCES)
+        signature = self._signature()
+        cached = None if kwargs.get('refresh', False) else self._load(signature)
+        if cached:
+            self.deepsea_minions = cached
+        else:
+            self.deepsea_minions = self._query()
+            if self.deepsea_minions:
+                self._save(signature)
         self.matches = self._matches()
 
+    def _signature(self):
+        """
+        Returns the modification time and size of each source.  A new or
+        removed minion key changes the modification time of the key directory.
+        """
+        signature = []
+        for path in self.sources:
+            try:
+                stat = os.stat(path)
+                signature.append([path, stat.st_mtime, stat.st_size])
+            except OSError:
+                signature.append([path, None, None])
+        return signature
+
+    def _load(self, signature):
+        """
+        Returns the cached value if the sources are unchanged
+        """
+        try:
+            with open(self.cache_file, 'r') as cache:
+                content = json.load(cache)
+        except (IOError, OSError, ValueError):
+            return None
+        if content.get('signature') != signature:
+            log.debug("{} is stale".format(self.cache_file))
+            return None
+        return content.get('deepsea_minions')
+
+    def _save(self, signature):
+        """
+        Writes the cache atomically, other runners may read it concurrently
+        """
+        content = {'signature': signature,
+                   'deepsea_minions': self.deepsea_minions}
+        directory = os.path.dirname(self.cache_file)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            descriptor, tmp = tempfile.mkstemp(dir=directory, prefix='.deepsea_minions.')
+            with os.fdopen(descriptor, 'w') as cache:
+                json.dump(content, cache)
+            os.rename(tmp, self.cache_file)
+        except (IOError, OSError) as error:
+            log.warning("Cannot write {}: {}".format(self.cache_file, error))
+
     def _query(self):
         """
         Returns the value of deepsea_minions
@@ -65,7 +130,7 @@ class DeepseaMinions(object):
                                     ['id'],
                                     expr_form="compound")
             sys.stdout = _stdout
-            return result.keys()
+            return sorted(result.keys())
         return []
 
 
@@ -73,11 +138,14 @@ def help_():
     """
     Usage
     """
-    usage = ('salt-run deepsea_minions.show:\n\n'
+    usage = ('salt-run deepsea_minions.show [refresh=True]:\n\n'
              '    Displays deepsea_minions value\n'
              '\n\n'
-             'salt-run deepsea_minions.matches:\n\n'
+             'salt-run deepsea_minions.matches [refresh=True]:\n\n'
              '    Returns an array of matched minions\n'
+             '\n\n'
+             'The value is cached until deepsea_minions.sls or the accepted\n'
+             'minion keys change.  refresh=True resolves it again.\n'
              '\n\n')
     print usage
     return ""
@@ -87,7 +155,7 @@ def show(**kwargs):
     """
     Returns deepsea_minions value
     """
-    target = DeepseaMinions()
+    target = DeepseaMinions(refresh=kwargs.get('refresh', False))
     return target.deepsea_minions
 
 
@@ -95,7 +163,7 @@ def matches(**kwargs):
     """
     Returns array of matched minions
     """
-    target = DeepseaMinions()
+    target = DeepseaMinions(refresh=kwargs.get('refresh', False))
     return target.matches
 
 __func_alias__ = {
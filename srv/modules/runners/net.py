@@ -4,9 +4,8 @@
 Network utilities
 """
 
-import time
 import logging
-import operator
+import multiprocessing.dummy
 import re
 import salt.client
 
@@ -17,6 +16,10 @@ import deepsea_minions
 
 log = logging.getLogger(__name__)
 
+IPERF_PORT = 5200
+# iperf3 clients run for 10 seconds
+IPERF_TIMEOUT = 60
+
 
 def help_():
     """
@@ -34,11 +37,18 @@ def help_():
              'salt-run net.jumbo_ping:\n\n'
              '    Summarizes network connectivity between minion interfaces for jumbo packets\n'
              '\n\n'
+             'salt-run net.latency:\n'
+             'salt-run net.latency cluster=ceph count=50:\n\n'
+             '    Summarizes the latency distribution (p50, p99, max, jitter and loss)\n'
+             '    between minion interfaces\n'
+             '\n\n'
              'salt-run net.iperf:\n'
              'salt-run net.iperf ceph:\n'
              'salt-run net.iperf cluster=ceph:\n'
-             'salt-run net.iperf exclude=target:\n\n'
+             'salt-run net.iperf exclude=target:\n'
+             'salt-run net.iperf cluster=ceph output=full:\n\n'
              '    Summarizes bandwidth throughput between minion interfaces\n'
+             '    and reports links slower than half of the median\n'
              '\n\n')
     print usage
     return ""
@@ -55,11 +65,13 @@ def get_cpu_count(server):
     return cpu_core
 
 
-def iperf(cluster=None, exclude=None, output=None, **kwargs):
+def iperf(cluster=None, exclude=None, output=None, slow_ratio=0.5, **kwargs):
     """
-    iperf server created from the each minions and then clients are created
-    base on the server's cpu count and request that number of other minions
-    as client to hit the server and report the total bendwidth.
+    Measure the bandwidth between every pair of addresses.  iperf servers
+    are started on all minions at once.  The pairs are scheduled in rounds
+    where each address takes part in at most one test, and the tests of a
+    round run concurrently.  A link slower than slow_ratio times the median
+    of all links is reported as slow.
 
     CLI Example: (Before DeepSea with a cluster configuration)
     .. code-block:: bash
@@ -73,7 +85,7 @@ def iperf(cluster=None, exclude=None, output=None, **kwargs):
     .. code-block:: bash
         sudo salt-run net.iperf cluster=ceph
 
-    To get all host iperf result
+    To get the bandwidth matrix of all addresses
         sudo salt-run net.iperf cluster=ceph output=full
 
     """
@@ -81,7 +93,6 @@ def iperf(cluster=None, exclude=None, output=None, **kwargs):
     if exclude:
         exclude_string, exclude_iplist = _exclude_filter(exclude)
 
-    addresses = []
     local = salt.client.LocalClient()
     # Salt targets can use list or string
     # pylint: disable=redefined-variable-type
@@ -92,158 +103,181 @@ def iperf(cluster=None, exclude=None, output=None, **kwargs):
             search += " and not ( " + exclude_string + " )"
             log.debug("iperf: search {} ".format(search))
 
-        public_networks = local.cmd(search, 'pillar.item',
-                                    ['public_network'], expr_form="compound")
-        log.debug("iperf: public_network {} ".format(public_networks))
-        cluster_networks = local.cmd(search, 'pillar.item',
-                                     ['cluster_network'], expr_form="compound")
-        log.debug("iperf: cluster_network {} ".format(cluster_networks))
+        networks = local.cmd(search, 'pillar.item',
+                             ['public_network', 'cluster_network'], expr_form="compound")
+        log.debug("iperf: networks {} ".format(networks))
         total = local.cmd(search, 'grains.get', ['ipv4'], expr_form="compound")
         log.debug("iperf: total grains.get {} ".format(total))
-        public_addresses = []
-        cluster_addresses = []
+        public_addresses = {}
+        cluster_addresses = {}
         for host in sorted(total.iterkeys()):
-            if 'public_network' in public_networks[host]:
-                public_addresses.extend(
-                    _address(total[host],
-                             public_networks[host]['public_network']))
-            if 'cluster_network' in cluster_networks[host]:
-                cluster_addresses.extend(
-                    _address(total[host],
-                             cluster_networks[host]['cluster_network']))
-            log.debug("iperf: public_network {} ".format(public_addresses))
-            log.debug("iperf: cluster_network {} ".format(cluster_addresses))
-        result = {}
-        _create_server(public_addresses)
-        p_result = _create_client(public_addresses)
-        _create_server(cluster_addresses)
-        c_result = _create_client(cluster_addresses)
-        p_sort = _add_unit(sorted(p_result.items(),
-                                  key=operator.itemgetter(1), reverse=True))
-        c_sort = _add_unit(sorted(c_result.items(),
-                                  key=operator.itemgetter(1), reverse=True))
-
-        if output:
-            result.update({'Public Network': p_sort})
-            result.update({'Cluster Network': c_sort})
-            return result
-        else:
-            result.update({'Public Network':
-                           {"Slowest 2 hosts": p_sort[-2:],
-                            "Fastest 2 hosts": p_sort[:2]}})
-            result.update({'Cluster Network':
-                           {"Slowest 2 hosts": c_sort[-2:],
-                            "Fastest 2 hosts": c_sort[:2]}})
-            return result
+            if 'public_network' in networks.get(host, {}):
+                for address in _address(total[host], networks[host]['public_network']):
+                    public_addresses[address] = host
+            if 'cluster_network' in networks.get(host, {}):
+                for address in _address(total[host], networks[host]['cluster_network']):
+                    cluster_addresses[address] = host
+        log.debug("iperf: public_network {} ".format(public_addresses))
+        log.debug("iperf: cluster_network {} ".format(cluster_addresses))
+        return {'Public Network': _iperf_report(_iperf_matrix(public_addresses),
+                                                output, slow_ratio),
+                'Cluster Network': _iperf_report(_iperf_matrix(cluster_addresses),
+                                                 output, slow_ratio)}
     else:
         search = deepsea_minions.DeepseaMinions().deepsea_minions
         if exclude_string:
             search += " and not ( " + exclude_string + " )"
-            log.debug("ping: search {} ".format(search))
-        addresses = local.cmd(search, 'grains.get',
-                              ['ipv4'], expr_form="compound")
-        addresses = _flatten(addresses.values())
-        # Lazy loopback removal - use ipaddress when adding IPv6
-        try:
-            if addresses:
-                addresses.remove('127.0.0.1')
-            if exclude_iplist:
-                for ex_ip in exclude_iplist:
-                    log.debug("ping: removing {} ip ".format(ex_ip))
-                    addresses.remove(ex_ip)
-        except ValueError:
-            log.debug("ping: remove {} ip doesn't exist".format(ex_ip))
-        _create_server(addresses)
-        result = _create_client(addresses)
-        sort_result = _add_unit(sorted(result.items(),
-                                       key=operator.itemgetter(1),
-                                       reverse=True))
-        if output:
-            return sort_result
-        else:
-            return {"Slowest 2 hosts": sort_result[-2:],
-                    "Fastest 2 hosts": sort_result[:2]}
+            log.debug("iperf: search {} ".format(search))
+        total = local.cmd(search, 'grains.get', ['ipv4'], expr_form="compound")
+        excluded = set(exclude_iplist or [])
+        addresses = {}
+        for host in sorted(total.iterkeys()):
+            for address in total[host]:
+                # Lazy loopback removal - use ipaddress when adding IPv6
+                if address == '127.0.0.1' or address in excluded:
+                    continue
+                addresses[address] = host
+        return _iperf_report(_iperf_matrix(addresses), output, slow_ratio)
 
 
-def _add_unit(records):
+def _iperf_schedule(addresses):
     """
-    Add formatting
+    Return rounds of (client, server) pairs covering every ordered pair of
+    addresses of different minions, where an address appears at most once
+    per round.  Uses the circle method of round robin tournaments, each
+    pairing is played in both directions.
+
+    addresses is a dictionary of address to minion
     """
-    stuff = []
-    for host in enumerate(records):
-        log.debug("Host {} Speed {}".format(host[1][0], host[1][1]))
-        stuff.append([host[1][0], "{} Mbits/sec".format(host[1][1])])
-    return stuff
+    players = sorted(addresses)
+    if len(players) % 2:
+        players.append(None)
+    count = len(players)
+    rounds = []
+    for _ in range(count - 1):
+        pairs = [(players[idx], players[count - 1 - idx]) for idx in range(count // 2)]
+        pairs = [pair for pair in pairs
+                 if None not in pair and addresses[pair[0]] != addresses[pair[1]]]
+        if pairs:
+            rounds.append(pairs)
+            rounds.append([(server, client) for client, server in pairs])
+        players = [players[0], players[-1]] + players[1:-1]
+    return rounds
+
+
+def _iperf_ports(addresses):
+    """
+    Assign each address a port, distinct among the addresses of a minion,
+    so that a minion can serve tests on several interfaces at once
+    """
+    ports = {}
+    used = {}
+    for address in sorted(addresses):
+        minion = addresses[address]
+        ports[address] = IPERF_PORT + used.get(minion, 0)
+        used[minion] = used.get(minion, 0) + 1
+    return ports
 
 
-def _create_server(addresses):
+def _iperf_pair(args):
+    """
+    Run one iperf client and return the bandwidth in Mbits/sec or None
+    """
+    client, server, port = args
+    local = salt.client.LocalClient()
+    result = local.cmd("S@{}".format(client), 'multi.iperf', [server, 0, port],
+                       expr_form="compound", timeout=IPERF_TIMEOUT)
+    for msg in result.values():
+        if isinstance(msg, dict) and msg.get('succeeded'):
+            try:
+                return float(msg['filter'].split()[0])
+            except (KeyError, ValueError, IndexError):
+                log.warning("iperf: unexpected output {}".format(msg))
+        break
+    return None
+
+
+def _iperf_matrix(addresses):
     """
-    Start iperf server
+    Start the iperf servers of all minions in one call, run the scheduled
+    rounds and return the bandwidth matrix {client: {server: Mbits/sec}}.
+    Failed tests are None.
     """
-    start_service = []
+    matrix = dict((address, {}) for address in addresses)
+    if len(set(addresses.values())) < 2:
+        return matrix
+    ports = _iperf_ports(addresses)
+    minions = sorted(set(addresses.values()))
     local = salt.client.LocalClient()
-    log.debug("net.iperf._create_server: address list {} ".format(addresses))
-    for server in addresses:
-        cpu_core = get_cpu_count(server)
-        log.debug("net.iperf._create_server: server {} cpu count {} "
-                  .format(server, cpu_core))
-        for count in range(cpu_core):
-            log.debug("net.iperf._create_server: server {} count {} port {} "
-                      .format(server, count, 5200+count))
-            start_service.append(local.cmd("S@{}".format(server),
-                                           'multi.iperf_server_cmd',
-                                           [count, 5200+count], expr_form="compound"))
+    started = local.cmd(minions, 'multi.iperf_servers', sorted(set(ports.values())),
+                        expr_form="list")
+    ready = set()
+    for minion, result in started.items():
+        if isinstance(result, dict):
+            ready.update((minion, port) for port in result.get('ready', []))
+            if result.get('missing'):
+                log.warning("iperf: {} servers not listening on {}".format(
+                    minion, result['missing']))
+
+    rounds = _iperf_schedule(addresses)
+    pool = multiprocessing.dummy.Pool(max(len(pairs) for pairs in rounds))
+    try:
+        for pairs in rounds:
+            runnable = [(client, server, ports[server]) for client, server in pairs
+                        if (addresses[server], ports[server]) in ready]
+            for (client, server, _), rate in zip(runnable, pool.map(_iperf_pair, runnable)):
+                matrix[client][server] = rate
+            for client, server in pairs:
+                matrix[client].setdefault(server, None)
+    finally:
+        pool.close()
+        local.cmd(minions, 'multi.kill_iperf_cmd', [], expr_form="list")
+    return matrix
+
+
+def _iperf_report(matrix, output=None, slow_ratio=0.5):
+    """
+    Summarize the matrix by the average bandwidth received by each address
+    and list slow and failed links.  With output, include the matrix.
+    """
+    rates = sorted(rate for row in matrix.values() for rate in row.values()
+                   if rate is not None)
+    median = rates[len(rates) // 2] if rates else 0
+    slow = []
+    failed = []
+    received = {}
+    for client in sorted(matrix):
+        for server in sorted(matrix[client]):
+            rate = matrix[client][server]
+            if rate is None:
+                failed.append("{} -> {}".format(client, server))
+                continue
+            received.setdefault(server, []).append(rate)
+            if rate < slow_ratio * median:
+                slow.append("{} -> {} {} Mbits/sec".format(client, server, int(rate)))
+    averages = dict((server, int(sum(values) / len(values)))
+                    for server, values in received.items())
+    hosts = _add_unit(sorted(averages.items(), key=lambda item: (-item[1], item[0])))
+
+    report = {"Slowest 2 hosts": hosts[-2:],
+              "Fastest 2 hosts": hosts[:2],
+              "Slow links": slow,
+              "Failed links": failed}
+    if output:
+        report['Hosts'] = hosts
+        report['Matrix'] = matrix
+    return report
 
 
-def _create_client(addresses):
+def _add_unit(records):
     """
-    Start iperf client
+    Add formatting
     """
-    results = []
-    jid = []
-    local = salt.client.LocalClient()
-    for server in addresses:
-        cpu_core = get_cpu_count(server)
-        log.debug("net.iperf._create_client: server {} cpu count {} "
-                  .format(server, cpu_core))
-        clients = list(addresses)
-        clients.remove(server)
-        clients_size = len(clients)
-        # pylint: disable=invalid-name
-        for x in xrange(0, cpu_core, clients_size):
-            # pylint: disable=invalid-name
-            for y, client in enumerate(clients):
-                log.debug("net.iperf._create_client:")
-                log.debug("server port:{}, x:{} client:{} to server:{}"
-                          .format(5200+x+y, x/clients_size, client, server))
-                if x+y < cpu_core:
-                    jid.append(
-                        local.cmd_async(
-                            "S@"+client,
-                            'multi.iperf',
-                            [server, x/clients_size, 5200+x+y],
-                            expr_form="compound"))
-                    log.debug("net.iperf._create_client:")
-                    log.debug("calling from client:{} ".format(client))
-                    log.debug("to server:{} ".format(server))
-                    log.debug("cpu:{} port:{}".format(x/clients_size, 5200+x+y))
-        log.debug("net.iperf._create_client:")
-        log.debug("Server {} iperf client count {}".format(server, len(jid)))
-        time.sleep(8)
-
-    log.debug("iperf: All Async iperf client count {}".format(len(jid)))
-    not_done = True
-    while not_done:
-        not_done = False
-        for job in jid:
-            if not __salt__['jobs.lookup_jid'](job):
-                log.debug("iperf: job not done {} ".format(job))
-                time.sleep(1)
-                not_done = True
-    results = []
-    for job in jid:
-        results.append(__salt__['jobs.lookup_jid'](job))
-    return _summarize_iperf(results)
+    stuff = []
+    for host in enumerate(records):
+        log.debug("Host {} Speed {}".format(host[1][0], host[1][1]))
+        stuff.append([host[1][0], "{} Mbits/sec".format(host[1][1])])
+    return stuff
 
 
 def jumbo_ping(cluster=None, exclude=None, **kwargs):
@@ -253,7 +287,15 @@ def jumbo_ping(cluster=None, exclude=None, **kwargs):
     ping(cluster, exclude, ping_type="jumbo")
 
 
-def ping(cluster=None, exclude=None, ping_type=None, **kwargs):
+def latency(cluster=None, exclude=None, count=20, **kwargs):
+    """
+    Send count probes to every address from every minion and summarize the
+    latency distribution of each link
+    """
+    ping(cluster, exclude, ping_type="latency", count=count)
+
+
+def ping(cluster=None, exclude=None, ping_type=None, count=20, **kwargs):
     """
     Ping all addresses from all addresses on all minions.  If cluster is passed,
     restrict addresses to public and cluster networks.
@@ -352,6 +394,10 @@ def ping(cluster=None, exclude=None, ping_type=None, **kwargs):
     if ping_type is "jumbo":
         results = local.cmd(search, 'multi.jumbo_ping',
                             addresses, expr_form="compound")
+    elif ping_type == "latency":
+        results = local.cmd(search, 'multi.ping_stats',
+                            addresses + ["count={}".format(count)],
+                            expr_form="compound")
     else:
         results = local.cmd(search, 'multi.ping',
                             addresses, expr_form="compound")
@@ -479,6 +525,31 @@ def _summarize(total, results):
         print "Failed: \n    {}".format("\n    ".join(failed))
     if errored:
         print "Errored: \n    {}".format("\n    ".join(errored))
+    _summarize_latency(results)
+
+
+def _summarize_latency(results):
+    """
+    Summarize the latency distributions returned by multi.ping_stats
+    """
+    latencies = dict((host, results[host]['latency']) for host in results
+                     if isinstance(results[host], dict) and 'latency' in results[host])
+    if not latencies:
+        return
+    p50s = sorted(latencies[host]['p50'] for host in latencies)
+    print ("Latency: p50 {0:.2f} ms p99 {1:.2f} ms max {2:.2f} ms "
+           "jitter {3:.2f} ms loss {4:.1f}%".format(
+               p50s[(len(p50s) - 1) // 2],
+               max(latencies[host]['p99'] for host in latencies),
+               max(latencies[host]['max'] for host in latencies),
+               max(latencies[host]['jitter'] for host in latencies),
+               sum(latencies[host]['loss'] for host in latencies) / len(latencies)))
+    worst = sorted(((p99, address, host) for host in latencies
+                    for address, p99 in results[host].get('worst', [])),
+                   key=lambda link: (-link[0], link[1], link[2]))[:5]
+    if worst:
+        print "Highest p99: \n    {}".format("\n    ".join(
+            "{} from {} {:.2f} ms".format(address, host, p99) for p99, address, host in worst))
 
 
 def _iperf_result_get_server(result):
@@ -488,46 +559,6 @@ def _iperf_result_get_server(result):
     return result['server']
 
 
-def _summarize_iperf(results):
-    """
-    iperf summarize the successes, failures and errors across all minions
-    """
-    server_results = {}
-    log.debug("Results {} ".format(results))
-    for result in results:
-        for host in result:
-            log.debug("Server {}".format(result[host]['server']))
-            if not result[host]['server'] in server_results:
-                server_results.update({result[host]['server']: ""})
-            if result[host]['succeeded']:
-                # print "filter:\n{}".format(result[host]['filter'])
-                server_results[result[host]['server']] +=\
-                        " " + result[host]['filter']
-                log.debug("Speed {}".
-                          format(server_results[result[host]['server']]))
-            elif result[host]['failed']:
-                # print "failed:\n{}".format(result[host]['failed'])
-                server_results[result[host]['server']] +=\
-                        " Failed to connect from {}".format(host)
-            elif result[host]['errored']:
-                # print "errored :\n{}".format(result[host]['errored'])
-                server_results[result[host]['server']] +=\
-                        " {} iperf error check installation.".format(host)
-
-    for key, result in server_results.iteritems():
-        total = 0
-        speed = result.split('Mbits/sec')
-        speed = filter(None, speed)
-        try:
-            for value in speed:
-                total += float(value.strip())
-            # server_results[key] = str(total) + " Mbits/sec"
-            server_results[key] = int(total)
-        except ValueError:
-            continue
-    return server_results
-
-
 def _skip_dunder(settings):
     """
     Skip double underscore keys
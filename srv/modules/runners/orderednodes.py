@@ -5,9 +5,18 @@
 Utilities that return preferred orders of minions
 """
 
+import json
+import logging
 import sys
 import os
 import salt.client
+# pylint: disable=relative-import
+import restart
+
+log = logging.getLogger(__name__)
+
+# Upgrade tiers, the gateways follow the storage
+ROLES = ['mon', 'mgr', 'storage', 'mds', 'rgw', 'igw', 'ganesha']
 
 
 def help_():
@@ -18,6 +27,11 @@ def help_():
              'salt-run orderednodes.unique ceph:\n'
              'salt-run orderednodes.unique cluster=ceph:\n\n'
              '    Returns an array of sorted minions according to role\n'
+             '\n\n'
+             'salt-run orderednodes.batches:\n'
+             'salt-run orderednodes.batches cluster=ceph failure_domain=rack max_batch=4:\n\n'
+             '    Returns an array of batches of minions that can be upgraded\n'
+             '    simultaneously, ordered according to role\n'
              '\n\n')
     print usage
     return ""
@@ -36,38 +50,137 @@ def _preserve_order_sorted(seq):
     return [x for x in seq if x not in seen and not seen.add(x)]
 
 
+def _roles(client, cluster, functions=None):
+    """
+    Return the roles of all minions of the cluster with a single call.  The
+    results of additional functions are included as well.
+    """
+    functions = functions or {}
+    names = ['pillar.get'] + sorted(functions)
+    # When search matches no minions, salt prints to stdout.  Suppress stdout.
+    _stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    results = client.cmd("I@cluster:{}".format(cluster), names,
+                         [['roles']] + [functions[name] for name in names[1:]],
+                         expr_form="compound")
+    sys.stdout = _stdout
+    return dict((minion, results[minion]) for minion in results
+                if isinstance(results[minion], dict))
+
+
 # pylint: disable=dangerous-default-value
 def unique(cluster='ceph', exclude=[]):
     """
     Assembling a list of nodes.
     Ordered(MON, MGR, OSD, MDS, RGW, IGW)
     """
-    all_clients = []
-
     client = salt.client.LocalClient(__opts__['conf_file'])
 
-    cluster_assignment = "I@cluster:{}".format(cluster)
-    roles = ['mon', 'mgr', 'storage', 'mds', 'rgw', 'igw', 'ganesha']
     # Adding an exclude param here to allow skipping of individual
     # roles.
     # Usecase: If an admin wants to have manual control over the upgrade
     # process in missioncritical connections like iscsi where one needs
     # to be sure that the MPIO successfully failed over before
     # rebooting/starting the service.
+    roles = [role for role in ROLES if role not in exclude]
+    assigned = _roles(client, cluster)
 
-    # When search matches no minions, salt prints to stdout.  Suppress stdout.
-    _stdout = sys.stdout
-    sys.stdout = open(os.devnull, 'w')
-
-    roles = [role for role in roles if role not in exclude]
+    all_clients = []
     for role in roles:
-        nodes = client.cmd("I@roles:{} and {}".format(role, cluster_assignment),
-                           'pillar.get', ['roles'], expr_form="compound")
-        all_clients += nodes.keys()
-
-    sys.stdout = _stdout
+        all_clients += sorted(minion for minion in assigned
+                              if role in (assigned[minion]['pillar.get'] or []))
     return _preserve_order_sorted(all_clients)
 
+
+def _limit(role, count):
+    """
+    Return how many minions of a role may be down at the same time.  The
+    monitors keep a quorum, the other roles keep half of their instances.
+    """
+    if role == 'mon':
+        return max(1, (count - 1) // 2)
+    return max(1, count // 2)
+
+
+def _batches(roles, domains=None, exclude=[], max_batch=0):
+    """
+    Order the minions by role tier and split each tier into batches.  A
+    minion belongs to the tier of its first role in ROLES that is not
+    excluded, and is skipped only when all its roles are.  Within a batch
+    no role loses more than its limit and all storage minions share a
+    failure domain, so data stays available.
+
+    roles maps the minions to their roles, domains maps the storage minions
+    to their failure domain
+    """
+    domains = domains or {}
+    counts = {}
+    for minion in roles:
+        for role in roles[minion]:
+            counts[role] = counts.get(role, 0) + 1
+
+    tiers = dict((role, []) for role in ROLES)
+    for minion in sorted(roles):
+        tier = next((role for role in ROLES
+                     if role in roles[minion] and role not in exclude), None)
+        if tier:
+            tiers[tier].append(minion)
+
+    ordered = []
+    for tier in ROLES:
+        batches = []
+        for minion in tiers[tier]:
+            domain = domains.get(minion, minion) if 'storage' in roles[minion] else None
+            for batch in batches:
+                if max_batch and len(batch['minions']) >= int(max_batch):
+                    continue
+                if domain is not None and batch['domain'] not in (None, domain):
+                    continue
+                if any(batch['roles'].get(role, 0) >= _limit(role, counts[role])
+                       for role in roles[minion] if role != 'storage'):
+                    continue
+                break
+            else:
+                batch = {'minions': [], 'roles': {}, 'domain': None}
+                batches.append(batch)
+            batch['minions'].append(minion)
+            if domain is not None:
+                batch['domain'] = domain
+            for role in roles[minion]:
+                batch['roles'][role] = batch['roles'].get(role, 0) + 1
+        ordered.extend(batch['minions'] for batch in batches)
+    return ordered
+
+
+# pylint: disable=dangerous-default-value
+def batches(cluster='ceph', exclude=[], failure_domain='host', max_batch=0):
+    """
+    Assembling batches of nodes that can be upgraded simultaneously.
+    Ordered(MON, MGR, OSD, MDS, RGW, IGW, GANESHA)
+    """
+    client = salt.client.LocalClient(__opts__['conf_file'])
+    assigned = _roles(client, cluster, {'grains.get': ['host']})
+    roles = dict((minion, [role for role in (assigned[minion]['pillar.get'] or [])
+                           if role in ROLES])
+                 for minion in assigned)
+
+    domains = {}
+    master = client.cmd('I@roles:master', 'pillar.get', ['master_minion'],
+                        expr_form="compound").values()
+    if master:
+        output = client.cmd(master[0], 'cmd.run', ['ceph osd tree -f json'])
+        try:
+            hosts = restart._host_domains(json.loads(output[master[0]]), failure_domain)
+        except (KeyError, ValueError) as error:
+            log.warning("osd tree unavailable, one storage minion per batch: {}".
+                        format(error))
+            hosts = {}
+        domains = dict((minion, hosts[assigned[minion]['grains.get']])
+                       for minion in assigned
+                       if assigned[minion].get('grains.get') in hosts)
+    return _batches(roles, domains, exclude, max_batch)
+
+
 __func_alias__ = {
                  'help_': 'help',
                  }
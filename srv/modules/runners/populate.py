@@ -47,7 +47,6 @@ import ipaddress
 import logging
 # pylint: disable=relative-import
 import deepsea_minions
-import operator
 
 import sys
 
@@ -123,6 +122,7 @@ class CephStorage(object):
 
         self.root_dir = settings.root_dir
         # self.keyring = Utils.secret()
+        self.directories = set()
 
     def save(self, servers, _proposals):
         """
@@ -144,8 +144,7 @@ class CephStorage(object):
         Save the storage data structure for each server
         """
         model_dir = "{}/{}/stack/default/{}/minions".format(self.root_dir, name, self.cluster)
-        if not os.path.isdir(model_dir):
-            _create_dirs(model_dir, self.root_dir)
+        self._create_dir(model_dir)
         filename = model_dir + "/" +  server + ".yml"
         contents = {'storage': storage}
         self.writer.write(filename, contents)
@@ -155,14 +154,23 @@ class CephStorage(object):
         Save the storage role for each server
         """
         cluster_dir = "{}/{}/cluster".format(self.root_dir, name)
-        if not os.path.isdir(cluster_dir):
-            _create_dirs(cluster_dir, self.root_dir)
+        self._create_dir(cluster_dir)
         # filename = cluster_dir + "/" +  server.split('.')[0] + ".sls"
         filename = cluster_dir + "/" +  server + ".sls"
         contents = {}
         contents['roles'] = ['storage']
         self.writer.write(filename, contents)
 
+    def _create_dir(self, path):
+        """
+        Create a profile directory once, since hosts of the same hardware
+        profile share it
+        """
+        if path not in self.directories:
+            if not os.path.isdir(path):
+                _create_dirs(path, self.root_dir)
+            self.directories.add(path)
+
 
 class HardwareProfile(object):
     """
@@ -177,18 +185,26 @@ class HardwareProfile(object):
         self.servers = {}
         self.rotates = {}
         self.nvme = {}
+        self.fingerprints = {}
+        self.hosts = {}
+        self.labels = {}
+        self.names = {}
 
     def add(self, hostname, drives):
         """
-        Add a profile by label
+        Add a profile by label.  Hosts with the same fingerprint share the
+        profile name.
         """
         self.model = {}
         for drive in drives:
             if 'Vendor' in drive:
-                label = self._label(drive['Vendor'], drive['Capacity'])
+                key = (drive['Vendor'], drive['Capacity'])
             else:
                 # Virtual machines do not have vendors
-                label = self._label(drive['Model'], drive['Capacity'])
+                key = (drive['Model'], drive['Capacity'])
+            if key not in self.labels:
+                self.labels[key] = self._label(*key)
+            label = self.labels[key]
 
             if label not in self.rotates:
                 self.rotates[label] = drive['rotational']
@@ -200,8 +216,23 @@ class HardwareProfile(object):
                 self.model[label].append(self._device(drive))
             else:
                 self.model[label] = [self._device(drive)]
-        name = self._name()
-        self._profiles(name, hostname)
+
+        fingerprint = self.fingerprint(self.model)
+        if fingerprint not in self.names:
+            self.names[fingerprint] = self._name()
+        if hostname in self.hosts:
+            self.fingerprints[self.hosts[hostname]].remove(hostname)
+        self.hosts[hostname] = fingerprint
+        self.fingerprints.setdefault(fingerprint, []).append(hostname)
+        self._profiles(self.names[fingerprint], hostname)
+
+    @staticmethod
+    def fingerprint(model):
+        """
+        Canonical description of a model: the quantity of drives of each
+        label.  The rotational and nvme flags are tracked per label.
+        """
+        return tuple(sorted((label, len(devices)) for label, devices in model.items()))
 
     def _device(self, drive):
         """
@@ -310,29 +341,63 @@ class DiskConfiguration(object):
         for server in self.storage_nodes:
             self.hardware.add(server, self.storage_nodes[server])
 
+        # Proposals only depend on the quantity of each drive type.  Compute
+        # them for the first host of a fingerprint and map the devices of
+        # the other hosts by position.  The time saved is the measured time
+        # of computing a fingerprint, for each host that reused it, less the
+        # measured time of mapping the devices.
+        templates = {}
+        computing = {}
+        saved = 0.0
+        start = time.time()
         for server in self.hardware.profiles:
             if server not in self.proposals:
                 self.proposals[server] = {}
             for configuration in self.hardware.profiles[server]:
-                if configuration not in self.proposals[server]:
-                    self.proposals[server][configuration] = []
-
                 drives = self.hardware.profiles[server][configuration]
-
-                log.debug("configuration {} with no journals".format(configuration))
-                self.proposals[server][configuration].append(self._assignments(drives))
-                for drive_model in drives:
-                    # How many types of drives are SSDs, NVMes
-                    if self.hardware.rotates[drive_model] == '0':
-                        log.debug(("configuration {} with {} "
-                                   "journal".format(configuration, drive_model)))
-                        proposal = self._assignments(drives, drive_model)
-                        if proposal:
-                            self.proposals[server][configuration].append(proposal)
-                        else:
-                            log.warning(("No proposal for {} as journal on "
-                                         "{}".format(drive_model,
-                                                     configuration)))
+                fingerprint = self.hardware.fingerprint(drives)
+                started = time.time()
+                if fingerprint not in templates:
+                    templates[fingerprint] = (drives, self._proposals(configuration, drives))
+                    computing[fingerprint] = time.time() - started
+                    self.proposals[server][configuration] = templates[fingerprint][1]
+                    continue
+
+                template, proposals = templates[fingerprint]
+                mapping = {}
+                for label in drives:
+                    mapping.update(zip(template[label], drives[label]))
+                self.proposals[server][configuration] = [_translate(proposal, mapping)
+                                                         for proposal in proposals]
+                saved += computing[fingerprint] - (time.time() - started)
+
+        self.summary = {'hosts': len(self.proposals),
+                        'fingerprints': len(templates),
+                        'seconds': time.time() - start,
+                        'saved': max(saved, 0.0)}
+        log.info("{hosts} hosts, {fingerprints} hardware fingerprints, "
+                 "{seconds:.3f}s, {saved:.3f}s saved".format(**self.summary))
+
+    def _proposals(self, configuration, drives):
+        """
+        Return the proposal without journals followed by a proposal for each
+        solid state drive type as journal
+        """
+        log.debug("configuration {} with no journals".format(configuration))
+        proposals = [self._assignments(drives)]
+        for drive_model in drives:
+            # How many types of drives are SSDs, NVMes
+            if self.hardware.rotates[drive_model] == '0':
+                log.debug(("configuration {} with {} "
+                           "journal".format(configuration, drive_model)))
+                proposal = self._assignments(drives, drive_model)
+                if proposal:
+                    proposals.append(proposal)
+                else:
+                    log.warning(("No proposal for {} as journal on "
+                                 "{}".format(drive_model,
+                                             configuration)))
+        return proposals
 
     def _log_results(self, label, results):
         """
@@ -464,6 +529,19 @@ class DiskConfiguration(object):
         return assignments
 
 
+def _translate(proposal, mapping):
+    """
+    Replace the devices of a proposal computed for another host with the same
+    hardware fingerprint
+    """
+    if not proposal:
+        return {}
+    return {'osds': [mapping[device] for device in proposal['osds']],
+            'data+journals': [dict((mapping[data], "{}".format(mapping[journal]))
+                                   for data, journal in entry.items())
+                              for entry in proposal['data+journals']]}
+
+
 class CephRoles(object):
     """
     Create reasonable proposals from the existing hardware
@@ -481,8 +559,10 @@ class CephRoles(object):
         target = deepsea_minions.DeepseaMinions()
         self.search = target.deepsea_minions
 
+        self._discover()
         self.networks = self._networks(self.servers)
         self.public_networks, self.cluster_networks = self.public_cluster(self.networks.copy())
+        self.public_addresses = None
 
         self.available_roles = ['storage']
 
@@ -616,12 +696,15 @@ class CephRoles(object):
         """
         Find the public interface for a server
         """
-        for public_network in self.public_networks:
-            public_net = ipaddress.ip_network(u'{}'.format(public_network))
-            for entry in self.networks[public_net]:
-                if entry[0] == server:
-                    log.debug("Public interface for {}: {}".format(server, entry[2]))
-                    return entry[2]
+        if self.public_addresses is None:
+            self.public_addresses = {}
+            for public_network in self.public_networks:
+                for entry in self.networks[public_network]:
+                    self.public_addresses.setdefault(entry[0], entry[2])
+        if server in self.public_addresses:
+            log.debug("Public interface for {}: {}".format(server,
+                                                           self.public_addresses[server]))
+            return self.public_addresses[server]
         return ""
 
     def cluster_config(self):
@@ -645,6 +728,33 @@ class CephRoles(object):
 
             self.writer.write(filename, contents)
 
+    def _discover(self):
+        """
+        Query the interfaces, the addresses of the hostname, the ipv4 grain
+        and the master_minion of all minions in a single broadcast
+        """
+        local = salt.client.LocalClient()
+        functions = ['network.interfaces', 'cmd.run', 'grains.get', 'pillar.get']
+        args = [[], ['hostname -i'], ['ipv4'], ['master_minion']]
+        results = local.cmd(self.search, functions, args, expr_form="compound")
+
+        self.interfaces = {}
+        self.hostname_addrs = {}
+        self.ipv4 = {}
+        self.master_minion = None
+        for minion, result in results.items():
+            if not isinstance(result, dict):
+                log.warning("Network discovery failed on {}: {}".format(minion, result))
+                continue
+            if isinstance(result.get('network.interfaces'), dict):
+                self.interfaces[minion] = result['network.interfaces']
+            if 'cmd.run' in result:
+                self.hostname_addrs[minion] = result['cmd.run']
+            if isinstance(result.get('grains.get'), list):
+                self.ipv4[minion] = result['grains.get']
+            if not self.master_minion and result.get('pillar.get'):
+                self.master_minion = result['pillar.get']
+
     def _networks(self, minions):
         """
         Create a dictionary of networks with tuples of minion name, network
@@ -653,9 +763,7 @@ class CephRoles(object):
         """
 
         networks = {}
-        local = salt.client.LocalClient()
-
-        interfaces = local.cmd(self.search, 'network.interfaces', [], expr_form="compound")
+        interfaces = self.interfaces
 
         for minion in interfaces:
             for nic in interfaces[minion]:
@@ -700,38 +808,38 @@ class CephRoles(object):
 
         priorities = sorted(priorities, cmp=network_sort)
 
+        index = NetworkIndex(networks)
+
         # first step, find public networks using hostname -i in all minions
-        public_addrs = []
-        local = salt.client.LocalClient()
-        cmd_result = local.cmd(self.search, 'cmd.run', ['hostname -i'], expr_form="compound")
-        for _, addrs in cmd_result.items():
-            addr_list = addrs.split(' ')
-            public_addrs.extend([ipaddress.ip_address(u'{}'.format(addr))
-                                 for addr in addr_list if not addr.startswith('127.')])
+        found = set()
+        for _, addrs in self.hostname_addrs.items():
+            for addr in addrs.split(' '):
+                if addr and not addr.startswith('127.'):
+                    found.update(index.containing(addr))
         for _, network in priorities:
-            if reduce(operator.__or__, [addr in network for addr in public_addrs], False):
+            if network in found:
                 public_networks.append(network)
         for network in public_networks:
             networks.pop(network)
 
         # second step, find cluster network by checking which network salt-master does not belong
-        master_addrs = []
-        master_minion = None
-        cmd_result = local.cmd(self.search, 'pillar.get', ['master_minion'], expr_form="compound")
-        for _, value in cmd_result.items():
-            master_minion = value
-            break
-        if not master_minion:
+        if not self.master_minion:
             raise Exception("No master_minion found in pillar")
-        cmd_result = local.cmd(master_minion, 'grains.get', ['ipv4'], expr_form="compound")
-        for _, addr_list in cmd_result.items():
-            master_addrs.extend([ipaddress.ip_address(u'{}'.format(addr))
-                                for addr in addr_list if not addr.startswith('127.')])
+        if self.master_minion in self.ipv4:
+            master_addrs = self.ipv4[self.master_minion]
+        else:
+            local = salt.client.LocalClient()
+            cmd_result = local.cmd(self.master_minion, 'grains.get', ['ipv4'],
+                                   expr_form="compound")
+            master_addrs = [addr for addr_list in cmd_result.values() for addr in addr_list]
+        found = set()
+        for addr in master_addrs:
+            if not addr.startswith('127.'):
+                found.update(index.containing(addr))
         for _, network in priorities:
             if network not in networks:
                 continue
-            if reduce(operator.__and__, [addr not in network for addr in master_addrs], True) and \
-               len(networks[network]) > 1:
+            if network not in found and len(networks[network]) > 1:
                 cluster_networks.append(network)
         for network in cluster_networks:
             networks.pop(network)
@@ -752,20 +860,17 @@ class CephRoles(object):
                     cluster_networks.append(network)
 
         # fourth step, remove redudant public networks
+        members = {}
+        for minion, addr_list in self.ipv4.items():
+            for addr in addr_list:
+                for network in index.containing(addr):
+                    members.setdefault(network, set()).add(minion)
+        remaining = set(self.ipv4)
         filtered_list = []
-        cmd_result = local.cmd(self.search, 'grains.get', ['ipv4'], expr_form="compound")
         for network in public_networks:
-            to_remove = []
-            for key, addr_list in cmd_result.items():
-                if reduce(operator.__or__,
-                          [ipaddress.ip_address(u'{}'.format(addr)) in network
-                           for addr in addr_list],
-                          False):
-                    to_remove.append(key)
-            for key in to_remove:
-                cmd_result.pop(key)
+            remaining.difference_update(members.get(network, ()))
             filtered_list.append(network)
-            if not cmd_result:
+            if not remaining:
                 break
         public_networks = filtered_list
 
@@ -775,6 +880,39 @@ class CephRoles(object):
         return public_networks, cluster_networks
 
 
+class NetworkIndex(object):
+    """
+    Find the networks containing an address with one lookup per prefix
+    length, like a routing table, instead of comparing each address with
+    every network
+    """
+
+    def __init__(self, networks):
+        """
+        Group the networks by version and prefix length, keyed by their
+        network address
+        """
+        self.tables = {}
+        for network in networks:
+            key = (network.version, network.max_prefixlen, network.prefixlen)
+            self.tables.setdefault(key, {})[int(network.network_address)] = network
+
+    def containing(self, address):
+        """
+        Return the networks containing the address
+        """
+        address = ipaddress.ip_address(u'{}'.format(address))
+        value = int(address)
+        networks = []
+        for (version, bits, prefixlen), table in self.tables.items():
+            if version != address.version:
+                continue
+            mask = ((1 << prefixlen) - 1) << (bits - prefixlen)
+            if value & mask in table:
+                networks.append(table[value & mask])
+        return networks
+
+
 def network_sort(a, b):
     """
     Sort quantity descending and network ascending.
@@ -900,6 +1038,9 @@ def show(**kwargs):
                         else:
                             sys.stdout.write(" " + v)
                 print
+        dc.generate(hardwareprofile)
+        print ("{hosts} storage nodes, {fingerprints} hardware fingerprints, proposals in "
+               "{seconds:.3f}s, {saved:.3f}s saved".format(**dc.summary))
 
 
 def help_():
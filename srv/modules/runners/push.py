@@ -42,17 +42,24 @@ Customization:
     desired values in /srv/pillar/ceph/stack directory tree and likely
     unnecessary.  This will still work and may prove useful for some.
 
-All files are overwritten in the destination tree /srv/pillar/ceph/stack/default.
+Files are written to the destination tree /srv/pillar/ceph/stack/default only
+when their merged content changed.  Files no longer named by the policy.cfg
+are removed.
 
 """
 
 import os
 import errno
+import fnmatch
 import glob
+import hashlib
+import json
 import logging
 import imp
 import re
 import shutil
+import tempfile
+import time
 import yaml
 
 CUR_FILE_PATH = os.path.dirname(os.path.realpath(__file__))
@@ -150,22 +157,39 @@ class PillarData(object):
         """
         Write the merged YAML files to the correct locations,
         /srv/pillar/ceph/cluster and /srv/pillar/ceph/stack/default.
-        """
 
-        self._clean()
+        The manifest records the sources, size and hash of each file written.
+        Files whose sources are unchanged are not merged again and files
+        whose merged content is unchanged are not rewritten.
+        """
+        manifest = self._load_manifest()
+        written = {}
+        changed = 0
 
-        for pathname in common.keys():
-            merged = _merge(pathname, common)
+        for pathname in sorted(common.keys()):
             filename = self.pillar_dir + "/" + pathname
-            self._default(filename, merged)
+            sources = _sources(common[pathname])
+            entry = manifest.get(pathname)
+            if not (entry and entry['sources'] == sources and
+                    os.path.isfile(filename) and
+                    os.path.getsize(filename) == entry['size']):
+                merged = _merge(pathname, common)
+                entry = self._default(filename, merged)
+                if entry['written']:
+                    changed += 1
+                entry = {'sources': sources,
+                         'size': entry['size'],
+                         'sha1': entry['sha1'],
+                         'cluster': merged.get('cluster')}
+            written[pathname] = entry
 
             if pathname.startswith("cluster"):
                 # Use the entire list of minions under cluster to populate
                 # stack/{cluster_name}/minions.  Skip unassigned.
-                if merged['cluster'] != "unassigned":
+                if entry['cluster'] != "unassigned":
                     newpath = re.sub(r'sls', 'yml', pathname)
                     relative = re.sub(r'cluster',
-                                      "stack/{}/minions".format(merged['cluster']), newpath)
+                                      "stack/{}/minions".format(entry['cluster']), newpath)
                     custom = (self.pillar_dir + "/" + relative)
                     self._custom(custom)
 
@@ -175,6 +199,11 @@ class PillarData(object):
                 custom = self.pillar_dir + "/" + default_path
                 self._custom(custom)
 
+        removed = self._clean(written)
+        self._save_manifest(written)
+        log.info("{} files written, {} unchanged, {} removed".format(
+            changed, len(written) - changed, removed))
+
     def convert(self, common):
         """
         Process all hardware profiles
@@ -193,28 +222,71 @@ class PillarData(object):
                                   Dumper=self.friendly_dumper,
                                   default_flow_style=False))
 
-    def _clean(self):
+    def _manifest(self):
+        """
+        Return the path of the manifest of the files written
+        """
+        return "{}/stack/default/.manifest.json".format(self.pillar_dir)
+
+    def _load_manifest(self):
+        """
+        Return the entries of the previous run, if any
+        """
+        try:
+            with open(self._manifest(), "r") as manifest:
+                return json.load(manifest)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_manifest(self, written):
+        """
+        Record the files written by this run
+        """
+        if not self.dryrun:
+            content = json.dumps(written, indent=1, sort_keys=True)
+            _atomic_write(self._manifest(), content, self.pillar_dir)
+
+    def _clean(self, written):
         """
-        Remove the stack/default tree to remove any leftover files from a
-        previous removal
+        Remove any leftover files of the stack/default tree that were not
+        written by this run.  Return the number of files removed.
         """
         stack_default = "{}/stack/default".format(self.pillar_dir)
-        if os.path.isdir(stack_default):
-            shutil.rmtree(stack_default)
+        removed = 0
+        for root, dirs, files in os.walk(stack_default, topdown=False):
+            for name in files:
+                filename = os.path.join(root, name)
+                pathname = os.path.relpath(filename, self.pillar_dir)
+                if pathname in written or filename == self._manifest():
+                    continue
+                log.info("Removing {}".format(filename))
+                removed += 1
+                if not self.dryrun:
+                    os.remove(filename)
+            if not self.dryrun and root != stack_default and not os.listdir(root):
+                os.rmdir(root)
+        return removed
 
     def _default(self, filename, merged):
         """
-        Output the merged contents to the default tree
+        Output the merged contents to the default tree unless the file
+        already has the same contents.  Return the size and hash of the
+        contents and whether the file was written.
         """
-        path_dir = os.path.dirname(filename)
-        if not os.path.isdir(path_dir):
-            _create_dirs(path_dir, self.pillar_dir)
+        content = yaml.dump(merged, Dumper=self.friendly_dumper, default_flow_style=False)
+        result = {'size': len(content),
+                  'sha1': hashlib.sha1(content).hexdigest(),
+                  'written': False}
+        if os.path.isfile(filename) and os.path.getsize(filename) == result['size']:
+            with open(filename, "r") as yml:
+                if hashlib.sha1(yml.read()).hexdigest() == result['sha1']:
+                    log.debug("Unchanged {}".format(filename))
+                    return result
         log.info("Writing {}".format(filename))
+        result['written'] = True
         if not self.dryrun:
-            with open(filename, "w") as yml:
-                yml.write(yaml.dump(merged,
-                          Dumper=self.friendly_dumper,
-                          default_flow_style=False))
+            _atomic_write(filename, content, self.pillar_dir)
+        return result
 
     def _custom(self, custom):
         """
@@ -240,8 +312,17 @@ class PillarData(object):
     def organize(self, filename):
         """
         Associate all filenames with their common subdirectory.
+
+        The proposals directory is scanned once and every policy line is
+        matched against that index.  A file selected by several lines is
+        listed once, at the position of its last occurrence, so it still
+        overrides the files of the lines before.  The time spent on each line
+        is kept in self.timings.
         """
         common = {}
+        seen = set()
+        index = PathIndex(self.proposals_dir)
+        self.timings = []
         with open(filename, "r") as policy:
             for line in policy:
                 log.debug(line)
@@ -251,8 +332,9 @@ class PillarData(object):
                 if line.startswith('#') or not line:
                     log.debug("Ignoring '{}'".format(line))
                     continue
+                start = time.time()
                 try:
-                    files = _parse(self.proposals_dir + "/" + line)
+                    files = _parse(self.proposals_dir + "/" + line, index)
                 except ValueError:
                     log.exception('''
                     ERROR: Mailformed {}: {}
@@ -263,16 +345,26 @@ class PillarData(object):
                 log.debug(line)
                 log.debug(files)
                 for filename in files:
+                    if filename in seen:
+                        pathname = _shift_dir(filename.replace(self.proposals_dir, ""))
+                        common[pathname].remove(filename)
+                        common[pathname].append(filename)
+                        continue
                     if os.stat(filename).st_size == 0:
                         log.warning("Skipping empty file {}".format(filename))
                         continue
-                    if os.path.isfile(filename):
+                    if filename in index or os.path.isfile(filename):
                         pathname = _shift_dir(filename.replace(self.proposals_dir, ""))
                         if pathname not in common:
                             common[pathname] = []
                         common[pathname].append(filename)
+                        seen.add(filename)
                     else:
                         log.warning("{} does not exist".format(filename))
+                self.timings.append((line, len(files), time.time() - start))
+
+        for line, count, elapsed in sorted(self.timings, key=lambda timing: -timing[2])[:10]:
+            log.debug("{:.4f}s {} files: {}".format(elapsed, count, line))
 
         # This should be in a conditional, but
         # getEffectiveLevel returns 1 no matter setting
@@ -351,6 +443,36 @@ def _examples(custom, yml):
         yml.write(text)
 
 
+def _atomic_write(filename, content, root):
+    """
+    Replace the file with the content through a rename, so that readers
+    never see a partially written file
+    """
+    path_dir = os.path.dirname(filename)
+    if not os.path.isdir(path_dir):
+        _create_dirs(path_dir, root)
+    handle, tmp_filename = tempfile.mkstemp(dir=path_dir, prefix=".push.")
+    try:
+        with os.fdopen(handle, "w") as tmp_file:
+            tmp_file.write(content)
+        os.chmod(tmp_filename, 0o644)
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError):
+        os.remove(tmp_filename)
+        raise
+
+
+def _sources(filenames):
+    """
+    Return the name, modification time and size of each source file
+    """
+    sources = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        sources.append([filename, stat.st_mtime, stat.st_size])
+    return sources
+
+
 def _merge(pathname, common):
     """
     Merge the files via stack.py
@@ -364,26 +486,109 @@ def _merge(pathname, common):
     return merged
 
 
-def _parse(line):
+class PathIndex(object):
+    """
+    The files of the proposals directory, scanned once with one glob per
+    directory level and grouped by their top directory (role-*, cluster-*,
+    profile-*, config, ...)
+    """
+
+    def __init__(self, root):
+        """
+        Scan the tree below root
+        """
+        self.root = root.rstrip('/')
+        self.files = set()
+        self.groups = {}
+        depth = 1
+        while True:
+            entries = glob.glob("/".join([self.root] + ['*'] * depth))
+            if not entries:
+                break
+            for entry in entries:
+                if os.path.isfile(entry):
+                    self.files.add(entry)
+                    parts = entry[len(self.root) + 1:].split('/')
+                    self.groups.setdefault(parts[0], []).append((parts, entry))
+            depth += 1
+
+    def __contains__(self, filename):
+        return filename in self.files
+
+    def glob(self, pattern):
+        """
+        Return the indexed files matching a glob pattern, with the same
+        results as glob.glob for files
+        """
+        segments = pattern[len(self.root) + 1:].split('/')
+        if not pattern.startswith(self.root + '/') or \
+           any(segment.startswith('.') for segment in segments):
+            # hidden files and relative paths are not indexed
+            return glob.glob(pattern)
+        if not glob.has_magic(pattern):
+            return [pattern] if pattern in self.files else []
+        if glob.has_magic(segments[0]):
+            groups = [self.groups[name] for name in self.groups
+                      if _match_segment(name, segments[0])]
+        else:
+            groups = [self.groups.get(segments[0], [])]
+        files = []
+        for group in groups:
+            for parts, entry in group:
+                if len(parts) == len(segments) and \
+                   all(_match_segment(part, segment)
+                       for part, segment in zip(parts[1:], segments[1:])):
+                    files.append(entry)
+        return files
+
+
+def _match_segment(name, segment):
+    """
+    Match a single path component like glob, which skips hidden files
+    unless the pattern starts with a dot
+    """
+    if name.startswith('.') and not segment.startswith('.'):
+        return False
+    return fnmatch.fnmatchcase(name, segment)
+
+
+def _slice(files, value):
+    """
+    Apply a python slice such as [2:5], [::2] or [-1] to the files
+    """
+    match = re.match(r'^\[\s*(-?\d*)\s*(?::\s*(-?\d*)\s*(?::\s*(-?\d*)\s*)?)?\]$', value)
+    if not match:
+        raise ValueError("invalid slice {}".format(value))
+    start, stop, step = [int(number) if number else None for number in match.groups()]
+    if ':' not in value:
+        if start is None:
+            raise ValueError("invalid slice {}".format(value))
+        return files[start:start + 1 or None]
+    if step == 0:
+        raise ValueError("slice step cannot be zero")
+    return files[start:stop:step]
+
+
+def _parse(line, index=None):
     """
     Return globbed files constrained by optional slices or regexes.
     """
+    _glob = index.glob if index else glob.glob
     if " " in line:
         parts = re.split('\s+', line)
-        files = sorted(glob.glob(parts[0]))
+        files = sorted(_glob(parts[0]))
         for optional in parts[1:]:
             filter_type, value = optional.split('=')
             if filter_type == "re":
                 regex = re.compile(value)
                 files = [m.group(0) for l in files for m in [regex.search(l)] if m]
             elif filter_type == "slice":
-                # pylint: disable=eval-used
-                files = eval("files{}".format(value))
+                files = _slice(files, value)
             else:
                 log.warning("keyword {} unsupported".format(filter_type))
 
     else:
-        files = glob.glob(line)
+        files = _glob(line)
     return files
 
 
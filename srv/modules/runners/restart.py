@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=modernize-parse-error
+"""
+Rolling restarts of storage hosts
+
+The OSD hosts are grouped by CRUSH failure domain.  All hosts of one
+failure domain are restarted together, since losing them at once is what
+the CRUSH rules already tolerate.  Between batches, the cluster must not
+be in HEALTH_ERR, every PG must be active and not peering and the degraded
+objects must settle below a threshold (none by default) for several
+consecutive checks, otherwise the restart is aborted.  Processes are
+checked only on the hosts that were restarted.
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+import salt.client
+
+log = logging.getLogger(__name__)
+
+
+def help_():
+    """
+    Usage
+    """
+    usage = ('salt-run restart.plan:\n'
+             'salt-run restart.plan failure_domain=rack max_batch=4:\n\n'
+             '    Shows the batches of storage hosts that restart together\n'
+             '\n\n'
+             'salt-run restart.osd:\n'
+             'salt-run restart.osd failure_domain=rack max_batch=4 max_degraded=0:\n\n'
+             '    Restarts the OSDs one failure domain at a time, aborts when\n'
+             '    the degraded objects stay above max_degraded percent\n'
+             '\n\n')
+    print usage
+    return ""
+
+
+def _host_domains(tree, failure_domain='host'):
+    """
+    Map the name of each host bucket of an 'osd tree' to the name of the
+    bucket of type failure_domain above it
+    """
+    nodes = dict((node['id'], node) for node in tree.get('nodes', []))
+    domains = {}
+    stack = [(node['id'], None) for node in tree.get('nodes', [])
+             if node['type'] == 'root']
+    while stack:
+        node_id, domain = stack.pop()
+        node = nodes.get(node_id)
+        if node is None or node['type'] == 'osd':
+            continue
+        if node['type'] == failure_domain:
+            domain = node['name']
+        if node['type'] == 'host':
+            domains.setdefault(node['name'], domain or node['name'])
+            continue
+        stack.extend((child, domain) for child in node.get('children', []))
+    return domains
+
+
+def _plan(tree, hosts, failure_domain='host', max_batch=0):
+    """
+    Split the minions into batches that restart together.  A batch holds
+    hosts of a single failure domain and at most max_batch of them.  Minions
+    absent from the tree are a failure domain of their own.
+
+    hosts maps the minion ids to the CRUSH host names
+    """
+    domains = _host_domains(tree, failure_domain)
+    groups = {}
+    for minion in sorted(hosts):
+        groups.setdefault(domains.get(hosts[minion], minion), []).append(minion)
+
+    batches = []
+    for domain in sorted(groups):
+        size = int(max_batch) or len(groups[domain])
+        for idx in range(0, len(groups[domain]), size):
+            batches.append({'domain': domain,
+                            'hosts': groups[domain][idx:idx + size]})
+    return batches
+
+
+class RollingRestart(object):
+    """
+    Restart the storage hosts batch by batch
+    """
+
+    def __init__(self, cluster='ceph', **kwargs):
+        """
+        Default settings can be overridden
+        """
+        self.settings = {
+            'failure_domain': 'host',
+            'max_batch': 0,
+            'max_degraded': 0,
+            'check': 2,
+            'timeout': 900,
+            'delay': 6,
+            'sls': 'ceph.osd.restart'
+        }
+        self.settings.update(dict((key, value) for key, value in kwargs.items()
+                                  if not key.startswith('__')))
+        self.search = "I@cluster:{} and I@roles:storage".format(cluster)
+        self.local = salt.client.LocalClient()
+        self.master = self.local.cmd('I@roles:master', 'pillar.get',
+                                     ['master_minion'], expr_form="compound").values()[0]
+
+    def _ceph(self, command):
+        """
+        Run a ceph command with json output on the master minion
+        """
+        output = self.local.cmd(self.master, 'cmd.run',
+                                ['ceph {} -f json'.format(command)])
+        return json.loads(output[self.master])
+
+    def plan(self):
+        """
+        Return the batches of the storage hosts
+        """
+        # When search matches no minions, salt prints to stdout.  Suppress stdout.
+        _stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        hosts = self.local.cmd(self.search, 'grains.get', ['host'], expr_form="compound")
+        sys.stdout = _stdout
+        return _plan(self._ceph('osd tree'), hosts, self.settings['failure_domain'],
+                     self.settings['max_batch'])
+
+    def settle(self):
+        """
+        Poll the cluster status until, for check consecutive polls, it is
+        not in HEALTH_ERR, no PG is inactive or peering and the degraded
+        objects are at most max_degraded percent.  Return a description of
+        the last poll and whether the cluster settled.
+        """
+        end_time = time.time() + self.settings['timeout']
+        check = 0
+        while True:
+            status = self._ceph('status')
+            health = status.get('health', {})
+            current = health.get('status', health.get('overall_status'))
+            pgmap = status.get('pgmap', {})
+            degraded = pgmap.get('degraded_ratio', 0) * 100
+            unavailable = sum(state['count'] for state in pgmap.get('pgs_by_state', [])
+                              if 'active' not in state['state_name'].split('+') or
+                              'peering' in state['state_name'])
+            state = "{}, {:.2f}% degraded objects, {} inactive or peering pgs".format(
+                current, degraded, unavailable)
+            log.debug(state)
+            if (current != 'HEALTH_ERR' and not unavailable and
+                    degraded <= float(self.settings['max_degraded'])):
+                check += 1
+                if check >= int(self.settings['check']):
+                    return state, True
+            else:
+                # Reset check counter
+                check = 0
+            if time.time() > end_time:
+                return state, False
+            time.sleep(self.settings['delay'])
+
+    def restart(self, hosts):
+        """
+        Apply the restart state to the hosts of a batch and wait for their
+        processes.  Return False if any host failed.
+        """
+        results = self.local.cmd(hosts, 'state.apply', [self.settings['sls']],
+                                 expr_form="list")
+        failed = [host for host in hosts if not _succeeded(results.get(host))]
+        if failed:
+            log.error("restart failed on {}".format(", ".join(failed)))
+            return False
+        processes = self.local.cmd(hosts, 'cephprocesses.wait',
+                                   ['timeout={}'.format(self.settings['timeout'])],
+                                   expr_form="list")
+        down = [host for host in hosts if processes.get(host) is not True]
+        if down:
+            log.error("processes are not running on {}".format(", ".join(down)))
+            return False
+        return True
+
+    def run(self, batches):
+        """
+        Restart all batches, stop at the first one that fails or when the
+        cluster does not settle
+        """
+        result = {'restarted': [], 'batches': len(batches)}
+        for batch in batches:
+            state, settled = self.settle()
+            if not settled:
+                result['aborted'] = ("cluster did not settle before {}: {}, limit is {}% "
+                                     "degraded objects".format(batch['domain'], state,
+                                                               self.settings['max_degraded']))
+                break
+            log.info("restarting {} in {}".format(", ".join(batch['hosts']),
+                                                  batch['domain']))
+            if not self.restart(batch['hosts']):
+                result['aborted'] = "restart of {} failed".format(batch['domain'])
+                break
+            result['restarted'].extend(batch['hosts'])
+        if 'aborted' in result:
+            log.error("rolling restart aborted: {}".format(result['aborted']))
+        return result
+
+
+def _succeeded(states):
+    """
+    Return whether every state of a state.apply result succeeded
+    """
+    if not isinstance(states, dict):
+        return False
+    return all(state.get('result') is not False for state in states.values())
+
+
+def plan(cluster='ceph', **kwargs):
+    """
+    Show the batches of storage hosts without restarting anything
+    """
+    return RollingRestart(cluster, **kwargs).plan()
+
+
+def osd(cluster='ceph', **kwargs):
+    """
+    Restart the storage hosts one failure domain at a time.  Return False
+    when the restart was aborted.
+    """
+    rolling = RollingRestart(cluster, **kwargs)
+    result = rolling.run(rolling.plan())
+    log.info("rolling restart: {}".format(result))
+    return 'aborted' not in result
+
+
+__func_alias__ = {
+                 'help_': 'help',
+                 }
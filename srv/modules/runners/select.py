@@ -2,16 +2,25 @@
 # pylint: disable=too-few-public-methods,modernize-parse-error
 """
 The list of minions related to a Salt target is often needed for operations.
+
+Rendering a stage calls these functions many times with the same criteria.
+Query results are kept for a few seconds and grains are read from the master
+cache, falling back to a single query of the minions missing from it.
 """
 
 import logging
 import os
 import sys
 import re
+import time
 import salt.client
+import salt.utils.master
 
 log = logging.getLogger(__name__)
 
+MEMO_TTL = 10
+_MEMO = {}
+
 
 def help_():
     """
@@ -33,6 +42,13 @@ def help_():
              'salt-run select.attr host=True attr=value key=value [key=value...]:\n\n'
              '    Returns an array of pillar values for the specified criteria\n'
              '\n\n'
+             'salt-run select.attrs attrs=value1,value2 key=value [key=value...]:\n'
+             'salt-run select.attrs host=True attrs=value1,value2 key=value [key=value...]:\n\n'
+             '    Returns an array of minions with several pillar values each\n'
+             '\n\n'
+             'salt-run select.grains grains=value1,value2 key=value [key=value...]:\n\n'
+             '    Returns an array of minions with several grain values each\n'
+             '\n\n'
              'salt-run select.from pillar=var role=default_role attr=value1,value2 :\n\n'
              '    Returns an array of grain values that matches the pillar variable.\n'
              '    Defaults to role if variable is not found.\n'
@@ -41,40 +57,109 @@ def help_():
     return ""
 
 
-def _grain_host(client, minion):
+def _memo(key, func, *args):
     """
-    Return the host grain for a given minion, for use a short hostname
+    Return the result of func for the same key within MEMO_TTL seconds
     """
-    return client.cmd(minion, 'grains.item', ['host']).values()[0]['host']
+    now = time.time()
+    if key in _MEMO and now - _MEMO[key][0] < MEMO_TTL:
+        return _MEMO[key][1]
+    value = func(*args)
+    _MEMO[key] = (now, value)
+    return value
 
 
-def minions(host=False, **kwargs):
+def _cmd(search, fun, args, expr_form="compound"):
     """
-    Some targets needs to match all minions within a search criteria.
+    Run a salt function on the search, remembering the result briefly
+    """
+    def _query():
+        # When search matches no minions, salt prints to stdout.  Suppress stdout.
+        _stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            local = salt.client.LocalClient()
+            return local.cmd(search, fun, list(args), expr_form=expr_form)
+        finally:
+            sys.stdout = _stdout
+
+    key = tuple(search) if isinstance(search, list) else search
+    return _memo(('cmd', key, fun, tuple(args), expr_form), _query)
+
+
+def _cached_grains(minion_list):
+    """
+    Return the grains of the minions from the master cache
+    """
+    try:
+        pillar_util = salt.utils.master.MasterPillarUtil(minion_list, "list",
+                                                         use_cached_grains=True,
+                                                         grains_fallback=False,
+                                                         opts=__opts__)
+        return pillar_util.get_minion_grains()
+    # pylint: disable=broad-except
+    except Exception as error:
+        log.debug("No cached grains: {}".format(error))
+        return {}
+
+
+def _grains(minion_list, names):
+    """
+    Return the requested grains of all minions as {minion: {grain: value}}.
+    Minions missing from the master cache are queried in one call.
+    """
+    def _query():
+        cached = _cached_grains(list(minion_list))
+        results = {}
+        missing = []
+        for minion in minion_list:
+            grains = cached.get(minion) or {}
+            if all(name in grains for name in names):
+                results[minion] = dict((name, grains[name]) for name in names)
+            else:
+                missing.append(minion)
+        if missing:
+            results.update(_cmd(missing, 'grains.item', names, expr_form="list"))
+        return results
+
+    minion_list = sorted(minion_list)
+    names = list(names)
+    return _memo(('grains', tuple(minion_list), tuple(names)), _query)
+
+
+def _hosts(minion_list):
+    """
+    Return the host grain of each minion, for use as a short hostname
+    """
+    grains = _grains(minion_list, ['host'])
+    return dict((minion, grains[minion]['host']) for minion in grains)
+
+
+def _search(kwargs, skip=()):
+    """
+    Return the compound search of the key=value criteria
     """
     criteria = []
     for key in kwargs:
-        if key[0] == "_":
+        if key[0] == "_" or key in skip:
             continue
         values = kwargs[key]
         if not isinstance(values, list):
             values = [values]
         for value in values:
             criteria.append("I@{}:{}".format(key, value))
+    return " and ".join(criteria)
 
-    search = " and ".join(criteria)
-
-    # When search matches no minions, salt prints to stdout.  Suppress stdout.
-    _stdout = sys.stdout
-    sys.stdout = open(os.devnull, 'w')
 
-    local = salt.client.LocalClient()
-    _minions = local.cmd(search, 'pillar.get', ['id'], expr_form="compound")
-
-    sys.stdout = _stdout
+def minions(host=False, **kwargs):
+    """
+    Some targets needs to match all minions within a search criteria.
+    """
+    _minions = _cmd(_search(kwargs), 'pillar.get', ['id'])
 
     if host:
-        return [_grain_host(local, k) for k in _minions.keys()]
+        hosts = _hosts(_minions.keys())
+        return [hosts[k] for k in _minions.keys()]
     return _minions.keys()
 
 
@@ -95,26 +180,12 @@ def public_addresses(tuples=False, host=False, **kwargs):
     Returns an array of public addresses matching the search critieria.
     Can also return an array of tuples with fqdn or short name.
     """
-    criteria = []
-    for key in kwargs:
-        if key[0] == "_":
-            continue
-        criteria.append("I@{}:{}".format(key, kwargs[key]))
-
-    search = " and ".join(criteria)
-
-    # When search matches no minions, salt prints to stdout.  Suppress stdout.
-    _stdout = sys.stdout
-    sys.stdout = open(os.devnull, 'w')
-
-    local = salt.client.LocalClient()
-    result = local.cmd(search, 'public.address', [], expr_form="compound")
-
-    sys.stdout = _stdout
+    result = _cmd(_search(kwargs), 'public.address', [])
 
     if tuples:
         if host:
-            addresses = [[_grain_host(local, k), v] for k, v in result.items()]
+            hosts = _hosts(result.keys())
+            addresses = [[hosts[k], v] for k, v in result.items()]
         else:
             addresses = [[k, v] for k, v in result.items()]
     else:
@@ -128,34 +199,45 @@ def attr(host=False, **kwargs):
     """
     Return a paired list of minions and a given attribute
     """
-    criteria = []
-    attribute = None
-    for key in kwargs:
-        if key[0] == "_":
-            continue
-        if key == 'attr':
-            attribute = kwargs['attr']
-            continue
-        criteria.append("I@{}:{}".format(key, kwargs[key]))
-
-    search = " and ".join(criteria)
-
-    # When search matches no minions, salt prints to stdout.  Suppress stdout.
-    _stdout = sys.stdout
-    sys.stdout = open(os.devnull, 'w')
-
-    local = salt.client.LocalClient()
-    _minions = local.cmd(search, 'pillar.get', [attribute], expr_form="compound")
-
-    sys.stdout = _stdout
+    attribute = kwargs.get('attr')
+    _minions = _cmd(_search(kwargs, ['attr']), 'pillar.get', [attribute])
 
     if host:
-        pairs = [[_grain_host(local, k), v] for k, v in _minions.items()]
+        hosts = _hosts(_minions.keys())
+        pairs = [[hosts[k], v] for k, v in _minions.items()]
     else:
         pairs = [[k, v] for k, v in _minions.items()]
     return pairs
 
 
+def attrs(host=False, **kwargs):
+    """
+    Return a list of minions with several attributes each, from one query
+
+    salt-run select.attrs attrs=public_network,cluster_network roles=storage
+    """
+    names = re.split(r',\s*', kwargs.get('attrs', ''))
+    _minions = _cmd(_search(kwargs, ['attrs']), 'pillar.item', names)
+
+    hosts = _hosts(_minions.keys()) if host else {}
+    return [[hosts.get(k, k)] + [v.get(name) for name in names]
+            for k, v in sorted(_minions.items())]
+
+
+def grains(**kwargs):
+    """
+    Return a list of minions with several grains each, from the master cache
+    or one query
+
+    salt-run select.grains grains=host,fqdn roles=rgw
+    """
+    names = re.split(r',\s*', kwargs.get('grains', ''))
+    _minions = _cmd(_search(kwargs, ['grains']), 'pillar.get', ['id'])
+    results = _grains(_minions.keys(), names)
+    return [[k] + [results[k].get(name) for name in names]
+            for k in sorted(results)]
+
+
 def from_(pillar, role, *args, **kwargs):
     """
     Return a list of roles and corresponding grains for the provided pillar
@@ -170,34 +252,34 @@ def from_(pillar, role, *args, **kwargs):
     if 'attr' in kwargs:
         args = re.split(r',\s*', kwargs['attr'])
 
-    # When search matches no minions, salt prints to stdout.  Suppress stdout.
-    _stdout = sys.stdout
-    sys.stdout = open(os.devnull, 'w')
-
-    local = salt.client.LocalClient()
     search = "I@roles:master"
     try:
-        roles = local.cmd(search, 'pillar.get', [pillar], expr_form="compound").values()[0]
+        roles = _cmd(search, 'pillar.get', [pillar]).values()[0]
     # pylint: disable=bare-except
     except:
         roles = []
 
-    sys.stdout = _stdout
-
     if not roles:
         # With no pillar variable, check for minions with assigned role
         result = minions(roles=role)
         if result:
             roles = [role]
 
+    members = {}
+    if roles:
+        search = " or ".join("I@roles:{}".format(_role) for _role in roles)
+        for minion, assigned in _cmd(search, 'pillar.get', ['roles']).items():
+            for _role in assigned or []:
+                members.setdefault(_role, []).append(minion)
+    all_minions = set(minion for _role in roles for minion in members.get(_role, []))
+    grains_results = _grains(all_minions, list(args))
+
     results = []
     for _role in roles:
-        minion_list = minions(roles=_role)
-        for minion in minion_list:
-            grains_result = local.cmd(minion, 'grains.item', list(args)).values()[0]
+        for minion in sorted(members.get(_role, [])):
             small = [_role]
             for arg in list(args):
-                small.append(grains_result[arg])
+                small.append(grains_results[minion][arg])
             results.append(small)
 
     if results:
@@ -13,14 +13,17 @@ prerequisite is that osd assignment must be decided before segregating types
 of hardware.
 """
 
+import copy
 import logging
 import ipaddress
 import json
+import multiprocessing.dummy
 import os
 from os.path import dirname
 import re
 import sys
 import glob
+import time
 from subprocess import Popen, PIPE
 from collections import OrderedDict
 import yaml
@@ -84,6 +87,18 @@ class PrettyPrinter(object):
             log.info("VALIDATE WARNING " + format_str)
             print format_str
 
+    def add_timings(self, name, timings):
+        """
+        Print the total and the slowest check, log each check
+        """
+        if not timings:
+            return
+        for check, seconds in timings.items():
+            log.info("VALIDATE TIMING  {:25}: {:.3f}s".format(check, seconds))
+        slowest = max(timings, key=timings.get)
+        print "{:25}: {} in {:.2f}s, slowest {} {:.2f}s".format(
+            'checks', len(timings), sum(timings.values()), slowest, timings[slowest])
+
     def print_result(self):
         """
         Printing happens during add
@@ -108,6 +123,12 @@ class JsonPrinter(object):
         """
         self.result[name] = {'passed': passed, 'errors': errors, 'warnings': warnings}
 
+    def add_timings(self, name, timings):
+        """
+        Collect the seconds spent in each check
+        """
+        self.result.setdefault(name, {})['timings'] = timings
+
     def print_result(self):
         """
         Dump results as json
@@ -128,6 +149,25 @@ def get_printer(__pub_output=None, **kwargs):
         return PrettyPrinter()
 
 
+def _snapshot(local, search, functions):
+    """
+    Collect the results of several functions from all minions with a
+    single broadcast.  Returns {function: {minion: result}}.
+    """
+    names = [fun for fun, _ in functions]
+    results = local.cmd(search, names, [args for _, args in functions],
+                        expr_form="compound")
+    snapshot = dict((name, {}) for name in names)
+    for minion, returns in results.items():
+        if not isinstance(returns, dict):
+            log.warning("{} returned {}".format(minion, returns))
+            continue
+        for name in names:
+            if name in returns:
+                snapshot[name][minion] = returns[name]
+    return snapshot
+
+
 class SaltOptions(object):
     """
     Keep the querying of salt options separate
@@ -200,20 +240,68 @@ class Validate(object):
     Perform checks on pillar and grain data
     """
 
-    def __init__(self, name, data=None, grains=None, printer=None):
+    def __init__(self, name, data=None, grains=None, printer=None, packages=None):
         """
         Query the cluster assignment and remove unassigned
+
+        packages optionally holds the 'latest' and 'installed' ceph package
+        data of each minion
         """
         self.name = name
         self.data = data
         self.grains = grains
         self.printer = printer
+        self.packages = packages
         self.in_dev_env = self.__dev_env()
         self.passed = OrderedDict()
         self.errors = OrderedDict()
         self.warnings = OrderedDict()
+        self.timings = OrderedDict()
         # self._minion_check()
 
+    def _check(self, name):
+        """
+        Run a single check on a copy with its own results
+        """
+        check = copy.copy(self)
+        check.passed = OrderedDict()
+        check.errors = OrderedDict()
+        check.warnings = OrderedDict()
+        start = time.time()
+        getattr(check, name)()
+        return check, time.time() - start
+
+    def run(self, checks, workers=8):
+        """
+        Run independent checks concurrently against the same pillar and
+        grains data.  Results are merged in the order of the checks, as if
+        the checks ran one after another.
+        """
+        workers = max(1, min(workers, len(checks)))
+        if workers > 1:
+            pool = multiprocessing.dummy.Pool(workers)
+            try:
+                results = pool.map(self._check, checks)
+            finally:
+                pool.close()
+        else:
+            results = [self._check(name) for name in checks]
+
+        for name, (check, seconds) in zip(checks, results):
+            self.timings[name] = seconds
+            for key, value in check.errors.items():
+                if isinstance(self.errors.get(key), list) and isinstance(value, list):
+                    self.errors[key].extend(value)
+                else:
+                    self.errors[key] = value
+                self.passed.pop(key, None)
+            for key, value in check.warnings.items():
+                self.warnings.setdefault(key, []).extend(value)
+                self.passed.pop(key, None)
+            for key, value in check.passed.items():
+                if key not in self.errors and key not in self.warnings:
+                    self.passed[key] = value
+
     def __dev_env(self):
         """
         Check if DEV_ENV is set in the environment or pillar
@@ -664,16 +752,18 @@ class Validate(object):
         port 80.  With all the configuration allowed in the pillar, checking the
         final ceph.conf seems the most reliable.
         """
-        local = salt.client.LocalClient()
-        for node in self.data.keys():
-            if ('roles' in self.data[node] and
-                'openattic' in self.data[node]['roles'] and
-                'rgw' in self.data[node]['roles']):
-                # Would use file.contains if it supported '='
-                result = local.cmd(node, 'file.search',
-                                   ['/etc/ceph/ceph.conf', r'port\=80\b'],
-                                   expr_form="glob")
-                if result[node]:
+        nodes = [node for node in self.data.keys()
+                 if ('roles' in self.data[node] and
+                     'openattic' in self.data[node]['roles'] and
+                     'rgw' in self.data[node]['roles'])]
+        if nodes:
+            local = salt.client.LocalClient()
+            # Would use file.contains if it supported '='
+            result = local.cmd(nodes, 'file.search',
+                               ['/etc/ceph/ceph.conf', r'port\=80\b'],
+                               expr_form="list")
+            for node in nodes:
+                if result.get(node):
                     msg = "rgw port conflicts with openATTIC on {} - check ceph.conf".format(node)
                     self.errors.setdefault('openattic', []).append(msg)
 
@@ -727,10 +817,14 @@ class Validate(object):
         """
         data = None
         node = None
-        local = salt.client.LocalClient()
         for node in self.data.keys():
-            data = local.cmd(self.data[node]['master_minion'],
-                             'pillar.get', ['master_minion'], expr_form="glob")
+            if self.data[node]['master_minion'] in self.data:
+                # The master minion already answered
+                data = True
+            else:
+                local = salt.client.LocalClient()
+                data = local.cmd(self.data[node]['master_minion'],
+                                 'pillar.get', ['master_minion'], expr_form="glob")
             break
         if data:
             self.passed['master_minion'] = "valid"
@@ -746,15 +840,19 @@ class Validate(object):
         """
         Scan all minions for ceph versions in their repos.
         """
-        target = deepsea_minions.DeepseaMinions()
-        search = target.deepsea_minions
-        local = salt.client.LocalClient()
-        contents = local.cmd(search, 'pkg.latest_version', ['ceph'], expr_form="compound")
-        for minion, version in contents.items():
+        packages = self.packages
+        if packages is None:
+            target = deepsea_minions.DeepseaMinions()
+            local = salt.client.LocalClient()
+            snapshot = _snapshot(local, target.deepsea_minions, [
+                ('pkg.latest_version', ['ceph']), ('pkg.info_installed', ['ceph'])])
+            packages = {'latest': snapshot['pkg.latest_version'],
+                        'installed': snapshot['pkg.info_installed']}
+        for minion, version in packages['latest'].items():
             if not version:
-                info = local.cmd(minion, 'pkg.info_installed', ['ceph'])
-                if info and 'version' in info[minion]['ceph']:
-                    version = info[minion]['ceph']['version']
+                info = packages['installed'].get(minion)
+                if isinstance(info, dict) and 'version' in info.get('ceph', {}):
+                    version = info['ceph']['version']
                 else:
                     self.errors.setdefault('ceph_version', []).append(
                         "No Ceph version is available for installation in {}".format(minion))
@@ -895,6 +993,8 @@ class Validate(object):
         Print the validation report
         """
         self.printer.add(self.name, self.passed, self.errors, self.warnings)
+        if self.timings and hasattr(self.printer, 'add_timings'):
+            self.printer.add_timings(self.name, self.timings)
         self.printer.print_result()
 
 
@@ -976,9 +1076,10 @@ def discovery(cluster=None, printer=None, **kwargs):
     valid = Validate(cluster, data=pillar_data, printer=printer)
 
     valid.deepsea_minions(target)
-    valid.lint_yaml_files()
+    checks = ['lint_yaml_files']
     if not valid.in_dev_env:
-        valid.profiles_populated()
+        checks.append('profiles_populated')
+    valid.run(checks)
     valid.report()
 
     if valid.errors:
@@ -1002,26 +1103,14 @@ def pillar(cluster=None, printer=None, **kwargs):
     # Restrict search to this cluster
     search = "I@cluster:{}".format(cluster)
 
-    pillar_data = local.cmd(search, 'pillar.items', [], expr_form="compound")
-    grains_data = local.cmd(search, 'grains.items', [], expr_form="compound")
+    snapshot = _snapshot(local, search, [('pillar.items', []), ('grains.items', [])])
 
     printer = get_printer(**kwargs)
-    valid = Validate(cluster, pillar_data, grains_data, printer)
-    valid.dev_env()
-    valid.fsid()
-    valid.public_network()
-    valid.public_interface()
-    valid.cluster_network()
-    valid.cluster_interface()
-    valid.monitors()
-    valid.mgrs()
-    valid.storage()
-    valid.ganesha()
-    valid.master_role()
-    valid.osd_creation()
-    valid.pool_creation()
-    valid.time_server()
-    valid.fqdn()
+    valid = Validate(cluster, snapshot['pillar.items'], snapshot['grains.items'], printer)
+    valid.run(['dev_env', 'fsid', 'public_network', 'public_interface',
+               'cluster_network', 'cluster_interface', 'monitors', 'mgrs',
+               'storage', 'ganesha', 'master_role', 'osd_creation',
+               'pool_creation', 'time_server', 'fqdn'])
     valid.report()
 
     if valid.errors:
@@ -1037,12 +1126,11 @@ def deploy(**kwargs):
     target = deepsea_minions.DeepseaMinions()
     search = target.deepsea_minions
     local = salt.client.LocalClient()
-    pillar_data = local.cmd(search, 'pillar.items', [], expr_form="compound")
-    grains_data = local.cmd(search, 'grains.items', [], expr_form="compound")
+    snapshot = _snapshot(local, search, [('pillar.items', []), ('grains.items', [])])
     printer = get_printer(**kwargs)
 
-    valid = Validate("deploy", pillar_data, grains_data, printer)
-    valid.openattic()
+    valid = Validate("deploy", snapshot['pillar.items'], snapshot['grains.items'], printer)
+    valid.run(['openattic'])
     valid.report()
 
     if valid.errors:
@@ -1063,7 +1151,7 @@ def saltapi(**kwargs):
     printer = get_printer(**kwargs)
 
     valid = Validate("salt-api", pillar_data, [], printer)
-    valid.saltapi()
+    valid.run(['saltapi'])
     valid.report()
 
     if valid.errors:
@@ -1088,13 +1176,16 @@ def setup(**kwargs):
     search = target.deepsea_minions
     local = salt.client.LocalClient()
 
-    pillar_data = local.cmd(search, 'pillar.items', [], expr_form="compound")
+    snapshot = _snapshot(local, search, [('pillar.items', []),
+                                         ('pkg.latest_version', ['ceph']),
+                                         ('pkg.info_installed', ['ceph'])])
     printer = get_printer(**kwargs)
 
-    valid = Validate("setup", pillar_data, [], printer)
+    valid = Validate("setup", snapshot['pillar.items'], [], printer,
+                     packages={'latest': snapshot['pkg.latest_version'],
+                               'installed': snapshot['pkg.info_installed']})
     valid.deepsea_minions(target)
-    valid.master_minion()
-    valid.ceph_version()
+    valid.run(['master_minion', 'ceph_version'])
     valid.report()
 
     if valid.errors:
@@ -4,8 +4,11 @@
 Operations for finding blank drives or Ceph disks
 """
 
+import json
+import multiprocessing.dummy
 import os
 import re
+import threading
 import xml.etree.ElementTree as et
 from glob import glob
 from subprocess import Popen, PIPE
@@ -31,13 +34,22 @@ class HardwareDetections(object):
             hw_raid_name(str): Manually set the hw_raid_ctrls name
             software_raid(bool): Manually set if you have sw raid and the class
                                             fails to detect it.
+            smartctl_workers(int): Number of concurrent smartctl probes
+            smartctl_timeout(int): Seconds before a smartctl probe is killed
+            cache_file(str): Keep the smartctl results per disk serial in this file
+            refresh(bool): Probe all disks again, ignoring the cache_file
         REQUIREMENTS FOR THE PROGRAMM TO WORK:
         gptfdisk, pciutils, smartmontools
         """
+        self._which_cache = {}
         self.detection_method = self._find_detection_tool(kwargs.get('detection_method', None))
         self.hw_raid = kwargs.get('hw_raid', None)
         self.hw_raid_name = kwargs.get('raid_controller_name', None)
         self.software_raid = kwargs.get('sw_raid', None)
+        self.smartctl_workers = int(kwargs.get('smartctl_workers', 8))
+        self.smartctl_timeout = int(kwargs.get('smartctl_timeout', 30))
+        self.cache_file = kwargs.get('cache_file', None)
+        self.refresh = kwargs.get('refresh', False)
 
     # pylint: disable=no-self-use
     def _is_removable(self, base):
@@ -74,19 +86,31 @@ class HardwareDetections(object):
         else:
             return "0"
 
-    def _return_device_bus_id(self, device):
+    def _lsscsi(self):
+        """
+        Run lsscsi once for all devices
+
+        return:
+            list: lines of the lsscsi output
+        """
+        lsscsi_path = self._which('lsscsi')
+        cmd = lsscsi_path
+        proc = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
+        return list(proc.stdout)
+
+    def _return_device_bus_id(self, device, lsscsi=None):
         """
         Tries to get the BUS_ID for a device. Used to query
         S.M.A.R.T with -d <raidctrl>,<busid>
         args:
             device(str): shortname for device(sda, sdb)
+            lsscsi(list): lsscsi output, runs lsscsi if not provided
         return:
             str: bus_id of device
         """
-        lsscsi_path = self._which('lsscsi')
-        cmd = lsscsi_path
-        proc = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
-        for line in proc.stdout:
+        if lsscsi is None:
+            lsscsi = self._lsscsi()
+        for line in lsscsi:
             if device in line:
                 match = re.match(r'\[(.*?)\]', line)
                 if len(match.group(1).split(":")) >= 2:
@@ -98,7 +122,7 @@ class HardwareDetections(object):
                     log.warning("Could not retrieve bus_id for {}").format(device)
                     return None
 
-    def _query_disktype(self, device, raid_ctrl, base):
+    def _query_disktype(self, device, raid_ctrl, base, lsscsi=None):
         """
         Query smartctl for a more concise information on it's type.
 
@@ -106,22 +130,30 @@ class HardwareDetections(object):
             device (str): short form of device (sda, sdb)
             raid_ctrl (dict): dict with raidctrl info
             id (str): position in disk array? don't know how to fix that TODO:
+            lsscsi (list): lsscsi output shared by all devices
         return:
-            bool: 0 if SSD else 1
+            tuple: '0' if SSD else '1' and whether smartctl answered, the
+                   legacy detection is used when it did not
         """
         smartctl_path = self._which('smartctl')
-        bus_id = self._return_device_bus_id(device)
+        bus_id = self._return_device_bus_id(device, lsscsi)
         if not bus_id:
             log.warning(('Could not find bus_id for {}. Falling back to legacy '
                          'detection mode'.format(device)))
-            return self._is_rotational(base)
+            return self._is_rotational(base), False
         try:
             cmd = "{} -i /dev/{} -d {},{}".format(smartctl_path,
                                                   device,
                                                   raid_ctrl['controller_name'],
                                                   bus_id)
             proc = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
-            proc.wait()
+            # A disk behind a busy controller may not answer at all
+            watchdog = threading.Timer(self.smartctl_timeout, proc.kill)
+            watchdog.start()
+            try:
+                proc.wait()
+            finally:
+                watchdog.cancel()
             if proc.returncode != 0:
                 log.info("{}\nrc: {} - {}".format(cmd, proc.returncode, proc.stderr.read()))
                 raise RuntimeError("Smartctl failure")
@@ -135,15 +167,15 @@ class HardwareDetections(object):
                         found = re.match(r"^\s+ Solid State Device",
                                          match.group(2))
                         if found:
-                            return '0'
-            return '1'
+                            return '0', True
+            return '1', True
         # pylint: disable=bare-except
         except:
             # If something fails, fall back to the default detection mode
             log.warning(('Something went wrong during smartctl query for '
                          'device {}. Falling back to legacy detection '
                          'mode'.format(device)))
-            return self._is_rotational(base)
+            return self._is_rotational(base), False
 
     def _detect_raidctrl(self):
         """
@@ -227,6 +259,27 @@ class HardwareDetections(object):
         return:
             str: the full path of the programm
         """
+        if program not in self._which_cache:
+            self._which_cache[program] = self._search_path(program)
+        if self._which_cache[program]:
+            return self._which_cache[program]
+        if failhard is False:
+            return None
+        elif failhard is True:
+            msg = "Can't find the tool: {}. Please Install it in order to resume.".format(program)
+            log.info(msg)
+            raise StandardError(msg)
+        else:
+            msg = ("Parameter <failhard> needs to be bool(True) or bool(False) "
+                   "but was: {}".format(str(failhard)))
+            log.info(msg)
+            raise StandardError(msg)
+
+    # pylint: disable=no-self-use
+    def _search_path(self, program):
+        """
+        Return the full path of an executable program or None
+        """
         def _is_exe(fpath):
             """
             Check if file is executable
@@ -243,17 +296,7 @@ class HardwareDetections(object):
                 exe_file = os.path.join(path, program)
                 if _is_exe(exe_file):
                     return exe_file
-        if failhard is False:
-            return None
-        elif failhard is True:
-            msg = "Can't find the tool: {}. Please Install it in order to resume.".format(program)
-            log.info(msg)
-            raise StandardError(msg)
-        else:
-            msg = ("Parameter <failhard> needs to be bool(True) or bool(False) "
-                   "but was: {}".format(str(failhard)))
-            log.info(msg)
-            raise StandardError(msg)
+        return None
 
     def _find_detection_tool(self, overwrite_method=None):
         """
@@ -448,6 +491,7 @@ class HardwareDetections(object):
         """
 
         drives = []
+        candidates = []
         raid_ctrl = self._detect_raidctrl()
         _hw = self.detection_method()
         for path in glob('/sys/block/*/device'):
@@ -477,26 +521,95 @@ class HardwareDetections(object):
                 hardware = _hw['/dev/'+device]
             else:
                 hardware = self.detection_method(device)
+            candidates.append((device, base, hardware))
 
-            if raid_ctrl['raidtype'] and self._which('smartctl'):
-                # Trying to correct the kernel's assumption here
-                log.info("Requirements met to utilize S.M.A.R.T on {}".format(device))
-                rotational = self._query_disktype(device, raid_ctrl, base)
-                hardware['rotational'] = rotational
-            else:
-                hardware['rotational'] = self._is_rotational(base)
+        if raid_ctrl['raidtype'] and candidates and self._which('smartctl', failhard=False):
+            # Trying to correct the kernel's assumption here
+            self._probe_disktypes(candidates, raid_ctrl)
 
+        for device, base, hardware in candidates:
+            if 'rotational' not in hardware:
+                hardware['rotational'] = self._is_rotational(base)
             hardware['device'] = device
             self._preflight_check(hardware)
             log.debug('Adding {} to the list of cephdisks.'.format(device))
             drives.append(hardware)
         return drives
 
+    def _probe_disktypes(self, candidates, raid_ctrl):
+        """
+        Set the rotational value of each candidate from smartctl.  Disks
+        with a known serial reuse the answer of a previous run, the others
+        are probed concurrently.
+
+        args:
+            candidates (list): list of (device, base, hardware) tuples
+            raid_ctrl (dict): dict with raidctrl info
+        """
+        cache = self._load_cache()
+        probes = []
+        for device, base, hardware in candidates:
+            serial = hardware.get('Serial ID')
+            if serial and serial in cache:
+                log.debug("Using cached S.M.A.R.T result for {}".format(device))
+                hardware['rotational'] = cache[serial]
+            else:
+                log.info("Requirements met to utilize S.M.A.R.T on {}".format(device))
+                probes.append((device, base, hardware))
+        if not probes:
+            return
+
+        lsscsi = self._lsscsi()
+        pool = multiprocessing.dummy.Pool(max(min(self.smartctl_workers, len(probes)), 1))
+        try:
+            results = pool.map(lambda (device, base, _): self._query_disktype(device, raid_ctrl,
+                                                                               base, lsscsi),
+                               probes)
+        finally:
+            pool.close()
+            pool.join()
+        for (device, base, hardware), (rotational, answered) in zip(probes, results):
+            hardware['rotational'] = rotational
+            # The legacy detection is not cached, smartctl may answer next time
+            if answered and hardware.get('Serial ID'):
+                cache[hardware['Serial ID']] = rotational
+        self._save_cache(cache)
+
+    def _load_cache(self):
+        """
+        Return the smartctl results of previous runs indexed by disk serial
+        """
+        if not self.cache_file or self.refresh or not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, 'r') as _fd:
+                return json.load(_fd)
+        except (IOError, ValueError) as error:
+            log.warning("Ignoring cache {}: {}".format(self.cache_file, error))
+            return {}
+
+    def _save_cache(self, cache):
+        """
+        Write the smartctl results indexed by disk serial
+        """
+        if not self.cache_file:
+            return
+        tmp_file = "{}.tmp".format(self.cache_file)
+        try:
+            with open(tmp_file, 'w') as _fd:
+                json.dump(cache, _fd)
+            os.rename(tmp_file, self.cache_file)
+        except (IOError, OSError) as error:
+            log.warning("Could not write cache {}: {}".format(self.cache_file, error))
+
 
 def list_(**kwargs):
     """
     List the disks
     """
+    if 'cache_file' not in kwargs:
+        kwargs['cache_file'] = os.path.join(__opts__.get('cachedir', '/var/cache/salt/minion'),
+                                            'cephdisks.json')
     hwd = HardwareDetections(**kwargs)
     return hwd.assemble_device_list()
 
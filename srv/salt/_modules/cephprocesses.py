@@ -9,12 +9,12 @@ import time
 import os
 import pwd
 import shlex
-# pylint: disable=import-error,3rd-party-module-not-gated
 from subprocess import Popen, PIPE
-import psutil
 
 log = logging.getLogger(__name__)
 
+PROC = '/proc'
+
 """
 The original purpose of this runner is to verify that proceeding with an
 upgrade is safe.  All expected services are running.
@@ -40,11 +40,68 @@ processes = {'mon': ['ceph-mon'],
              'master': []}
 
 
+def _osd_id(cmdline):
+    """
+    Return the OSD id from the arguments of a ceph-osd process
+    """
+    for idx, arg in enumerate(cmdline):
+        if arg in ('--id', '-i') and idx + 1 < len(cmdline):
+            value = cmdline[idx + 1]
+        elif arg.startswith('--id='):
+            value = arg[5:]
+        else:
+            continue
+        if value.isdigit():
+            return int(value)
+    return None
+
+
+def _scan(names, proc=None):
+    """
+    Read /proc once and return the pids and owners of the processes with
+    the given names, and the pids of the ceph-osd processes by OSD id.
+
+    NOTE about process names: some processes (ie. ceph-mgr was noted)
+    _sometimes_ contain a name in /proc/PID/stat,status and comm that does
+    not match /proc/PID/cmdline, such as 'exe'.  The name is taken from the
+    executable in cmdline and only kernel threads, which have no cmdline,
+    fall back to comm.
+    """
+    proc = proc or PROC
+    pids = {}
+    osds = {}
+    for pid in os.listdir(proc):
+        if not pid.isdigit():
+            continue
+        path = "{}/{}".format(proc, pid)
+        try:
+            with open(path + "/cmdline", 'r') as cmdline_file:
+                cmdline = cmdline_file.read().split('\0')
+            if cmdline[0]:
+                name = os.path.basename(cmdline[0].split(' ')[0])
+            else:
+                with open(path + "/comm", 'r') as comm_file:
+                    name = comm_file.read().strip()
+            if name not in names:
+                continue
+            uid = os.stat(path).st_uid
+        except (IOError, OSError):
+            # The process exited during the scan
+            continue
+        pids.setdefault(name, []).append((int(pid), uid))
+        if name == 'ceph-osd':
+            osd_id = _osd_id(cmdline)
+            if osd_id is not None:
+                osds[osd_id] = int(pid)
+    return pids, osds
+
+
 def check(results=False, quiet=False, **kwargs):
     """
     Query the status of running processes for each role.  Return False if any
     fail.  If results flag is set, return a dictionary of the form:
       { 'down': [ process, ... ], 'up': { process: [ pid, ... ], ...} }
+    OSDs that are not running are listed in down as osd.<id>.
     """
     running = True
     res = {'up': {}, 'down': []}
@@ -53,62 +110,46 @@ def check(results=False, quiet=False, **kwargs):
         for rgw_config in __pillar__['rgw_configurations']:
             processes[rgw_config] = ['radosgw']
 
-    # pylint: disable=too-many-nested-blocks
     if 'roles' in __pillar__:
-        for role in kwargs.get('roles', __pillar__['roles']):
-            # Checking running first.
-            for running_proc in psutil.process_iter():
-                # NOTE about `ps` and psutils.Process():
-                # `ps -e` determines process names by examining
-                # /proc/PID/stat,status files.  The name derived
-                # there is also found in psutil.Process.name.
-                # `ps -ef`, according to strace, appears to also reference
-                # /proc/PID/cmdline when determining
-                # process names.  We have found that some processes (ie.
-                # ceph-mgr was noted) will _sometimes_
-                # contain a process name in /proc/PIDstat/stat,status that does
-                # not match that found in /proc/PID/cmdline.
-                # In our ceph-mgr example, the process name was found to be
-                # 'exe' (which happens to also be the name a of
-                # symlink in /proc/PID that points to the executable) while the
-                # cmdline entry contained 'ceph-mgr' etc.
-                # As such, we've decided that a check based on executable
-                # path is more reliable.
-                pdict = running_proc.as_dict(attrs=['pid', 'name', 'exe', 'uids'])
-                pdict_exe = os.path.basename(pdict['exe'])
-                pdict_pid = pdict['pid']
-                # Convert the numerical UID to name.
-                pdict_uid = pwd.getpwuid(pdict['uids'].real).pw_name
-                if pdict_exe in processes[role]:
-                    # Verify httpd-worker pid belongs to openattic.
-                    if (role != 'openattic') or (role == 'openattic' and pdict_uid == 'openattic'):
-                        if pdict_exe in res['up']:
-                            res['up'][pdict_exe] = res['up'][pdict_exe] + [pdict_pid]
-                        else:
-                            res['up'][pdict_exe] = [pdict_pid]
-
-            # Any processes for this role that aren't running, mark them down.
+        roles = kwargs.get('roles', __pillar__['roles'])
+        pids, osds = _scan(set(proc for role in roles for proc in processes[role]))
+        for role in roles:
             for proc in processes[role]:
-                if proc not in res['up']:
+                owners = pids.get(proc, [])
+                # Verify httpd-worker pid belongs to openattic.
+                if role == 'openattic':
+                    owners = [(pid, uid) for pid, uid in owners if _user(uid) == 'openattic']
+                if owners:
+                    res['up'][proc] = sorted(set(res['up'].get(proc, []) +
+                                                 [pid for pid, _ in owners]))
+                # Any processes for this role that aren't running, mark them down.
+                elif proc not in res['down']:
                     if not quiet:
                         log.error("ERROR: process {} for role {} is not running".format(proc, role))
                     running = False
                     res['down'] += [proc]
-            # pylint: disable=fixme
-            # FIXME: Map osd.ids to processes.pid to improve qualitify of logging
-            # currently you can only say how many osds/ if any are down, but not
-            # which osd is down exactly.
-            if role == 'storage':
-                if 'ceph-osd' in res['up']:
-                    if len(__salt__['osd.list']()) > len(res['up']['ceph-osd']):
-                        if not quiet:
-                            log.error("ERROR: At least one OSD is not running")
-                        res = {'up': {}, 'down': {'ceph-osd': 'ceph-osd'}}
-                        running = False
+            if role == 'storage' and 'ceph-osd' in res['up']:
+                res['osds'] = osds
+                expected = set(int(osd_id) for osd_id in __salt__['osd.list']())
+                for osd_id in sorted(expected - set(osds)):
+                    if not quiet:
+                        log.error("ERROR: osd.{} is not running".format(osd_id))
+                    res['down'] += ['osd.{}'.format(osd_id)]
+                    running = False
 
     return res if results else running
 
 
+def _user(uid):
+    """
+    Convert the numerical UID to name.
+    """
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return None
+
+
 # pylint: disable=unused-argument
 def down(**kwargs):
     """
@@ -6,10 +6,15 @@ for network related tasks such as ping and iperf.
 
 from __future__ import absolute_import
 import logging
+import math
 import multiprocessing.dummy
 import multiprocessing
+import os
 import re
+import select
 import socket
+import struct
+import time
 from subprocess import Popen, PIPE
 # pylint: disable=incompatible-py3-code
 log = logging.getLogger(__name__)
@@ -159,7 +164,7 @@ def iperf_client_cmd(server, cpu=0, port=5200):
         else:
             return [LOCALHOST_NAME, 2, "0",
                     "iperf3 not found in path, please install"]
-    iperf_cmd = ["/usr/bin/iperf3", "-fm", "-A"+str(cpu),
+    iperf_cmd = [IPERF_PATH, "-fm", "-A"+str(cpu),
                  "-t10", "-c"+server, "-p"+str(port)]
     log.debug('iperf_client_cmd: cmd {}'.format(iperf_cmd))
     proc = Popen(iperf_cmd, stdout=PIPE, stderr=PIPE)
@@ -185,6 +190,55 @@ def iperf_server_cmd(cpu=0, port=5200):
     return LOCALHOST_NAME + ": iperf3 started at cpu " + str(cpu) + " port " + str(port) + "\n"
 
 
+def _listening_ports():
+    '''
+    Return the TCP ports in LISTEN state from /proc/net/tcp and tcp6
+    '''
+    ports = set()
+    for filename in ['/proc/net/tcp', '/proc/net/tcp6']:
+        try:
+            with open(filename) as table:
+                next(table)
+                for line in table:
+                    fields = line.split()
+                    if len(fields) > 3 and fields[3] == '0A':
+                        ports.add(int(fields[1].rsplit(':', 1)[1], 16))
+        except (IOError, StopIteration):
+            continue
+    return ports
+
+
+def iperf_servers(*ports, **kwargs):
+    '''
+    Start an iperf3 server on each port and wait until all of them listen,
+    polling the listening sockets instead of sleeping a fixed time
+
+    CLI Example:
+    .. code-block:: bash
+    salt 'node' multi.iperf_servers 5200 5201 timeout=10
+    '''
+    if IPERF_PATH is None:
+        return {'ready': [], 'missing': list(ports),
+                'error': LOCALHOST_NAME + ": iperf3 not found in path, please install"}
+    ports = [int(port) for port in ports]
+    cpus = multiprocessing.cpu_count()
+    for index, port in enumerate(ports):
+        iperf_cmd = [IPERF_PATH, "-s", "-D", "-A"+str(index % cpus), "-p"+str(port)]
+        log.debug('iperf_servers: cmd {}'.format(iperf_cmd))
+        Popen(iperf_cmd)
+
+    deadline = time.time() + float(kwargs.get('timeout', 10))
+    delay = 0.05
+    while True:
+        listening = _listening_ports()
+        ready = [port for port in ports if port in listening]
+        if len(ready) == len(ports) or time.time() > deadline:
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, 1)
+    return {'ready': ready, 'missing': [port for port in ports if port not in ready]}
+
+
 def kill_iperf_cmd():
     '''
     Clean up all the iperf3 server and clean it.
@@ -253,6 +307,171 @@ def jumbo_ping_cmd(host):
     return host, proc.returncode, proc.stdout.read(), proc.stderr.read()
 
 
+def _checksum(data):
+    '''
+    Internet checksum of an ICMP message
+    '''
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack('!{}H'.format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def _icmp_socket():
+    '''
+    Return an unprivileged ICMP socket if the kernel allows one, otherwise a
+    raw socket.  The flag tells whether replies carry an IP header.
+    '''
+    try:
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP), False
+    except socket.error:
+        return socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP), True
+
+
+def _probe(targets, count, interval, timeout):
+    '''
+    Send count echo requests to every target from a single socket, one
+    round every interval seconds, and return the round trip times in ms of
+    the replies of each target.
+    '''
+    sock, raw = _icmp_socket()
+    ident = os.getpid() & 0xffff
+    pending = {}
+    rtts = dict((address, []) for address in targets.values())
+    seq = 0
+
+    def _receive(until):
+        while time.time() < until:
+            readable = select.select([sock], [], [], max(0, until - time.time()))[0]
+            if not readable:
+                return
+            packet, peer = sock.recvfrom(2048)
+            received = time.time()
+            if raw:
+                packet = packet[(ord(packet[0:1]) & 0x0f) * 4:]
+            if len(packet) < 8:
+                continue
+            icmp_type, _, _, reply_id, reply_seq = struct.unpack('!BBHHH', packet[:8])
+            if icmp_type != 0 or (raw and reply_id != ident):
+                continue
+            sent = pending.pop((peer[0], reply_seq), None)
+            if sent is not None:
+                rtts[peer[0]].append((received - sent) * 1000)
+
+    try:
+        for _ in range(count):
+            for address in rtts:
+                seq = (seq + 1) & 0xffff
+                header = struct.pack('!BBHHH', 8, 0, 0, ident, seq)
+                payload = b'deepsea' * 8
+                header = struct.pack('!BBHHH', 8, 0, _checksum(header + payload), ident, seq)
+                pending[(address, seq)] = time.time()
+                try:
+                    sock.sendto(header + payload, (address, 0))
+                except socket.error as error:
+                    log.debug('_probe: {} {}'.format(address, error))
+                    pending.pop((address, seq))
+            _receive(time.time() + interval)
+        deadline = time.time() + timeout
+        while pending and time.time() < deadline:
+            _receive(deadline)
+    finally:
+        sock.close()
+    return rtts
+
+
+def _percentile(samples, pct):
+    '''
+    Nearest rank percentile of sorted samples
+    '''
+    rank = int(math.ceil(pct * len(samples) / 100.0))
+    return samples[min(max(rank, 1), len(samples)) - 1]
+
+
+def _latency(samples, sent):
+    '''
+    Summarize the round trip times of one target
+    '''
+    stats = {'sent': sent, 'received': len(samples),
+             'loss': 100.0 * (sent - len(samples)) / sent if sent else 0.0}
+    if samples:
+        ordered = sorted(samples)
+        stats.update({'min': ordered[0], 'p50': _percentile(ordered, 50),
+                      'p99': _percentile(ordered, 99), 'max': ordered[-1]})
+        if len(samples) > 1:
+            stats['jitter'] = (sum(abs(samples[idx] - samples[idx - 1])
+                                   for idx in range(1, len(samples))) /
+                               (len(samples) - 1))
+        else:
+            stats['jitter'] = 0.0
+    return stats
+
+
+def ping_stats(*hosts, **kwargs):
+    '''
+    Send many probes to every host over one ICMP socket and summarize the
+    latency distribution.  The summary keeps the keys of multi.ping and adds
+    the p50/p99/max, loss and jitter over all hosts and the hosts with the
+    worst p99.  With detail=True the statistics of each host are included.
+
+    CLI Example:
+    .. code-block:: bash
+        sudo salt 'node' multi.ping_stats <hostname>|<ip> <hostname>|<ip>.... count=20
+    '''
+    count = int(kwargs.get('count', 20))
+    interval = float(kwargs.get('interval', 0.02))
+    timeout = float(kwargs.get('timeout', 1))
+    targets = {}
+    errored = []
+    for host in hosts:
+        try:
+            targets[host] = socket.gethostbyname(host)
+        except socket.error:
+            errored.append(host)
+    log.debug('ping_stats hostlist={}'.format(list(hosts)))
+
+    rtts = _probe(targets, count, interval, timeout) if targets else {}
+    stats = dict((host, _latency(rtts[address], count))
+                 for host, address in targets.items())
+    return _summarize_stats(stats, errored, kwargs.get('detail', False))
+
+
+def _summarize_stats(stats, errored, detail=False):
+    '''
+    Reduce the statistics of each host to a summary compatible with
+    _summarize_ping
+    '''
+    success = sorted(host for host in stats if stats[host]['received'])
+    failed = sorted(host for host in stats if not stats[host]['received'])
+    samples = sorted(stats[host]['p50'] for host in success)
+    msg = {'succeeded': len(success)}
+    if failed:
+        msg['failed'] = " ".join(failed)
+    if errored:
+        msg['errored'] = " ".join(errored)
+    msg['avg'] = sum(samples) / len(samples) if samples else 0
+    if samples:
+        median = _percentile(samples, 50)
+        slow = [host for host in success if stats[host]['p50'] > 2 * median + 1]
+        if slow:
+            msg['slow'] = " ".join(slow)
+        sent = sum(stats[host]['sent'] for host in stats)
+        msg['latency'] = {
+            'p50': median,
+            'p99': max(stats[host]['p99'] for host in success),
+            'max': max(stats[host]['max'] for host in success),
+            'jitter': max(stats[host]['jitter'] for host in success),
+            'loss': 100.0 * sum(stats[host]['sent'] - stats[host]['received']
+                                for host in stats) / sent if sent else 0.0}
+        msg['worst'] = [[host, stats[host]['p99']] for host in
+                        sorted(success, key=lambda host: -stats[host]['p99'])[:3]]
+    if detail:
+        msg['hosts'] = stats
+    return msg
+
+
 def prepare_iperf_server():
     '''
     Create N server base on the total core number of your cpu count
@@ -6,10 +6,12 @@ All OSD related functions
 """
 
 from __future__ import absolute_import
+import contextlib
 import glob
 import os
 import json
 import logging
+import multiprocessing.dummy
 import time
 import re
 import pprint
@@ -44,45 +46,111 @@ def _run(cmd):
     return proc.returncode, _stdout, _stderr
 
 
-# These first three methods should be combined... saving for later
+class OSDInventory(object):
+    """
+    Snapshot of the mounts, partitions, symlinks and OSD directories of the
+    minion.
+
+    Lookups are only cached while a snapshot is active.  The module functions
+    that query several devices open a snapshot, so that each mount table read,
+    glob, readlink or sgdisk call happens once per module call.  Anything that
+    changes partitions or mounts calls invalidate.
+    """
+
+    def __init__(self):
+        """
+        Start without an active snapshot
+        """
+        self.depth = 0
+        self.cache = {}
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        """
+        Cache lookups until the outermost snapshot ends
+        """
+        self.depth += 1
+        try:
+            yield self
+        finally:
+            self.depth -= 1
+            if not self.depth:
+                self.invalidate()
+
+    def invalidate(self):
+        """
+        Forget all cached lookups
+        """
+        self.cache = {}
+
+    def lookup(self, key, func, *args):
+        """
+        Return the cached result of func for key, calling func when no
+        snapshot is active or the key is missing
+        """
+        if not self.depth:
+            return func(*args)
+        if key not in self.cache:
+            self.cache[key] = func(*args)
+        return self.cache[key]
+
+
+_INVENTORY = OSDInventory()
+
+
+def _read_mounts():
+    """
+    Return the device and mount point of each entry in /proc/mounts
+    """
+    _mounts = []
+    with open('/proc/mounts') as mounts:
+        for line in mounts:
+            entry = line.split()
+            if len(entry) > 1:
+                _mounts.append((entry[0], entry[1]))
+    return _mounts
+
+
+def _mounts():
+    """
+    Return the mount table
+    """
+    return _INVENTORY.lookup(('mounts',), _read_mounts)
+
+
+def _osd_mounts():
+    """
+    Return the device and path of each mounted OSD directory
+    """
+    _paths = set(paths())
+    return [(device, path) for device, path in _mounts() if path in _paths]
+
+
 def paths():
     """
     Return an array of pathnames
     """
-    return [pathname for pathname in glob.glob("/var/lib/ceph/osd/*")]
+    return list(_INVENTORY.lookup(('paths',), glob.glob, "/var/lib/ceph/osd/*"))
 
 
 def devices():
     """
     Return an array of devices
     """
-    _paths = [pathname for pathname in glob.glob("/var/lib/ceph/osd/*")]
-    _devices = []
-    with open('/proc/mounts') as mounts:
-        for line in mounts:
-            device, path = line.split()[:2]
-            if path in _paths:
-                _devices.append(device)
-
-    return _devices
+    return [device for device, _ in _osd_mounts()]
 
 
 def pairs():
     """
     Return an array of devices and paths
     """
-    _paths = [pathname for pathname in glob.glob("/var/lib/ceph/osd/*")]
     _pairs = []
-    with open('/proc/mounts') as mounts:
-        for line in mounts:
-            _partition, path = line.split()[:2]
-            if path in _paths:
-                match = re.match(r'^(.+)\d+$', _partition)
-                device = match.group(1)
-                if 'nvme' in device:
-                    device = device[:-1]
-                _pairs.append([device, path])
-
+    for _partition, path in _osd_mounts():
+        match = re.match(r'^(.+)\d+$', _partition)
+        device = match.group(1)
+        if 'nvme' in device:
+            device = device[:-1]
+        _pairs.append([device, path])
     return _pairs
 
 
@@ -90,15 +158,10 @@ def part_pairs():
     """
     Return an array of partitions and paths
     """
-    _paths = [pathname for pathname in glob.glob("/var/lib/ceph/osd/*")]
     _pairs = []
-    with open('/proc/mounts') as mounts:
-        for line in mounts:
-            _partition, path = line.split()[:2]
-            if path in _paths:
-                match = re.match(r'^(.+)\d+$', _partition)
-                part = match.group(0)
-                _pairs.append([part, path])
+    for _partition, path in _osd_mounts():
+        match = re.match(r'^(.+)\d+$', _partition)
+        _pairs.append([match.group(0), path])
     return _pairs
 
 
@@ -222,6 +285,115 @@ def tree():
     return json.dumps(json.loads(output), indent=4)
 
 
+class OSDDrain(object):
+    """
+    Track the PGs remaining on a set of OSDs until all of them are empty
+
+    A single osd df is issued per interval for all tracked OSDs.  The interval
+    starts at delay, doubles up to max_delay while no PGs move and shrinks to
+    the shortest estimated time remaining.
+    """
+
+    def __init__(self, osd_ids, cluster, **kwargs):
+        """
+        Initialize settings, track each OSD id
+        """
+        self.osd_ids = [int(_id) for _id in osd_ids]
+        self.cluster = cluster
+        self.settings = {
+            'timeout': 60,
+            'delay': 6,
+            'max_delay': 60,
+            'check_weight': False
+        }
+        self.settings.update(kwargs)
+        self.status = {}
+
+    def osd_df(self):
+        """
+        Return the df entries of all OSDs indexed by id
+        """
+        cmd = json.dumps({"prefix": "osd df", "format": "json"})
+        _, output, _ = self.cluster.mon_command(cmd, b'', timeout=6)
+        return dict((entry['id'], entry) for entry in json.loads(output)['nodes'])
+
+    def _update(self, _id, entry, now):
+        """
+        Record the PGs remaining on an OSD and estimate the time until it is
+        empty.  Return whether PGs moved since the last update.
+        """
+        status = self.status.setdefault(_id, {'first_pgs': entry['pgs'],
+                                              'first_time': now,
+                                              'pgs': entry['pgs'],
+                                              'eta': None})
+        moved = status['pgs'] != entry['pgs']
+        status['pgs'] = entry['pgs']
+        moved_pgs = status['first_pgs'] - entry['pgs']
+        if moved_pgs > 0 and now > status['first_time']:
+            rate = moved_pgs / (now - status['first_time'])
+            status['eta'] = int(entry['pgs'] / rate)
+        return moved
+
+    def wait(self):
+        """
+        Wait until PGs reach 0 on all OSDs or no PGs move before the timeout
+        expires.  Return a message per OSD id, empty when the OSD is empty.
+        """
+        results = {}
+        pending = list(self.osd_ids)
+        delay = self.settings['delay']
+        last_progress = time.time()
+        while True:
+            entries = self.osd_df()
+            now = time.time()
+            progress = False
+            tracked = len(self.status)
+            for _id in list(pending):
+                entry = entries.get(_id, {})
+                if 'pgs' not in entry:
+                    results[_id] = "osd.{} does not exist".format(_id)
+                    log.warn(results[_id])
+                    pending.remove(_id)
+                elif entry['pgs'] == 0:
+                    log.info("osd.{} has no PGs".format(_id))
+                    results[_id] = ""
+                    pending.remove(_id)
+                elif self.settings['check_weight'] and float(entry['crush_weight']) != 0:
+                    results[_id] = "Weight is not 0.0"
+                    log.error(results[_id])
+                    pending.remove(_id)
+                else:
+                    if self._update(_id, entry, now):
+                        progress = True
+                    log.warn("osd.{} has {} PGs remaining, ETA {}".format(
+                        _id, entry['pgs'], self._eta(_id)))
+            if not pending:
+                return results
+
+            # The first sample of an OSD does not count as a stall
+            if progress or len(self.status) > tracked:
+                last_progress = now
+                delay = self.settings['delay']
+            elif now - last_progress >= self.settings['timeout']:
+                log.debug("Timeout expired")
+                raise RuntimeError("Timeout expired")
+            else:
+                delay = min(delay * 2, self.settings['max_delay'])
+            etas = [self.status[_id]['eta'] for _id in pending
+                    if _id in self.status and self.status[_id]['eta'] is not None]
+            if etas:
+                delay = max(min([delay] + etas), 1)
+            time.sleep(delay)
+
+    def _eta(self, _id):
+        """
+        Return the estimated time remaining for an OSD
+        """
+        if _id in self.status and self.status[_id]['eta'] is not None:
+            return "{}s".format(self.status[_id]['eta'])
+        return "unknown"
+
+
 class OSDState(object):
     """
     Manage the OSD state
@@ -265,27 +437,11 @@ class OSDState(object):
         """
         Wait until PGs reach 0 or timeout expires
         """
-        i = 0
-        while i < self.settings['timeout']/self.settings['delay']:
-            entry = self.osd_tree()
-            if 'pgs' in entry:
-                if entry['pgs'] == 0:
-                    log.info("osd.{} has no PGs".format(self.osd_id))
-                    return
-                else:
-                    if entry['crush_weight'] != '0.0':
-                        msg = "Weight is not 0.0"
-                        log.error(msg)
-                        return msg
-                    log.warn("osd.{} has {} PGs remaining".format(self.osd_id, entry['pgs']))
-            else:
-                log.warn("osd.{} does not exist".format(self.osd_id))
-                return
-            i += 1
-            time.sleep(self.settings['delay'])
-
-        log.debug("Timeout expired")
-        raise RuntimeError("Timeout expired")
+        drain = OSDDrain([self.osd_id], self.cluster, check_weight=True,
+                         timeout=self.settings['timeout'], delay=self.settings['delay'])
+        result = drain.wait()[int(self.osd_id)]
+        if result == "Weight is not 0.0":
+            return result
 
 
 def down(_id, **kwargs):
@@ -382,29 +538,9 @@ class OSDWeight(object):
         """
         Wait until PGs reach 0 or timeout expires
         """
-        i = 0
-        last_pgs = 0
-        while i < self.settings['timeout']/self.settings['delay']:
-            entry = self.osd_df()
-            if 'pgs' in entry:
-                if entry['pgs'] == 0:
-                    log.info("osd.{} has no PGs".format(self.osd_id))
-                    return ""
-                else:
-                    log.warn("osd.{} has {} PGs remaining".format(self.osd_id, entry['pgs']))
-                    if last_pgs != entry['pgs']:
-                        # Making progress, reset countdown
-                        i = 0
-                        last_pgs = entry['pgs']
-            else:
-                msg = "osd.{} does not exist".format(self.osd_id)
-                log.warn(msg)
-                return msg
-            i += 1
-            time.sleep(self.settings['delay'])
-
-        log.debug("Timeout expired")
-        raise RuntimeError("Timeout expired")
+        drain = OSDDrain([self.osd_id], self.cluster,
+                         timeout=self.settings['timeout'], delay=self.settings['delay'])
+        return drain.wait()[int(self.osd_id)]
 
 
 def _settings(**kwargs):
@@ -443,6 +579,18 @@ def zero_weight(osd_id, wait=True, **kwargs):
         return ""
 
 
+def wait_empty(osd_ids, **kwargs):
+    """
+    Wait until the PGs are moved off all the OSDs, polling the cluster once
+    per interval
+    """
+    settings = _settings(**kwargs)
+    osdweight = OSDWeight(osd_ids[0], **settings)
+    drain = OSDDrain(osd_ids, osdweight.cluster, timeout=osdweight.settings['timeout'],
+                     delay=osdweight.settings['delay'])
+    return drain.wait()
+
+
 def restore_weight(osd_id, **kwargs):
     """
     Restore the previous setting for an OSD if possible
@@ -459,16 +607,23 @@ def _find_paths(device):
     Return matching pathnames, special case NVMe devices
     """
     if 'nvme' in device:
-        pathnames = glob.glob("{}p[0-9]*".format(device))
+        pattern = "{}p[0-9]*".format(device)
     else:
-        pathnames = glob.glob("{}[0-9]*".format(device))
-    return pathnames
+        pattern = "{}[0-9]*".format(device)
+    return list(_INVENTORY.lookup(('partitions', device), glob.glob, pattern))
 
 
 def readlink(device, follow=True):
     """
     Return the short name for a symlink device
     """
+    return _INVENTORY.lookup(('readlink', device, follow), _readlink, device, follow)
+
+
+def _readlink(device, follow):
+    """
+    Resolve a symlink with readlink
+    """
     option = ''
     if follow:
         option = '-f'
@@ -482,6 +637,14 @@ def readlink(device, follow=True):
     return result
 
 
+def _mine_disks():
+    """
+    Return the cephdisks.list mine data of this minion
+    """
+    return _INVENTORY.lookup(('mine',), lambda: __salt__['mine.get'](tgt=__grains__['id'],
+                                                                     fun='cephdisks.list'))
+
+
 # pylint: disable=too-many-instance-attributes
 class OSDConfig(object):
     """
@@ -563,7 +726,7 @@ class OSDConfig(object):
         """
         Return the bytes from the mine for this disk
         """
-        disks = __salt__['mine.get'](tgt=__grains__['id'], fun='cephdisks.list')
+        disks = _mine_disks()
         if disks:
             for disk in disks[__grains__['id']]:
                 if disk['Device File'] == self.device:
@@ -577,7 +740,7 @@ class OSDConfig(object):
         """
         Return the capacity from the mine for this disk
         """
-        disks = __salt__['mine.get'](tgt=__grains__['id'], fun='cephdisks.list')
+        disks = _mine_disks()
         if disks:
             for disk in disks[__grains__['id']]:
                 if disk['Device File'] == self.device:
@@ -680,7 +843,7 @@ class OSDConfig(object):
         Return the size of the journal.  Account for small disks.
         """
         if self.journal:
-            disks = __salt__['mine.get'](tgt=__grains__['id'], fun='cephdisks.list')
+            disks = _mine_disks()
             if disks:
                 for disk in disks[__grains__['id']]:
                     # Check size of journal disk
@@ -772,6 +935,7 @@ class OSDPartitions(object):
         if pathnames:
             cmd = "sgdisk -Z --clear -g {}".format(self.osd.device)
             _rc, _stdout, _stderr = _run(cmd)
+            _INVENTORY.invalidate()
             if _rc != 0:
                 raise RuntimeError("{} failed".format(cmd))
 
@@ -956,6 +1120,7 @@ class OSDPartitions(object):
                             "oflag=direct".format(device, number))
                 _run(wipe_cmd)
             index += 1
+        _INVENTORY.invalidate()
 
     def _part_probe(self, device):
         """
@@ -1036,7 +1201,7 @@ class OSDCommands(object):
         Check partition type
         """
         cmd = "/usr/sbin/sgdisk -i {} {}".format(_partition, device)
-        _, result, _ = _run(cmd)
+        _, result, _ = _INVENTORY.lookup(('sgdisk', device, _partition), _run, cmd)
         _id = "Partition GUID code: {}".format(self.osd.types[partition_type])
         return _id in result
 
@@ -1269,12 +1434,10 @@ class OSDCommands(object):
             return False
 
         pathname = None
-        with open("/proc/mounts", "r") as mounts:
-            for line in mounts:
-                entry = line.split()
-                if entry[0].startswith(self.osd.device):
-                    pathname = entry[1]
-                    break
+        for device, path in _mounts():
+            if device.startswith(self.osd.device):
+                pathname = path
+                break
 
         if pathname:
             filename = "{}/type".format(pathname)
@@ -1613,7 +1776,10 @@ def remove(osd_id, **kwargs):
     osdg = OSDGrains(osdd)
 
     osdr = OSDRemove(osd_id, osdd, osdw, osdg, **kwargs)
-    return osdr.remove()
+    try:
+        return osdr.remove()
+    finally:
+        _INVENTORY.invalidate()
 
 
 def is_empty(osd_id, **kwargs):
@@ -1686,15 +1852,13 @@ class OSDDevices(object):
         mount_dir = "{}/ceph-{}".format(self.pathname, self.osd_id)
         lockbox_dir = self._lockbox_dir()
         log.info("Checking /proc/mounts for {}".format(mount_dir))
-        with open("/proc/mounts", "r") as mounts:
-            for line in mounts:
-                entry = line.split()
-                if entry[1] == mount_dir:
-                    log.info("osd: {}".format(line))
-                    _partitions['osd'] = self._uuid_device(entry[0])
-                if entry[1] == lockbox_dir:
-                    log.info("lockbox: {}".format(line))
-                    _partitions['lockbox'] = self._uuid_device(entry[0])
+        for device, path in _mounts():
+            if path == mount_dir:
+                log.info("osd: {} {}".format(device, path))
+                _partitions['osd'] = self._uuid_device(device)
+            if path == lockbox_dir:
+                log.info("lockbox: {} {}".format(device, path))
+                _partitions['lockbox'] = self._uuid_device(device)
 
         for device_type in ['journal', 'block', 'block.db', 'block.wal', 'block_dmcrypt']:
             result = self._uuid_device("{}/{}".format(mount_dir, device_type))
@@ -1813,7 +1977,98 @@ def is_partitioned(device):
     return osdc.is_partitioned(device)
 
 
-def deploy():
+def _deploy_workers(workers=None):
+    """
+    Return the number of devices to prepare and activate at once
+    """
+    if workers is None:
+        workers = __pillar__.get('osd_deploy_workers', 1)
+    return max(int(workers), 1)
+
+
+def _deployment(config):
+    """
+    Return the device, the devices it shares and the prepare and activate
+    commands for a partitioned OSD.
+
+    The commands must be generated before another OSD is partitioned since
+    they refer to the last partitions created on the journal, wal and db
+    devices.
+    """
+    osdc = OSDCommands(config)
+    shared = set([config.journal, config.wal, config.db]) - set([None, False, config.device])
+    return {'device': config.device,
+            'shared': shared,
+            'prepare': osdc.prepare(),
+            'activate': osdc.activate()}
+
+
+def _deployment_batches(pending):
+    """
+    Group the deployments that share a journal, wal or db device.  ceph-disk
+    creates partitions on these devices, so the deployments of a batch
+    run one after another.
+    """
+    batches = []
+    for index, deployment in enumerate(pending):
+        merged = [(index, deployment)]
+        devices = set(deployment['shared'])
+        for batch in list(batches):
+            if devices & batch['devices']:
+                batches.remove(batch)
+                merged.extend(batch['deployments'])
+                devices |= batch['devices']
+        batches.append({'deployments': sorted(merged, key=lambda entry: entry[0]),
+                        'devices': devices})
+    return [[deployment for _, deployment in batch['deployments']] for batch in batches]
+
+
+def _deploy_batch(batch):
+    """
+    Prepare and activate each OSD of the batch in order
+    """
+    results = []
+    for deployment in batch:
+        start = time.time()
+        prepare_rc, _stdout, _stderr = _run(deployment['prepare'])
+        activate_rc, _stdout, _stderr = _run(deployment['activate'])
+        elapsed = round(time.time() - start, 2)
+        log.info("Deployed {} in {}s: prepare {} activate {}".format(
+            deployment['device'], elapsed, prepare_rc, activate_rc))
+        results.append((deployment['device'], {'prepare': prepare_rc,
+                                               'activate': activate_rc,
+                                               'seconds': elapsed}))
+    return results
+
+
+def _deploy_all(pending, workers=None):
+    """
+    Run the prepare and activate commands with up to workers batches at once.
+    Return the results per device.
+    """
+    workers = _deploy_workers(workers)
+    batches = _deployment_batches(pending)
+    start = time.time()
+    if workers == 1 or len(batches) < 2:
+        batch_results = [_deploy_batch(batch) for batch in batches]
+    else:
+        pool = multiprocessing.dummy.Pool(min(workers, len(batches)))
+        try:
+            batch_results = pool.map(_deploy_batch, batches)
+        finally:
+            pool.close()
+            pool.join()
+    _INVENTORY.invalidate()
+    results = {}
+    for batch_result in batch_results:
+        results.update(batch_result)
+    if results:
+        log.info("Deployed {} OSDs in {} batches with {} workers in {:.2f}s".format(
+            len(results), len(batches), workers, time.time() - start))
+    return results
+
+
+def deploy(workers=None):
     """
     Partition, prepare and activate an OSD.
 
@@ -1837,52 +2092,75 @@ def deploy():
 
     The last idea is converting all of this into a state module that returns
     all the commands in the comment.
+
+    All devices are partitioned first, one at a time, and the prepare and
+    activate commands are generated right after each device is partitioned.
+    The commands then run on up to workers devices at once.  The number of
+    workers defaults to the pillar setting osd_deploy_workers or 1.
+
+    Returns the per device return codes and elapsed seconds.
     """
-    for device in configured():
-        if not is_prepared(device):
-            config = OSDConfig(device)
-            osdp = OSDPartitions(config)
-            osdp.clean()
-            osdp.partition()
-            osdc = OSDCommands(config)
-            _run(osdc.prepare())
-            _run(osdc.activate())
+    with _INVENTORY.snapshot():
+        pending = []
+        for device in configured():
+            if not is_prepared(device):
+                config = OSDConfig(device)
+                osdp = OSDPartitions(config)
+                osdp.clean()
+                osdp.partition()
+                pending.append(_deployment(config))
+        return _deploy_all(pending, workers)
 
 
-def redeploy(simultaneous=False):
+def redeploy(simultaneous=False, workers=None):
     """
     Empty all PGs in parallel initially if necessary.  Then remove and
     recreate each OSD that does not match its configuration.
-    """
-    if simultaneous:
+
+    With a single worker, each OSD is recreated before the next one is
+    removed.  Otherwise, all OSDs are removed and partitioned first and then
+    prepared and activated in parallel as in deploy.
+    """
+    with _INVENTORY.snapshot():
+        workers = _deploy_workers(workers)
+        if simultaneous:
+            emptying = []
+            for _id in __grains__['ceph']:
+                _part = _partition(_id)
+                log.info("Partition: {}".format(_part))
+                disk, _ = split_partition(_part)
+                log.info("ID: {}".format(_id))
+                log.info("Disk: {}".format(disk))
+                if is_incorrect(disk):
+                    if zero_weight(_id, wait=False) == "":
+                        emptying.append(_id)
+            if emptying:
+                wait_empty(emptying)
+
+        results = {}
+        pending = []
         for _id in __grains__['ceph']:
             _part = _partition(_id)
+            # if 'lockbox' in __grains__['ceph'][_id]['partitions']:
+            #     partition = __grains__['ceph'][_id]['partitions']['lockbox']
+            # else:
+            #     partition = __grains__['ceph'][_id]['partitions']['osd']
             log.info("Partition: {}".format(_part))
             disk, _ = split_partition(_part)
             log.info("ID: {}".format(_id))
             log.info("Disk: {}".format(disk))
-            if is_incorrect(disk):
-                zero_weight(_id, wait=False)
-
-    for _id in __grains__['ceph']:
-        _part = _partition(_id)
-        # if 'lockbox' in __grains__['ceph'][_id]['partitions']:
-        #     partition = __grains__['ceph'][_id]['partitions']['lockbox']
-        # else:
-        #     partition = __grains__['ceph'][_id]['partitions']['osd']
-        log.info("Partition: {}".format(_part))
-        disk, _ = split_partition(_part)
-        log.info("ID: {}".format(_id))
-        log.info("Disk: {}".format(disk))
-        if not os.path.exists(_part) or is_incorrect(disk):
-            remove(_id)
-            config = OSDConfig(disk)
-            osdp = OSDPartitions(config)
-            osdp.partition()
-            osdc = OSDCommands(config)
-            _run(osdc.prepare())
-            _run(osdc.activate())
-            # not is_prepared(disk)):
+            if not os.path.exists(_part) or is_incorrect(disk):
+                remove(_id)
+                config = OSDConfig(disk)
+                osdp = OSDPartitions(config)
+                osdp.partition()
+                # not is_prepared(disk)):
+                if workers == 1:
+                    results.update(_deploy_all([_deployment(config)], workers))
+                else:
+                    pending.append(_deployment(config))
+        results.update(_deploy_all(pending, workers))
+        return results
 
 
 def _partition(osd_id):
@@ -1904,17 +2182,19 @@ def is_prepared(device):
     to debug that configuration without reading python?  This task is left for
     later...
     """
-    config = OSDConfig(device)
-    osdc = OSDCommands(config)
-    if osdc.highest_partition(readlink(device), 'lockbox') != 0:
-        log.debug("Found encrypted OSD {}".format(device))
-        return True
-    _partition = osdc.highest_partition(readlink(device), 'osd', nvme_partition=False)
-    if _partition == 0:
-        log.debug("Do not know which partition to check on {}".format(device))
-        return False
-    log.debug("Checking partition {} on device {}".format(_partition, device))
-    return osdc.is_partition('osd', config.device, _partition) and _fsck(config.device, _partition)
+    with _INVENTORY.snapshot():
+        config = OSDConfig(device)
+        osdc = OSDCommands(config)
+        if osdc.highest_partition(readlink(device), 'lockbox') != 0:
+            log.debug("Found encrypted OSD {}".format(device))
+            return True
+        _partition = osdc.highest_partition(readlink(device), 'osd', nvme_partition=False)
+        if _partition == 0:
+            log.debug("Do not know which partition to check on {}".format(device))
+            return False
+        log.debug("Checking partition {} on device {}".format(_partition, device))
+        return (osdc.is_partition('osd', config.device, _partition) and
+                _fsck(config.device, _partition))
 
 
 def _fsck(device, _partition):
@@ -1942,16 +2222,16 @@ def is_activated(device):
     """
     Check if the device has already been activated.  Return shell command.
     """
-    config = OSDConfig(device)
-    osdc = OSDCommands(config)
-    _partition = osdc.highest_partition(readlink(device), 'osd')
-    pathname = "{}{}".format(config.device, _partition)
-    log.info("Checking /proc/mounts for {}".format(pathname))
-    with open("/proc/mounts", "r") as mounts:
-        for line in mounts:
-            if line.startswith(pathname):
+    with _INVENTORY.snapshot():
+        config = OSDConfig(device)
+        osdc = OSDCommands(config)
+        _partition = osdc.highest_partition(readlink(device), 'osd')
+        pathname = "{}{}".format(config.device, _partition)
+        log.info("Checking /proc/mounts for {}".format(pathname))
+        for mounted, _ in _mounts():
+            if mounted.startswith(pathname):
                 return "/bin/true"
-    return "/bin/false"
+        return "/bin/false"
 
 
 def prepare(device):
@@ -1962,18 +2242,20 @@ def prepare(device):
     give the desired results since the evaluation of the prepare command (and
     the partition check) occurs prior to creating the partitions
     """
-    config = OSDConfig(device)
-    osdc = OSDCommands(config)
-    return osdc.prepare()
+    with _INVENTORY.snapshot():
+        config = OSDConfig(device)
+        osdc = OSDCommands(config)
+        return osdc.prepare()
 
 
 def activate(device):
     """
     Return ceph-disk command to activate OSD.
     """
-    config = OSDConfig(device)
-    osdc = OSDCommands(config)
-    return osdc.activate()
+    with _INVENTORY.snapshot():
+        config = OSDConfig(device)
+        osdc = OSDCommands(config)
+        return osdc.activate()
 
 
 def detect(osd_id):
@@ -1987,26 +2269,29 @@ def is_incorrect(device):
     """
     Returns if the OSD does not match the desired configuration
     """
-    config = OSDConfig(device)
-    osdc = OSDCommands(config)
-    return osdc.is_incorrect()
+    with _INVENTORY.snapshot():
+        config = OSDConfig(device)
+        osdc = OSDCommands(config)
+        return osdc.is_incorrect()
 
 
 def partitions(osd_id):
     """
     List the related partitions to an OSD
     """
-    osdd = OSDDevices()
-    return osdd.partitions(osd_id)
+    with _INVENTORY.snapshot():
+        osdd = OSDDevices()
+        return osdd.partitions(osd_id)
 
 
 def retain():
     """
     Save the OSD partitions in the local grains
     """
-    osdd = OSDDevices()
-    osdg = OSDGrains(osdd)
-    return osdg.retain()
+    with _INVENTORY.snapshot():
+        osdd = OSDDevices()
+        osdg = OSDGrains(osdd)
+        return osdg.retain()
 
 
 def report(failhard=False):
@@ -2015,70 +2300,71 @@ def report(failhard=False):
 
     Note: this needs more bullet proofing
     """
-    if 'ceph' not in __grains__:
-        return "No ceph grain available.  Run osd.retain"
-    active = []
-    unmounted = []
-    for _id in __grains__['ceph']:
-        _partition = readlink(__grains__['ceph'][_id]['partitions']['osd'])
-        disk, _ = split_partition(_partition)
-        active.append(disk)
-        log.debug("checking /var/lib/ceph/osd/ceph-{}/fsid".format(_id))
-        if not os.path.exists("/var/lib/ceph/osd/ceph-{}/fsid".format(_id)):
-            unmounted.append(disk)
-        if 'lockbox' in __grains__['ceph'][_id]['partitions']:
-            _partition = readlink(__grains__['ceph'][_id]['partitions']['lockbox'])
+    with _INVENTORY.snapshot():
+        if 'ceph' not in __grains__:
+            return "No ceph grain available.  Run osd.retain"
+        active = []
+        unmounted = []
+        for _id in __grains__['ceph']:
+            _partition = readlink(__grains__['ceph'][_id]['partitions']['osd'])
             disk, _ = split_partition(_partition)
             active.append(disk)
-
-    log.debug("active: {}".format(active))
-
-    if 'ceph' in __pillar__:
-        unconfigured = __pillar__['ceph']['storage']['osds'].keys()
-        changed = list(unconfigured)
-        for osd in __pillar__['ceph']['storage']['osds'].keys():
-            if readlink(osd) in active:
-                unconfigured.remove(osd)
-                if not is_incorrect(readlink(osd)):
+            log.debug("checking /var/lib/ceph/osd/ceph-{}/fsid".format(_id))
+            if not os.path.exists("/var/lib/ceph/osd/ceph-{}/fsid".format(_id)):
+                unmounted.append(disk)
+            if 'lockbox' in __grains__['ceph'][_id]['partitions']:
+                _partition = readlink(__grains__['ceph'][_id]['partitions']['lockbox'])
+                disk, _ = split_partition(_partition)
+                active.append(disk)
+
+        log.debug("active: {}".format(active))
+
+        if 'ceph' in __pillar__:
+            unconfigured = __pillar__['ceph']['storage']['osds'].keys()
+            changed = list(unconfigured)
+            for osd in __pillar__['ceph']['storage']['osds'].keys():
+                if readlink(osd) in active:
+                    unconfigured.remove(osd)
+                    if not is_incorrect(readlink(osd)):
+                        log.debug("Removed from changed {}".format(osd))
+                        changed.remove(osd)
+                else:
                     log.debug("Removed from changed {}".format(osd))
                     changed.remove(osd)
-            else:
-                log.debug("Removed from changed {}".format(osd))
-                changed.remove(osd)
-
-    log.debug("changed: {}".format(active))
-
-    if 'storage' in __pillar__:
-        unconfigured = __pillar__['storage']['osds']
-        for _dj in __pillar__['storage']['data+journals']:
-            unconfigured.append(*_dj.keys())
-        log.info("unconfigured: {}".format(unconfigured))
-        changed = list(unconfigured)
-        osds = list(unconfigured)
-        for osd in osds:
-            if readlink(osd) in active:
-                unconfigured.remove(osd)
-                if not is_incorrect(readlink(osd)):
+
+        log.debug("changed: {}".format(active))
+
+        if 'storage' in __pillar__:
+            unconfigured = __pillar__['storage']['osds']
+            for _dj in __pillar__['storage']['data+journals']:
+                unconfigured.append(*_dj.keys())
+            log.info("unconfigured: {}".format(unconfigured))
+            changed = list(unconfigured)
+            osds = list(unconfigured)
+            for osd in osds:
+                if readlink(osd) in active:
+                    unconfigured.remove(osd)
+                    if not is_incorrect(readlink(osd)):
+                        log.debug("Removed from changed {}".format(osd))
+                        changed.remove(osd)
+                else:
                     log.debug("Removed from changed {}".format(osd))
                     changed.remove(osd)
+
+        if unconfigured or changed or unmounted:
+            msg = ""
+            if unconfigured:
+                msg += "No OSD configured for \n{}\n".format("\n".join(unconfigured))
+            if changed:
+                msg += "Different configuration for \n{}\n".format("\n".join(changed))
+            if unmounted:
+                msg += "No OSD mounted for \n{}\n".format("\n".join(unmounted))
+            if failhard:
+                raise RuntimeError(msg)
             else:
-                log.debug("Removed from changed {}".format(osd))
-                changed.remove(osd)
-
-    if unconfigured or changed or unmounted:
-        msg = ""
-        if unconfigured:
-            msg += "No OSD configured for \n{}\n".format("\n".join(unconfigured))
-        if changed:
-            msg += "Different configuration for \n{}\n".format("\n".join(changed))
-        if unmounted:
-            msg += "No OSD mounted for \n{}\n".format("\n".join(unmounted))
-        if failhard:
-            raise RuntimeError(msg)
+                return msg
         else:
-            return msg
-    else:
-        return "All configured OSDs are active"
+            return "All configured OSDs are active"
 
 
 __func_alias__ = {
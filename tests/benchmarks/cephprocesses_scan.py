@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of cephprocesses.check on a dense storage node
+
+Writes a synthetic /proc tree with a few thousand processes, among them the
+ceph-osd daemons and the daemons of several other roles, and times the
+check of all roles.  The single pass scan is compared with a scan per role
+that reads the name, the owner and the user name of every process, like
+the former psutil based check.
+
+    python -m tests.benchmarks.cephprocesses_scan [--processes 4000] [--osds 60]
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import os
+import pwd
+import shutil
+import tempfile
+import time
+
+from mock import patch
+
+from srv.salt._modules import cephprocesses
+
+ROLES = ['mon', 'mgr', 'storage', 'mds', 'rgw', 'ganesha']
+DAEMONS = [['/usr/bin/ceph-mon', '-f', '--id', 'node1'],
+           ['/usr/bin/ceph-mgr', '-f', '--id', 'node1'],
+           ['/usr/bin/ceph-mds', '-f', '--id', 'node1'],
+           ['/usr/bin/radosgw', '-f', '--name', 'client.rgw.node1'],
+           ['/usr/bin/ganesha.nfsd', '-F'],
+           ['/sbin/rpcbind', '-w'],
+           ['/usr/sbin/rpc.statd', '--no-notify']]
+
+
+def synthetic_proc(root, processes, osds):
+    """
+    Write a /proc tree with the cmdline, comm and status of every process
+    """
+    commands = list(DAEMONS)
+    commands.extend(['/usr/bin/ceph-osd', '-f', '--cluster', 'ceph', '--id', str(osd_id)]
+                    for osd_id in range(osds))
+    while len(commands) < processes:
+        commands.append(['/usr/bin/worker{}'.format(len(commands) % 50), '--serve'])
+    for pid, cmdline in enumerate(commands, 1000):
+        path = os.path.join(root, str(pid))
+        os.mkdir(path)
+        with open(os.path.join(path, 'cmdline'), 'w') as cmdline_file:
+            cmdline_file.write('\0'.join(cmdline) + '\0')
+        with open(os.path.join(path, 'comm'), 'w') as comm_file:
+            comm_file.write(os.path.basename(cmdline[0])[:15] + '\n')
+        with open(os.path.join(path, 'status'), 'w') as status_file:
+            status_file.write('Name:\t{}\nUid:\t0\t0\t0\t0\n'.format(
+                os.path.basename(cmdline[0])[:15]))
+
+
+def per_role(root):
+    """
+    Scan every process once per role, reading its name, owner and user name
+    """
+    up = {}
+    for role in ROLES:
+        for pid in os.listdir(root):
+            path = os.path.join(root, pid)
+            with open(os.path.join(path, 'cmdline')) as cmdline_file:
+                name = os.path.basename(cmdline_file.read().split('\0')[0])
+            with open(os.path.join(path, 'status')) as status_file:
+                uid = int(status_file.read().split('Uid:\t')[1].split('\t')[0])
+            pwd.getpwuid(uid)
+            if name in cephprocesses.processes[role]:
+                up.setdefault(name, []).append(int(pid))
+    return up
+
+
+def single_pass(root, osds):
+    """
+    Run cephprocesses.check against the synthetic tree
+    """
+    with patch.object(cephprocesses, 'PROC', root), \
+            patch.object(cephprocesses, '__pillar__', {'roles': ROLES}, create=True), \
+            patch.object(cephprocesses, '__salt__',
+                         {'osd.list': lambda: [str(osd_id) for osd_id in range(osds)]},
+                         create=True):
+        return cephprocesses.check(results=True)
+
+
+def main():
+    """
+    Time both scans
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=4000)
+    parser.add_argument('--osds', type=int, default=60)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='proc')
+    try:
+        synthetic_proc(root, args.processes, args.osds)
+        for name, scan in [('per role', lambda: per_role(root)),
+                           ('single pass', lambda: single_pass(root, args.osds))]:
+            start = time.time()
+            for _ in range(args.repeat):
+                result = scan()
+            elapsed = (time.time() - start) / args.repeat
+            print("{:12} {:8.1f} ms".format(name, elapsed * 1000))
+        print("{} processes, {} OSDs up, down: {}".format(
+            args.processes, len(result['osds']), result['down']))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the network proposal of populate.CephRoles
+
+Builds the network discovery results of a synthetic cluster of 2000 minions
+spread over racks, each rack with its own public and cluster subnet, and
+times the public/cluster network proposal and the public address lookup of
+every minion.  The prefix index is compared with a linear scan over all
+networks.
+
+    python -m tests.benchmarks.populate_networks [--minions 2000] [--racks 64]
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import random
+import time
+
+import ipaddress
+from mock import patch, MagicMock
+
+from srv.modules.runners import populate
+
+
+class LinearIndex(populate.NetworkIndex):
+    """
+    Compare every address with every network
+    """
+
+    def __init__(self, networks):
+        # pylint: disable=super-init-not-called
+        self.networks = list(networks)
+
+    def containing(self, address):
+        address = ipaddress.ip_address(u'{}'.format(address))
+        return [network for network in self.networks if address in network]
+
+
+def discovery(minions, racks, seed=0):
+    """
+    Return the results of the discovery broadcast for a synthetic cluster
+    """
+    rnd = random.Random(seed)
+    results = {}
+    for index in range(minions):
+        rack = index % racks
+        host = index // racks % 60 + 2
+        public = '10.{}.{}.{}'.format(rack // 4, rack % 4 * 64, host)
+        addresses = [public, '172.16.{}.{}'.format(rack, host)]
+        if rnd.random() < 0.2:
+            addresses.append('192.168.{}.{}'.format(rnd.randint(0, 3), rnd.randint(1, 254)))
+        interfaces = {'lo': {'inet': [{'address': '127.0.0.1', 'netmask': '255.0.0.0'}]}}
+        for nic, address in enumerate(addresses):
+            netmask = '255.255.255.192' if address == public else '255.255.255.0'
+            interfaces['eth{}'.format(nic)] = {'inet': [{'address': address,
+                                                         'netmask': netmask}]}
+        results['node{:05d}.ceph'.format(index)] = {
+            'network.interfaces': interfaces,
+            'cmd.run': public,
+            'grains.get': ['127.0.0.1'] + addresses,
+            'pillar.get': 'node00000.ceph'}
+    return results
+
+
+def run(results, index_class):
+    """
+    Propose the networks and return the timing, broadcasts and proposal
+    """
+    with patch('salt.client.LocalClient') as localclient, \
+            patch.object(populate.deepsea_minions, 'DeepseaMinions'), \
+            patch.object(populate, 'NetworkIndex', index_class):
+        localclient.return_value.cmd.return_value = results
+        start = time.time()
+        roles = populate.CephRoles(MagicMock(root_dir='/tmp'), 'ceph', sorted(results),
+                                   MagicMock())
+        for server in roles.servers:
+            roles._public_interface(server)
+        elapsed = time.time() - start
+    return elapsed, localclient.return_value.cmd.call_count, roles
+
+
+def main():
+    """
+    Time both lookups and print a summary
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--minions', type=int, default=2000)
+    parser.add_argument('--racks', type=int, default=64)
+    args = parser.parse_args()
+
+    results = discovery(args.minions, args.racks)
+    proposals = []
+    print("{} minions, {} racks".format(args.minions, args.racks))
+    for name, index_class in [('linear', LinearIndex), ('indexed', populate.NetworkIndex)]:
+        elapsed, broadcasts, roles = run(results, index_class)
+        proposals.append((roles.public_networks, roles.cluster_networks))
+        print("{:8} {:.3f}s  broadcasts: {}  public: {}  cluster: {}".format(
+            name, elapsed, broadcasts, len(roles.public_networks),
+            len(roles.cluster_networks)))
+    assert proposals[0] == proposals[1]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the pillar stack ext_pillar
+
+Builds a synthetic stack tree for a cluster of 1000 minions, laid out like
+the one created by stage 2, and times a pillar refresh of every minion with
+and without the stack cache.  Each mode runs in its own process so that the
+peak memory is measured separately.
+
+    python -m tests.benchmarks.stack_pillar [--minions 1000]
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import imp
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+STACK_PY = os.path.join(os.path.dirname(__file__), '..', '..', 'srv', 'modules', 'pillar', 'stack.py')
+STACK_CFG = os.path.join(os.path.dirname(__file__), '..', '..', 'srv', 'pillar', 'ceph', 'stack',
+                         'stack.cfg')
+ROLES = ['master', 'admin', 'mon', 'mgr', 'storage', 'mds', 'rgw', 'igw', 'ganesha']
+
+
+def _write(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as yml:
+        yaml.safe_dump(data, yml, default_flow_style=False)
+
+
+def _roles(index):
+    return [ROLES[2 + index % 3], 'storage'] if index % 10 else ['storage']
+
+
+def build_tree(basedir, minions):
+    """
+    Create the stack.cfg and yml files of a synthetic cluster
+    """
+    shutil.copy(STACK_CFG, os.path.join(basedir, 'stack.cfg'))
+    _write(os.path.join(basedir, 'default', 'global.yml'),
+           dict(('setting_{}'.format(idx), {'value': idx, 'enabled': True,
+                                            'items': range(10)})
+                for idx in range(50)))
+    _write(os.path.join(basedir, 'default', 'ceph', 'cluster.yml'),
+           {'fsid': '00000000-0000-0000-0000-000000000000',
+            'public_network': '10.0.0.0/16',
+            'cluster_network': '10.1.0.0/16',
+            'mon_host': ['10.0.0.{}'.format(idx) for idx in range(1, 4)],
+            'available_roles': ROLES})
+    for role in ROLES:
+        _write(os.path.join(basedir, 'default', 'ceph', 'roles', '{}.yml'.format(role)),
+               {'{}_settings'.format(role): dict(('key_{}'.format(idx), idx)
+                                                 for idx in range(50))})
+    _write(os.path.join(basedir, 'global.yml'), {'time_server': 'admin.ceph'})
+    for index in range(minions):
+        minion = 'node{:04d}.ceph'.format(index)
+        _write(os.path.join(basedir, 'default', 'ceph', 'minions', '{}.yml'.format(minion)),
+               {'public_address': '10.0.{}.{}'.format(index / 250, index % 250),
+                'ceph': {'storage': {'osds': dict(('/dev/sd{}'.format(chr(97 + disk)),
+                                                   {'format': 'bluestore'})
+                                                  for disk in range(12))}}})
+
+
+def run(basedir, minions, cached, refreshes):
+    """
+    Refresh the pillar of every minion and return the timings and peak memory
+    """
+    stack = imp.load_source('stack', STACK_PY)
+    stack.__opts__ = {}
+    stack.__salt__ = {}
+    stack.__grains__ = {}
+    stack._CACHE.enabled = cached
+    cfg = os.path.join(basedir, 'stack.cfg')
+    timings = []
+    for _ in range(refreshes):
+        start = time.time()
+        for index in range(minions):
+            minion = 'node{:04d}.ceph'.format(index)
+            stack.ext_pillar(minion, {'cluster': 'ceph', 'roles': _roles(index)}, cfg)
+        timings.append(time.time() - start)
+    return {'timings': timings,
+            'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def main():
+    """
+    Build the tree, run both modes in separate processes and print a summary
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--minions', type=int, default=1000)
+    parser.add_argument('--refreshes', type=int, default=2)
+    parser.add_argument('--mode', choices=['uncached', 'cached'])
+    parser.add_argument('--basedir')
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run(args.basedir, args.minions, args.mode == 'cached',
+                             args.refreshes)))
+        return
+
+    basedir = tempfile.mkdtemp(prefix='stack-bench-')
+    try:
+        build_tree(basedir, args.minions)
+        results = {}
+        for mode in ['uncached', 'cached']:
+            output = subprocess.check_output(
+                [sys.executable, '-m', 'tests.benchmarks.stack_pillar', '--mode', mode,
+                 '--basedir', basedir, '--minions', str(args.minions),
+                 '--refreshes', str(args.refreshes)])
+            results[mode] = json.loads(output.splitlines()[-1])
+    finally:
+        shutil.rmtree(basedir)
+
+    print("{} minions, {} refreshes".format(args.minions, args.refreshes))
+    for mode in ['uncached', 'cached']:
+        print("{:9}  refresh: {}  peak memory: {:.1f} MiB".format(
+            mode, " ".join("{:.2f}s".format(timing) for timing in results[mode]['timings']),
+            results[mode]['maxrss'] / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
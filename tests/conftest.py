@@ -0,0 +1,11 @@
+import pytest
+from srv.modules.runners import deepsea_minions
+
+
+@pytest.fixture(autouse=True)
+def deepsea_minions_cache(tmpdir, monkeypatch):
+    """
+    Keep the resolved deepsea_minions target of each test to itself
+    """
+    monkeypatch.setattr(deepsea_minions.DeepseaMinions, 'CACHE_FILE',
+                        str(tmpdir.join('deepsea_minions.json')))
@@ -166,7 +166,7 @@ class TestHardwareDetections():
         po.return_value.stdout = output_helper.smartctl_spinner_valid['stdout']
         expect = output_helper.smartctl_spinner_valid['expected_return']
         out = hwd._query_disktype('sda', {'controller_name': 'megaraid'}, 'base')
-        assert expect, out
+        assert (expect, True) == out
 
     @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._which')
     @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._return_device_bus_id')
@@ -179,7 +179,7 @@ class TestHardwareDetections():
         po.return_value.stdout = output_helper.smartctl_solid_state_valid['stdout']
         expect = output_helper.smartctl_solid_state_valid['expected_return']
         out = hwd._query_disktype('sdn', {'controller_name': 'megaraid'}, 'base')
-        assert expect == out 
+        assert (expect, True) == out
 
     @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._which')
     @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._return_device_bus_id')
@@ -193,6 +193,7 @@ class TestHardwareDetections():
         po.return_value.stdout = output_helper.smartctl_invalid['stdout']
         out = hwd._query_disktype('sdn', {'controller_name': 'megaraid'}, 'base')
         assert ir.called
+        assert out == (ir.return_value, False)
 
     @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._which')
     @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._return_device_bus_id')
@@ -206,7 +207,7 @@ class TestHardwareDetections():
         po.return_value.stdout = output_helper.smartctl_invalid['stdout']
         out = hwd._query_disktype('sdn', {'controller_name': 'megaraid'}, 'base')
         expect = output_helper.smartctl_invalid['expected_return']
-        assert expect == out
+        assert (expect, True) == out
 
 
     @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._which')
@@ -216,8 +217,9 @@ class TestHardwareDetections():
         """ Assume ret_bus_id False """
         wm.return_value = '/valid/path'
         ret_bus_id.return_value = False
-        hwd._query_disktype('sdn', {'controller_name': 'megaraid'}, 'base')
+        out = hwd._query_disktype('sdn', {'controller_name': 'megaraid'}, 'base')
         assert ir.called is True
+        assert out[1] is False
 
     @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._which')
     @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._return_device_bus_id')
@@ -228,8 +230,9 @@ class TestHardwareDetections():
         wm.return_value = '/valid/path'
         ret_bus_id.return_value = True
         po.side_effect = StandardError
-        hwd._query_disktype('sdn', {'controller_name': 'megaraid'}, 'base')
+        out = hwd._query_disktype('sdn', {'controller_name': 'megaraid'}, 'base')
         assert ir.called is True
+        assert out[1] is False
     
     @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._hw_raid_ctrl_detection')
     def test_hw_raid_ctrl_detection_custom_hwraid(self, hw_raid_detection):
@@ -402,3 +405,102 @@ class TestHardwareDetections_2():
     def test_detection_tool_overwrite_lshw(self):
         hwd = cephdisks.HardwareDetections(detection_method='lshw')
         assert callable(hwd.detection_method) is True
+
+
+class TestProbing():
+    """
+    Test the concurrent S.M.A.R.T probing and its cache
+    """
+
+    @pytest.fixture()
+    def hwd(self, tmpdir):
+        with patch('srv.salt._modules.cephdisks.HardwareDetections._find_detection_tool'):
+            yield cephdisks.HardwareDetections(cache_file=str(tmpdir.join('cephdisks.json')),
+                                               smartctl_workers=4)
+
+    def _candidates(self):
+        return [('sd{}'.format(letter), 'base', {'Serial ID': 'SERIAL{}'.format(letter)})
+                for letter in 'abcd']
+
+    @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._lsscsi')
+    @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._query_disktype')
+    def test_probe_disktypes(self, query, lsscsi, hwd):
+        lsscsi.return_value = ['lines']
+        query.side_effect = lambda device, raid_ctrl, base, lines: \
+            ('0', True) if device == 'sda' else ('1', True)
+        candidates = self._candidates()
+        hwd._probe_disktypes(candidates, {'controller_name': 'megaraid'})
+        assert [hardware['rotational'] for _, _, hardware in candidates] == ['0', '1', '1', '1']
+        assert query.call_count == 4
+        lsscsi.assert_called_once()
+        for call in query.call_args_list:
+            assert call[0][3] == ['lines']
+
+    @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._lsscsi')
+    @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._query_disktype')
+    def test_probe_disktypes_cached(self, query, lsscsi, hwd):
+        query.return_value = ('0', True)
+        hwd._probe_disktypes(self._candidates(), {'controller_name': 'megaraid'})
+        query.reset_mock()
+        lsscsi.reset_mock()
+
+        candidates = self._candidates()
+        candidates.append(('sde', 'base', {'Serial ID': 'NEW'}))
+        hwd._probe_disktypes(candidates, {'controller_name': 'megaraid'})
+        assert query.call_count == 1
+        assert query.call_args[0][0] == 'sde'
+        assert [hardware['rotational'] for _, _, hardware in candidates] == ['0'] * 5
+
+    @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._lsscsi')
+    @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._query_disktype')
+    def test_probe_disktypes_refresh(self, query, lsscsi, hwd):
+        query.return_value = ('0', True)
+        hwd._probe_disktypes(self._candidates(), {'controller_name': 'megaraid'})
+        hwd.refresh = True
+        hwd._probe_disktypes(self._candidates(), {'controller_name': 'megaraid'})
+        assert query.call_count == 8
+
+    @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._lsscsi')
+    @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._query_disktype')
+    def test_probe_disktypes_no_serial(self, query, lsscsi, hwd):
+        query.return_value = ('1', True)
+        hwd._probe_disktypes([('sda', 'base', {})], {'controller_name': 'megaraid'})
+        hwd._probe_disktypes([('sda', 'base', {})], {'controller_name': 'megaraid'})
+        assert query.call_count == 2
+
+    @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._lsscsi')
+    @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._query_disktype')
+    def test_probe_disktypes_fallback(self, query, lsscsi, hwd):
+        """
+        Given smartctl did not answer for sdb
+        Expect sdb to use the legacy value now and to be probed again
+        """
+        query.side_effect = lambda device, raid_ctrl, base, lines: \
+            ('1', False) if device == 'sdb' else ('0', True)
+        candidates = self._candidates()
+        hwd._probe_disktypes(candidates, {'controller_name': 'megaraid'})
+        assert candidates[1][2]['rotational'] == '1'
+        query.reset_mock()
+
+        hwd._probe_disktypes(self._candidates(), {'controller_name': 'megaraid'})
+        assert query.call_count == 1
+        assert query.call_args[0][0] == 'sdb'
+
+    def test_load_cache_corrupt(self, hwd):
+        with open(hwd.cache_file, 'w') as cache_file:
+            cache_file.write('not json')
+        assert hwd._load_cache() == {}
+
+    @mock.patch('srv.salt._modules.cephdisks.HardwareDetections._which')
+    @mock.patch('srv.salt._modules.cephdisks.Popen')
+    def test_return_device_bus_id_shared_lsscsi(self, po, wm, hwd):
+        lsscsi = ['[0:2:6:0]  disk    DELL     PERC H700 2.10  /dev/sdg \n']
+        assert hwd._return_device_bus_id('sdg', lsscsi) == '6'
+        assert po.called is False
+
+    def test_which_cached(self, hwd):
+        with patch('srv.salt._modules.cephdisks.HardwareDetections._search_path') as search:
+            search.return_value = '/usr/bin/cat'
+            hwd._which('cat')
+            hwd._which('cat')
+            search.assert_called_once_with('cat')
@@ -0,0 +1,79 @@
+import os
+import pytest
+from mock import patch
+from srv.salt._modules import cephprocesses
+
+
+def _process(proc, pid, cmdline, comm=None):
+    entry = proc.mkdir(str(pid))
+    entry.join('cmdline').write('\0'.join(cmdline) + ('\0' if cmdline else ''))
+    entry.join('comm').write((comm or os.path.basename(cmdline[0])) + '\n')
+
+
+@pytest.fixture
+def proc(tmpdir):
+    root = tmpdir.mkdir('proc')
+    _process(root, 1, ['/usr/lib/systemd/systemd', '--switched-root'])
+    _process(root, 2, [], 'kthreadd')
+    _process(root, 100, ['/usr/bin/ceph-mon', '-f', '--cluster', 'ceph', '--id', 'mon1'])
+    _process(root, 101, ['/usr/bin/ceph-mgr', '-f', '--id', 'mon1'], 'exe')
+    _process(root, 200, ['/usr/bin/ceph-osd', '-f', '--cluster', 'ceph', '--id', '0'])
+    _process(root, 201, ['/usr/bin/ceph-osd', '-f', '--id=1'])
+    _process(root, 202, ['/usr/bin/ceph-osd', '-f', '-i', '3'])
+    root.join('self').write('')
+    with patch.object(cephprocesses, 'PROC', str(root)):
+        yield root
+
+
+class TestScan():
+
+    def test_names(self, proc):
+        pids, osds = cephprocesses._scan(set(['ceph-mgr', 'ceph-osd', 'kthreadd']))
+        assert sorted(pid for pid, _ in pids['ceph-osd']) == [200, 201, 202]
+        assert [pid for pid, _ in pids['ceph-mgr']] == [101]
+        assert [pid for pid, _ in pids['kthreadd']] == [2]
+        assert 'ceph-mon' not in pids
+        assert osds == {0: 200, 1: 201, 3: 202}
+
+    def test_osd_id(self):
+        assert cephprocesses._osd_id(['ceph-osd', '--id', '12']) == 12
+        assert cephprocesses._osd_id(['ceph-osd', '--id=7']) == 7
+        assert cephprocesses._osd_id(['ceph-osd', '--id']) is None
+        assert cephprocesses._osd_id(['ceph-mon', '--id', 'mon1']) is None
+
+
+class TestCheck():
+
+    def _check(self, assigned, osds, **kwargs):
+        with patch.object(cephprocesses, '__pillar__', {'roles': assigned}, create=True), \
+                patch.object(cephprocesses, '__salt__',
+                             {'osd.list': lambda: osds}, create=True):
+            return cephprocesses.check(**kwargs)
+
+    def test_up(self, proc):
+        result = self._check(['mon', 'mgr', 'storage'], ['0', '1', '3'], results=True)
+        assert result['down'] == []
+        assert result['up'] == {'ceph-mon': [100], 'ceph-mgr': [101],
+                                'ceph-osd': [200, 201, 202]}
+        assert result['osds'] == {0: 200, 1: 201, 3: 202}
+
+    def test_missing_osd(self, proc):
+        result = self._check(['storage'], ['0', '1', '2', '3'], results=True, quiet=True)
+        assert result['down'] == ['osd.2']
+        assert self._check(['storage'], ['0', '1', '2', '3'], quiet=True) is False
+
+    def test_missing_process(self, proc):
+        result = self._check(['mon', 'mds'], [], results=True, quiet=True)
+        assert result['down'] == ['ceph-mds']
+        assert result['up'] == {'ceph-mon': [100]}
+
+    def test_roles(self, proc):
+        assert self._check(['mon', 'mds'], [], roles=['mon']) is True
+
+    def test_openattic(self, proc):
+        _process(proc, 300, ['/usr/sbin/httpd-prefork', '-DFOREGROUND'])
+        with patch.object(cephprocesses, '_user', return_value='wwwrun'):
+            result = self._check(['openattic'], [], results=True, quiet=True)
+        assert result['down'] == ['httpd-prefork']
+        with patch.object(cephprocesses, '_user', return_value='openattic'):
+            assert self._check(['openattic'], []) is True
@@ -0,0 +1,129 @@
+import socket
+import sys
+import pytest
+from mock import patch
+from srv.salt._modules import multi
+
+
+FAKE_IPERF = """#!{python}
+import socket
+import sys
+import time
+
+args = sys.argv[1:]
+port = int([arg for arg in args if arg.startswith('-p')][0][2:])
+if '-s' in args:
+    time.sleep(0.2)
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(1)
+    time.sleep(3)
+else:
+    print("[  4]   0.00-10.00  sec  1.09 GBytes   938 Mbits/sec                  receiver")
+"""
+
+
+@pytest.fixture
+def iperf3(tmpdir):
+    fake = tmpdir.join('iperf3')
+    fake.write(FAKE_IPERF.format(python=sys.executable))
+    fake.chmod(0o755)
+    with patch.object(multi, 'IPERF_PATH', str(fake)):
+        yield str(fake)
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestIperf():
+
+    def test_servers_ready(self, iperf3):
+        """
+        Given a fake iperf3 that listens after a delay
+        Expect iperf_servers to return once every port listens
+        """
+        ports = [_free_port(), _free_port()]
+        result = multi.iperf_servers(*ports, timeout=10)
+        assert result == {'ready': ports, 'missing': []}
+        assert set(ports) <= multi._listening_ports()
+
+    def test_servers_timeout(self, tmpdir):
+        fake = tmpdir.join('iperf3')
+        fake.write('#!/bin/sh\nexit 0\n')
+        fake.chmod(0o755)
+        port = _free_port()
+        with patch.object(multi, 'IPERF_PATH', str(fake)):
+            result = multi.iperf_servers(port, timeout=0.3)
+        assert result == {'ready': [], 'missing': [port]}
+
+    def test_servers_not_installed(self):
+        with patch.object(multi, 'IPERF_PATH', None):
+            result = multi.iperf_servers(5200)
+        assert result['missing'] == [5200]
+        assert 'not found' in result['error']
+
+    def test_client(self, iperf3):
+        result = multi.iperf('10.0.0.1', 0, 5200)
+        assert result['succeeded']
+        assert result['filter'] == '938 Mbits/sec'
+
+
+def _icmp_permitted():
+    try:
+        multi._icmp_socket()[0].close()
+    except socket.error:
+        return False
+    return True
+
+
+class TestPingStats():
+
+    def test_latency(self):
+        stats = multi._latency([1.0, 3.0, 2.0, 8.0], 5)
+        assert stats['sent'] == 5
+        assert stats['received'] == 4
+        assert stats['loss'] == 20.0
+        assert stats['p50'] == 2.0
+        assert stats['p99'] == 8.0
+        assert stats['max'] == 8.0
+        assert stats['jitter'] == 3.0
+
+    def test_latency_lost(self):
+        stats = multi._latency([], 3)
+        assert stats['loss'] == 100.0
+        assert 'p50' not in stats
+
+    def test_percentile(self):
+        samples = range(1, 101)
+        assert multi._percentile(samples, 50) == 50
+        assert multi._percentile(samples, 99) == 99
+        assert multi._percentile([7], 99) == 7
+
+    def test_summary(self):
+        stats = {'a': multi._latency([1.0, 1.0], 2),
+                 'b': multi._latency([1.0, 2.0], 2),
+                 'c': multi._latency([9.0, 9.0], 2),
+                 'd': multi._latency([], 2)}
+        result = multi._summarize_stats(stats, ['e'])
+        assert result['succeeded'] == 3
+        assert result['failed'] == 'd'
+        assert result['errored'] == 'e'
+        assert result['slow'] == 'c'
+        assert result['latency']['p50'] == 1.0
+        assert result['latency']['p99'] == 9.0
+        assert result['latency']['loss'] == 25.0
+        assert result['worst'][0] == ['c', 9.0]
+        assert 'hosts' not in result
+
+    @pytest.mark.skipif(not _icmp_permitted(), reason="ICMP sockets are not permitted")
+    def test_loopback(self):
+        result = multi.ping_stats('127.0.0.1', count=5, interval=0.01, detail=True)
+        assert result['succeeded'] == 1
+        assert result['hosts']['127.0.0.1']['received'] == 5
+        assert result['latency']['loss'] == 0.0
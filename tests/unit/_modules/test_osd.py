@@ -117,6 +117,77 @@ class TestOSDInstanceMethods():
         pass
 
 
+class TestOSDInventory():
+
+    def test_lookup_without_snapshot(self):
+        inventory = osd.OSDInventory()
+        func = MagicMock(return_value='result')
+        inventory.lookup('key', func)
+        inventory.lookup('key', func)
+        assert func.call_count == 2
+
+    def test_lookup_with_snapshot(self):
+        inventory = osd.OSDInventory()
+        func = MagicMock(return_value='result')
+        with inventory.snapshot():
+            assert inventory.lookup('key', func, 'arg') == 'result'
+            assert inventory.lookup('key', func, 'arg') == 'result'
+        func.assert_called_once_with('arg')
+        assert inventory.cache == {}
+
+    def test_nested_snapshot(self):
+        inventory = osd.OSDInventory()
+        func = MagicMock(return_value='result')
+        with inventory.snapshot():
+            with inventory.snapshot():
+                inventory.lookup('key', func)
+            inventory.lookup('key', func)
+        func.assert_called_once()
+
+    def test_invalidate(self):
+        inventory = osd.OSDInventory()
+        func = MagicMock(return_value='result')
+        with inventory.snapshot():
+            inventory.lookup('key', func)
+            inventory.invalidate()
+            inventory.lookup('key', func)
+        assert func.call_count == 2
+
+    @mock.patch('srv.salt._modules.osd._read_mounts')
+    @mock.patch('srv.salt._modules.osd.glob')
+    def test_single_pass(self, glob, read_mounts):
+        glob.glob.return_value = ['/var/lib/ceph/osd/ceph-0', '/var/lib/ceph/osd/ceph-1']
+        read_mounts.return_value = [('/dev/sda1', '/var/lib/ceph/osd/ceph-0'),
+                                    ('/dev/nvme0n1p1', '/var/lib/ceph/osd/ceph-1'),
+                                    ('proc', '/proc')]
+        with osd._INVENTORY.snapshot():
+            assert osd.devices() == ['/dev/sda1', '/dev/nvme0n1p1']
+            assert osd.pairs() == [['/dev/sda', '/var/lib/ceph/osd/ceph-0'],
+                                   ['/dev/nvme0n1', '/var/lib/ceph/osd/ceph-1']]
+            assert osd.part_pairs() == [['/dev/sda1', '/var/lib/ceph/osd/ceph-0'],
+                                        ['/dev/nvme0n1p1', '/var/lib/ceph/osd/ceph-1']]
+        glob.glob.assert_called_once_with('/var/lib/ceph/osd/*')
+        read_mounts.assert_called_once()
+
+    @mock.patch('srv.salt._modules.osd._readlink')
+    def test_readlink_cached(self, _readlink):
+        _readlink.return_value = '/dev/sda'
+        with osd._INVENTORY.snapshot():
+            for _ in range(3):
+                assert osd.readlink('/dev/disk/by-id/wwn-0x1') == '/dev/sda'
+            osd.readlink('/dev/disk/by-id/wwn-0x1', follow=False)
+        assert _readlink.call_count == 2
+
+    @mock.patch('srv.salt._modules.osd._run')
+    def test_is_partition_cached(self, run):
+        run.return_value = (0, 'Partition GUID code: 4FBD7E29-9D25-41B8-AFD0-062C0CEFF05D', '')
+        obj = osd.OSDCommands(OSDConfig())
+        with osd._INVENTORY.snapshot():
+            assert obj.is_partition('osd', '/dev/sdx', 1)
+            assert not obj.is_partition('journal', '/dev/sdx', 1)
+        run.assert_called_once()
+
+
 @pytest.mark.skip(reason="Low priority: skipped")
 class TetstOSDState():
     pass
@@ -126,6 +197,74 @@ class TestOSDWeight():
     pass
 
 
+class TestOSDDrain():
+
+    def _cluster(self, *samples):
+        """
+        Return a cluster returning one osd df sample per call
+        """
+        import json
+        cluster = MagicMock()
+        cluster.mon_command.side_effect = [
+            (0, json.dumps({'nodes': [{'id': _id, 'pgs': pgs, 'crush_weight': 0}
+                                      for _id, pgs in sample.items()]}), '')
+            for sample in samples]
+        return cluster
+
+    @mock.patch('srv.salt._modules.osd.time')
+    def test_wait_all_empty(self, time_mock):
+        time_mock.time.side_effect = range(0, 1000, 10)
+        cluster = self._cluster({0: 20, 1: 10, 2: 5},
+                                {0: 10, 1: 0, 2: 5},
+                                {0: 0, 2: 0})
+        drain = osd.OSDDrain([0, '1', 2], cluster)
+        ret = drain.wait()
+        assert ret == {0: "", 1: "", 2: ""}
+        assert cluster.mon_command.call_count == 3
+
+    @mock.patch('srv.salt._modules.osd.time')
+    def test_wait_missing(self, time_mock):
+        time_mock.time.side_effect = range(0, 1000, 10)
+        cluster = self._cluster({0: 0})
+        ret = osd.OSDDrain([0, 5], cluster).wait()
+        assert ret == {0: "", 5: "osd.5 does not exist"}
+
+    @mock.patch('srv.salt._modules.osd.time')
+    def test_wait_eta(self, time_mock):
+        time_mock.time.side_effect = range(0, 1000, 10)
+        cluster = self._cluster({0: 100}, {0: 90}, {0: 5}, {0: 0})
+        drain = osd.OSDDrain([0], cluster, delay=6, max_delay=60)
+        drain.wait()
+        assert drain.status[0]['eta'] == 1
+        assert [call[0][0] for call in time_mock.sleep.call_args_list] == [6, 6, 1]
+
+    @mock.patch('srv.salt._modules.osd.time')
+    def test_wait_backoff(self, time_mock):
+        time_mock.time.side_effect = range(0, 1000, 10)
+        cluster = self._cluster({0: 100}, {0: 100}, {0: 100}, {0: 100}, {0: 0})
+        drain = osd.OSDDrain([0], cluster, delay=6, max_delay=20, timeout=100)
+        drain.wait()
+        assert [call[0][0] for call in time_mock.sleep.call_args_list] == [6, 12, 20, 20]
+
+    @mock.patch('srv.salt._modules.osd.time')
+    def test_wait_timeout(self, time_mock):
+        time_mock.time.side_effect = range(0, 1000, 30)
+        cluster = self._cluster({0: 100}, {0: 100}, {0: 100})
+        drain = osd.OSDDrain([0], cluster, timeout=60)
+        with pytest.raises(RuntimeError):
+            drain.wait()
+
+    @mock.patch('srv.salt._modules.osd.time')
+    def test_wait_weight(self, time_mock):
+        import json
+        time_mock.time.side_effect = range(0, 1000, 10)
+        cluster = MagicMock()
+        cluster.mon_command.return_value = (0, json.dumps(
+            {'nodes': [{'id': 0, 'pgs': 10, 'crush_weight': 1.5}]}), '')
+        ret = osd.OSDDrain([0], cluster, check_weight=True).wait()
+        assert ret == {0: "Weight is not 0.0"}
+
+
 class TestOSDConfig():
 
     # How to properly reset the salt_internals after it was altered..
@@ -1980,3 +2119,94 @@ class TestOSDCommands():
     @pytest.mark.skip(reason="Low priority, postponed")
     def test_detect(self):
         pass
+
+
+class TestDeploy():
+
+    def _deployment(self, device, shared=()):
+        return {'device': device,
+                'shared': set(shared),
+                'prepare': 'prepare {}'.format(device),
+                'activate': 'activate {}'.format(device)}
+
+    def test_deployment_batches_independent(self):
+        pending = [self._deployment('/dev/sda'), self._deployment('/dev/sdb')]
+        ret = osd._deployment_batches(pending)
+        assert len(ret) == 2
+
+    def test_deployment_batches_shared_journal(self):
+        pending = [self._deployment('/dev/sda', ['/dev/nvme0n1']),
+                   self._deployment('/dev/sdb', ['/dev/nvme1n1']),
+                   self._deployment('/dev/sdc', ['/dev/nvme0n1'])]
+        ret = osd._deployment_batches(pending)
+        assert len(ret) == 2
+        devices = sorted([[entry['device'] for entry in batch] for batch in ret])
+        assert devices == [['/dev/sda', '/dev/sdc'], ['/dev/sdb']]
+
+    def test_deployment_batches_merged(self):
+        """
+        Given a device sharing the wal with one batch and the db with another
+        Expect a single batch in the original order
+        """
+        pending = [self._deployment('/dev/sda', ['/dev/nvme0n1']),
+                   self._deployment('/dev/sdb', ['/dev/nvme1n1']),
+                   self._deployment('/dev/sdc', ['/dev/nvme0n1', '/dev/nvme1n1'])]
+        ret = osd._deployment_batches(pending)
+        assert len(ret) == 1
+        assert [entry['device'] for entry in ret[0]] == ['/dev/sda', '/dev/sdb', '/dev/sdc']
+
+    @mock.patch('srv.salt._modules.osd._run')
+    def test_deploy_all_parallel(self, run):
+        run.return_value = (0, '', '')
+        pending = [self._deployment('/dev/sd{}'.format(letter)) for letter in 'abcd']
+        ret = osd._deploy_all(pending, workers=4)
+        assert sorted(ret.keys()) == ['/dev/sda', '/dev/sdb', '/dev/sdc', '/dev/sdd']
+        assert ret['/dev/sda']['prepare'] == 0
+        assert ret['/dev/sda']['activate'] == 0
+        assert 'seconds' in ret['/dev/sda']
+        assert run.call_count == 8
+
+    @mock.patch('srv.salt._modules.osd._run')
+    def test_deploy_all_batch_order(self, run):
+        run.return_value = (0, '', '')
+        pending = [self._deployment('/dev/sda', ['/dev/sdx']),
+                   self._deployment('/dev/sdb', ['/dev/sdx'])]
+        osd._deploy_all(pending, workers=4)
+        assert [call[0][0] for call in run.call_args_list] == ['prepare /dev/sda',
+                                                               'activate /dev/sda',
+                                                               'prepare /dev/sdb',
+                                                               'activate /dev/sdb']
+
+    @mock.patch('srv.salt._modules.osd._run')
+    def test_deploy_all_failure(self, run):
+        run.return_value = (1, '', 'failed')
+        ret = osd._deploy_all([self._deployment('/dev/sda')], workers=1)
+        assert ret['/dev/sda']['prepare'] == 1
+
+    def test_deploy_workers_pillar(self):
+        osd.__pillar__ = {'osd_deploy_workers': '8'}
+        assert osd._deploy_workers() == 8
+        assert osd._deploy_workers(2) == 2
+        osd.__pillar__ = {}
+        assert osd._deploy_workers() == 1
+        assert osd._deploy_workers(0) == 1
+
+    @mock.patch('srv.salt._modules.osd.OSDCommands')
+    @mock.patch('srv.salt._modules.osd.OSDPartitions')
+    @mock.patch('srv.salt._modules.osd.OSDConfig')
+    @mock.patch('srv.salt._modules.osd.is_prepared')
+    @mock.patch('srv.salt._modules.osd.configured')
+    @mock.patch('srv.salt._modules.osd._run')
+    def test_deploy(self, run, configured, is_prepared, osdconfig, osdp, osdc):
+        """
+        Given two unprepared devices
+        Expect both partitioned, prepared and reported
+        """
+        configured.return_value = ['/dev/sda', '/dev/sdb']
+        is_prepared.return_value = False
+        osdconfig.side_effect = lambda device: OSDConfig(device=device)
+        run.return_value = (0, '', '')
+        ret = osd.deploy(workers=2)
+        assert osdp.return_value.partition.call_count == 2
+        assert osdc.return_value.prepare.call_count == 2
+        assert sorted(ret.keys()) == ['/dev/sda', '/dev/sdb']
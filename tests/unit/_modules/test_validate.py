@@ -1,5 +1,6 @@
 import pytest
 import salt.client
+from collections import OrderedDict
 
 from mock import patch, MagicMock
 from srv.modules.runners import validate
@@ -62,3 +63,91 @@ class TestUtilMethods():
     def test_parse_string_list(self):
         list_str = "1, 4     ,   5, , 7"
         assert validate.Util.parse_list_from_string(list_str, ",") == ['1', '4', '5', '7']
+
+
+def _cluster():
+    pillar = {}
+    grains = {}
+    for idx in range(1, 6):
+        node = 'node{}.ceph'.format(idx)
+        roles = ['storage', 'mon', 'mgr'] if idx < 4 else ['storage']
+        if idx == 1:
+            roles.append('master')
+        pillar[node] = {'fsid': '2e7a0e5d-29f6-4b0b-8a91-5d7ee6a1b2a5',
+                        'public_network': '10.0.0.0/24',
+                        'cluster_network': '10.1.0.0/24' if idx < 5 else '10.1.0.0/33',
+                        'roles': roles, 'storage': {}, 'time_init': 'disabled',
+                        'master_minion': 'node1.ceph',
+                        'mon_host': ['10.0.0.1', '10.0.0.2', '10.0.0.3']}
+        grains[node] = {'ipv4': ['10.0.0.{}'.format(idx), '10.1.0.{}'.format(idx)],
+                        'fqdn': node if idx != 2 else 'localhost'}
+    return pillar, grains
+
+
+CHECKS = ['dev_env', 'fsid', 'public_network', 'public_interface', 'cluster_network',
+          'cluster_interface', 'monitors', 'mgrs', 'storage', 'ganesha', 'master_role',
+          'osd_creation', 'pool_creation', 'time_server', 'fqdn']
+
+
+class TestRun():
+
+    def test_same_as_sequential(self):
+        """
+        Given checks with passes, errors and warnings
+        Expect the concurrent run to report like the checks run in sequence
+        """
+        pillar, grains = _cluster()
+        sequential = validate.Validate('ceph', pillar, grains, None)
+        for check in CHECKS:
+            getattr(sequential, check)()
+        concurrent = validate.Validate('ceph', pillar, grains, None)
+        concurrent.run(CHECKS)
+        assert concurrent.errors == sequential.errors
+        assert concurrent.warnings == sequential.warnings
+        assert concurrent.passed == sequential.passed
+        assert concurrent.errors.keys() == ['cluster_network', 'cluster_interface']
+        assert concurrent.warnings.keys() == ['fqdn']
+        assert concurrent.timings.keys() == CHECKS
+
+    def test_timings_reported(self):
+        pillar, grains = _cluster()
+        printer = validate.JsonPrinter()
+        valid = validate.Validate('ceph', pillar, grains, printer)
+        valid.run(['fsid', 'monitors'], workers=1)
+        with patch('sys.stdout'):
+            valid.report()
+        assert printer.result['ceph']['timings'].keys() == ['fsid', 'monitors']
+        assert printer.result['ceph']['passed'] == {'fsid': 'valid', 'monitors': 'valid'}
+
+    def test_pretty_timings(self):
+        printer = validate.PrettyPrinter()
+        with patch('sys.stdout') as stdout:
+            printer.add_timings('ceph', OrderedDict([('fsid', 0.01), ('time_server', 1.5)]))
+        output = "".join(c[0][0] for c in stdout.write.call_args_list)
+        assert 'slowest time_server 1.50s' in output
+
+    def test_snapshot(self):
+        local = MagicMock()
+        local.cmd.return_value = {'node1': {'pillar.items': {'a': 1}, 'grains.items': {'b': 2}},
+                                  'node2': "Minion did not return"}
+        snapshot = validate._snapshot(local, '*', [('pillar.items', []), ('grains.items', [])])
+        assert snapshot == {'pillar.items': {'node1': {'a': 1}},
+                            'grains.items': {'node1': {'b': 2}}}
+        local.cmd.assert_called_once_with('*', ['pillar.items', 'grains.items'], [[], []],
+                                          expr_form='compound')
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_setup_checks_use_snapshot(self, localclient):
+        """
+        Given package data and a master minion among the minions
+        Expect no further queries
+        """
+        pillar, _ = _cluster()
+        packages = {'latest': {'node1.ceph': '12.2.1-1', 'node2.ceph': ''},
+                    'installed': {'node2.ceph': {'ceph': {'version': '2:10.1.0-3'}}}}
+        valid = validate.Validate('setup', pillar, [], None, packages=packages)
+        valid.run(['master_minion', 'ceph_version'])
+        assert localclient.return_value.cmd.called is False
+        assert valid.passed == {'master_minion': 'valid'}
+        assert valid.errors == {'ceph_version': [
+            "The Ceph version available in node2.ceph is older than 'jewel' (10.2)"]}
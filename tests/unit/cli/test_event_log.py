@@ -0,0 +1,126 @@
+import pickle
+import pytest
+from cli import event_log
+from cli.salt_event import EventListener
+
+
+class Collector(EventListener):
+
+    def __init__(self):
+        self.events = []
+
+    def handle_salt_event(self, event):
+        self.events.append(event)
+
+
+class TestEventRecorder():
+
+    def test_round_trip(self, tmpdir):
+        path = str(tmpdir.join('events.log'))
+        recorder = event_log.EventRecorder(path)
+        recorder.record_event(b'salt/auth\n\n\x80', 1.5)
+        recorder.record_stage('ceph.stage.0', ['step'], 'output', 2.0)
+        recorder.close()
+        records = list(event_log.read_event_log(path))
+        assert records[0] == (event_log.RECORD_EVENT, 1.5, b'salt/auth\n\n\x80')
+        assert records[1][:2] == (event_log.RECORD_STAGE, 2.0)
+        assert pickle.loads(records[1][2]) == ('ceph.stage.0', ['step'], 'output')
+
+    def test_append(self, tmpdir):
+        path = str(tmpdir.join('events.log'))
+        for _ in range(2):
+            recorder = event_log.EventRecorder(path)
+            recorder.record_event(b'event', 1.0)
+            recorder.close()
+        assert len(list(event_log.read_event_log(path))) == 2
+
+    def test_truncate(self, tmpdir):
+        path = str(tmpdir.join('events.log'))
+        for _ in range(2):
+            recorder = event_log.EventRecorder(path, truncate=True)
+            recorder.record_event(b'event', 1.0)
+            recorder.close()
+        assert len(list(event_log.read_event_log(path))) == 1
+
+    def test_truncated_record(self, tmpdir):
+        path = str(tmpdir.join('events.log'))
+        recorder = event_log.EventRecorder(path)
+        recorder.record_event(b'event', 1.0)
+        recorder.record_event(b'another event', 2.0)
+        recorder.close()
+        content = tmpdir.join('events.log').read_binary()
+        tmpdir.join('events.log').write_binary(content[:-3])
+        assert [payload for _, _, payload in event_log.read_event_log(path)] == [b'event']
+
+
+class TestReplay():
+
+    @pytest.fixture
+    def trace(self, tmpdir):
+        path = str(tmpdir.join('trace.log'))
+        event_log.write_synthetic_trace(path, minions=3, states=2, noise=1)
+        return path
+
+    def test_synthetic_trace_overwrites(self, trace):
+        records = list(event_log.read_event_log(trace))
+        event_log.write_synthetic_trace(trace, minions=3, states=2, noise=1)
+        assert len(list(event_log.read_event_log(trace))) == len(records)
+
+    def test_replay(self, trace):
+        """
+        Given a stage of two state steps on three minions, with one find_job
+        and one auth event per minion and step
+        Expect the find_job and auth events to be dropped and the others to
+        reach the listeners in order
+        """
+        processor = event_log.ReplayEventProcessor(trace, 0)
+        listener = Collector()
+        processor.add_listener(listener, ['saltutil.find_job'])
+        processor.running = True
+        processor.run()
+        assert processor.running is False
+        assert processor.stages.keys() == ['ceph.stage.synthetic']
+        assert len(processor.stages['ceph.stage.synthetic'][0]) == 3
+        assert processor.counters.seen == 24
+        assert processor.counters.dropped == 12
+        assert processor.counters.dispatched == 12
+        assert [event.fun for event in listener.events[:3]] == \
+            ['runner.state.orch', 'runner.ready.check', 'runner.ready.check']
+        assert [event.fun for event in listener.events[3:-1]] == ['state.sls'] * 8
+        assert listener.events[-1].fun == 'runner.state.orch'
+
+    def test_stop(self, trace):
+        processor = event_log.ReplayEventProcessor(trace, 0)
+        processor.stop()
+        processor.run()
+        assert processor.counters.seen == 0
+
+
+class TestLatencyHistogram():
+
+    def test_empty(self):
+        histogram = event_log.LatencyHistogram()
+        assert histogram.percentile(50) == 0.0
+        assert str(histogram) == "p50: 0.000ms p99: 0.000ms max: 0.000ms"
+
+    def test_percentiles(self):
+        histogram = event_log.LatencyHistogram()
+        for _ in range(99):
+            histogram.add(0.001)
+        histogram.add(2.0)
+        assert histogram.count == 100
+        assert histogram.percentile(50) == pytest.approx(1.024e-3)
+        assert histogram.percentile(99) == pytest.approx(1.024e-3)
+        assert histogram.percentile(100) == 2.0
+        assert histogram.max == 2.0
+
+    def test_bounded_by_max(self):
+        histogram = event_log.LatencyHistogram()
+        histogram.add(0.0005)
+        assert histogram.percentile(50) == 0.0005
+
+    def test_overflow(self):
+        histogram = event_log.LatencyHistogram()
+        histogram.add(5000.0)
+        assert histogram.buckets[-1] == 1
+        assert histogram.percentile(99) == 5000.0
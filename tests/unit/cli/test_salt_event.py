@@ -0,0 +1,82 @@
+from cli.monitor import Monitor
+from cli.salt_event import SaltEventProcessor, EventListener
+
+
+class Collector(EventListener):
+
+    def __init__(self):
+        self.events = []
+
+    def handle_salt_event(self, event):
+        self.events.append(event)
+
+
+class FakeMonitor(object):
+
+    def __init__(self):
+        self.events = []
+
+    def append_event(self, event):
+        self.events.append((event.func, event.event.fun))
+
+
+def _job(tag, fun):
+    return {'tag': tag, 'data': {'jid': '1', '_stamp': '', 'fun': fun, 'arg': [],
+                                 'minions': ['node1'], 'id': 'node1', 'success': True,
+                                 'retcode': 0, 'return': {}}}
+
+
+class TestListenerFilters():
+
+    def test_filter_per_listener(self):
+        """
+        Given a listener ignoring find_job and one without filters
+        Expect the find_job events to reach only the second one
+        """
+        processor = SaltEventProcessor()
+        filtered = Collector()
+        plain = Collector()
+        processor.add_listener(filtered, ['saltutil.find_job'])
+        processor.add_listener(plain)
+        processor._process(_job('salt/job/1/new', 'saltutil.find_job'))
+        processor._process(_job('salt/job/1/ret/node1', 'state.sls'))
+        assert [event.fun for event in filtered.events] == ['state.sls']
+        assert [event.fun for event in plain.events] == ['saltutil.find_job', 'state.sls']
+        assert processor.counters.dropped == 0
+        assert processor.counters.dispatched == 2
+
+    def test_dropped_by_all(self):
+        processor = SaltEventProcessor()
+        listener = Collector()
+        processor.add_listener(listener, ['pillar'], ['pillar'])
+        processor._process(_job('salt/job/1/new', 'pillar.items'))
+        processor._process(_job('salt/run/1/new', 'runner.pillar.show'))
+        processor._process(_job('salt/auth', 'pillar.items'))
+        assert listener.events == []
+        assert processor.counters.dropped == 3
+        assert processor.counters.dispatched == 0
+
+    def test_runner_filter(self):
+        processor = SaltEventProcessor()
+        listener = Collector()
+        processor.add_listener(listener, ['grains'])
+        processor._process(_job('salt/run/1/new', 'runner.grains.get'))
+        assert [event.fun for event in listener.events] == ['runner.grains.get']
+
+
+class TestDeepSeaEventListener():
+
+    def test_render_sls(self):
+        """
+        Given jobs of deepsea.render_sls and of a function with a longer name
+        Expect only the exact deepsea.render_sls jobs to be skipped
+        """
+        monitor = FakeMonitor()
+        processor = SaltEventProcessor()
+        processor.add_listener(Monitor.DeepSeaEventListener(monitor),
+                               Monitor._IGNORED_JOB_FUNS_, Monitor._IGNORED_RUNNER_FUNS_)
+        processor._process(_job('salt/job/1/new', 'deepsea.render_sls'))
+        processor._process(_job('salt/job/1/ret/node1', 'deepsea.render_sls'))
+        processor._process(_job('salt/job/2/new', 'deepsea.render_sls_all'))
+        processor._process(_job('salt/job/3/new', 'grains.items'))
+        assert monitor.events == [('start_step', 'deepsea.render_sls_all')]
@@ -0,0 +1,21 @@
+from mock import MagicMock, patch
+from cli.stage_parser import SLSRenderer
+
+
+class TestRenderStates():
+
+    def test_minion_without_return(self):
+        """
+        Given two minions published for the render job and only one returning
+        Expect the states of the returning minion and no entry for the other
+        """
+        local = MagicMock()
+        local.run_job.return_value = {'jid': '1', 'minions': ['node1', 'node2']}
+        local.get_cli_returns.return_value = iter([
+            {'node1': {'ret': {'ceph.sync': {'sync': {'__order__': 0, '__val__': 'x'}}}}},
+            {}])
+        with patch.object(SLSRenderer, '_LOCAL_', local, create=True):
+            result = SLSRenderer.render_states({'I@roles:master': ['ceph.sync']})
+        assert result.keys() == ['ceph.sync']
+        assert result['ceph.sync'].keys() == ['node1']
+        assert result['ceph.sync']['node1'] == {'sync': 'x'}
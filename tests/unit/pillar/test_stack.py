@@ -0,0 +1,127 @@
+import imp
+import os
+import time
+
+import pytest
+import yaml
+
+stack = imp.load_source('stack', os.path.join(os.path.dirname(__file__), '..', '..', '..',
+                                              'srv', 'modules', 'pillar', 'stack.py'))
+
+STACK_CFG = """
+default/global.yml
+default/{{ pillar.get('cluster') }}/cluster.yml
+{% for role in pillar.get('roles', []) %}
+default/{{ pillar.get('cluster') }}/roles/{{ role }}.yml
+{% endfor %}
+default/{{ pillar.get('cluster') }}/minions/{{ minion_id }}.yml
+global.yml
+{{ pillar.get('cluster') }}/minions/{{ minion_id }}.yml
+"""
+
+
+def _write(basedir, path, content):
+    filename = os.path.join(basedir, path)
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'w') as yml:
+        yml.write(content)
+
+
+class TestStackCache():
+
+    @pytest.fixture()
+    def tree(self, tmpdir):
+        basedir = str(tmpdir)
+        _write(basedir, 'stack.cfg', STACK_CFG)
+        _write(basedir, 'default/global.yml',
+               yaml.safe_dump({'time_server': 'admin', 'roles_list': ['a'],
+                               'nested': {'one': 1}}))
+        _write(basedir, 'default/ceph/cluster.yml', yaml.safe_dump({'fsid': '1234'}))
+        _write(basedir, 'default/ceph/roles/mon.yml', yaml.safe_dump({'roles_list': ['mon']}))
+        _write(basedir, 'default/ceph/roles/storage.yml',
+               yaml.safe_dump({'roles_list': ['storage'], 'nested': {'two': 2}}))
+        _write(basedir, 'global.yml', "time_server: {{ minion_id }}\n")
+        for minion in ['node1', 'node2', 'node3']:
+            _write(basedir, 'default/ceph/minions/{}.yml'.format(minion),
+                   yaml.safe_dump({'public_address': minion}))
+        _write(basedir, 'ceph/minions/node2.yml',
+               yaml.safe_dump({'nested': {'__': 'overwrite', 'three': 3}}))
+        stack.__opts__ = {}
+        stack.__salt__ = {}
+        stack.__grains__ = {}
+        stack._CACHE.clear()
+        stack._CACHE.enabled = True
+        yield os.path.join(basedir, 'stack.cfg')
+        stack._CACHE.clear()
+
+    def _pillars(self, cfg):
+        pillars = {}
+        for minion, roles in [('node1', ['mon']), ('node2', ['mon', 'storage']),
+                              ('node3', ['mon', 'storage'])]:
+            pillars[minion] = stack.ext_pillar(minion, {'cluster': 'ceph', 'roles': roles}, cfg)
+        return pillars
+
+    def test_cached_matches_uncached(self, tree):
+        stack._CACHE.enabled = False
+        expected = self._pillars(tree)
+        stack._CACHE.enabled = True
+        assert self._pillars(tree) == expected
+        assert self._pillars(tree) == expected
+        assert expected['node1']['time_server'] == 'node1'
+        assert expected['node2']['nested'] == {'three': 3}
+        assert expected['node3']['nested'] == {'one': 1, 'two': 2}
+        assert expected['node3']['roles_list'] == ['a', 'mon', 'storage']
+
+    def test_shared_layers(self, tree):
+        self._pillars(tree)
+        # Blank lines of the stack.cfg are kept as missing layers
+        keys = [[os.path.basename(signature[0]) for signature in key[1:]
+                 if signature[2] is not None]
+                for key in stack._CACHE.layers]
+        assert ['global.yml', 'cluster.yml', 'mon.yml', 'storage.yml'] in keys
+        for key in keys:
+            assert 'node1.yml' not in key
+
+    def test_static_file_parsed_once(self, tree):
+        self._pillars(tree)
+        files = [signature[0] for signature in stack._CACHE.files]
+        assert len(files) == len(set(files))
+        templates = [signature[0] for signature, entry in stack._CACHE.files.items()
+                     if entry is None]
+        assert templates == [os.path.join(os.path.dirname(tree), 'global.yml')]
+
+    def test_modified_file(self, tree):
+        self._pillars(tree)
+        filename = os.path.join(os.path.dirname(tree), 'default', 'ceph', 'cluster.yml')
+        with open(filename, 'w') as yml:
+            yml.write(yaml.safe_dump({'fsid': '5678'}))
+        mtime = time.time() + 10
+        os.utime(filename, (mtime, mtime))
+        assert self._pillars(tree)['node3']['fsid'] == '5678'
+
+    def test_returned_pillar_is_private(self, tree):
+        first = self._pillars(tree)
+        first['node2']['roles_list'].append('changed')
+        first['node2']['nested']['changed'] = True
+        second = self._pillars(tree)
+        assert second['node2']['roles_list'] == ['a', 'mon', 'storage']
+        assert second['node3']['nested'] == {'one': 1, 'two': 2}
+
+    def test_import_without_context(self, tree):
+        """
+        Given a template importing macros without context
+        Expect the macros to see the globals of the minion being rendered
+        """
+        basedir = os.path.dirname(tree)
+        _write(basedir, 'macros.j2',
+               "{% macro address() %}{{ minion_id }}.{{ __grains__['domain'] }}"
+               "{% endmacro %}\n")
+        _write(basedir, 'global.yml',
+               "{% import 'macros.j2' as macros %}\naddress: {{ macros.address() }}\n")
+        stack.__grains__ = {'domain': 'ceph'}
+        pillars = self._pillars(tree)
+        assert pillars['node1']['address'] == 'node1.ceph'
+        assert pillars['node3']['address'] == 'node3.ceph'
+        # stack.cfg, global.yml and macros.j2 are compiled once
+        assert len(stack._CACHE.bytecode.buckets) == 3
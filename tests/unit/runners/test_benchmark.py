@@ -0,0 +1,217 @@
+import copy
+import json
+import pytest
+from mock import patch
+with patch('salt.client.LocalClient'):
+    from srv.modules.runners import benchmark
+
+
+# two racks, three hosts, osd.6 sits directly below a host outside any rack
+TREE = {'nodes': [
+    {'id': -1, 'name': 'default', 'type': 'root', 'children': [-2, -3, -6]},
+    {'id': -2, 'name': 'rack1', 'type': 'rack', 'children': [-4]},
+    {'id': -3, 'name': 'rack2', 'type': 'rack', 'children': [-5]},
+    {'id': -4, 'name': 'data1', 'type': 'host', 'children': [0, 1, 2]},
+    {'id': -5, 'name': 'data2', 'type': 'host', 'children': [3, 4]},
+    {'id': -6, 'name': 'data3', 'type': 'host', 'children': [5, 6]},
+    {'id': 0, 'name': 'osd.0', 'type': 'osd'},
+    {'id': 1, 'name': 'osd.1', 'type': 'osd'},
+    {'id': 2, 'name': 'osd.2', 'type': 'osd'},
+    {'id': 3, 'name': 'osd.3', 'type': 'osd'},
+    {'id': 4, 'name': 'osd.4', 'type': 'osd'},
+    {'id': 5, 'name': 'osd.5', 'type': 'osd'},
+    {'id': 6, 'name': 'osd.6', 'type': 'osd'}],
+    'stray': []}
+
+
+class TestFailureDomains():
+
+    def test_host(self):
+        domains = benchmark._failure_domains(TREE)
+        assert domains == {0: 'data1', 1: 'data1', 2: 'data1',
+                           3: 'data2', 4: 'data2', 5: 'data3', 6: 'data3'}
+
+    def test_rack(self):
+        domains = benchmark._failure_domains(TREE, 'rack')
+        assert domains == {0: 'rack1', 1: 'rack1', 2: 'rack1', 3: 'rack2', 4: 'rack2'}
+
+
+class TestBatches():
+
+    def test_one_osd_per_domain(self):
+        domains = benchmark._failure_domains(TREE)
+        batches = benchmark._batches(domains, 8)
+        assert len(batches) == 3
+        assert sorted(osd_id for batch in batches for osd_id in batch) == range(7)
+        for batch in batches:
+            assert len(set(domains[osd_id] for osd_id in batch)) == len(batch)
+
+    def test_concurrency(self):
+        domains = dict((osd_id, 'host{}'.format(osd_id)) for osd_id in range(10))
+        batches = benchmark._batches(domains, 4)
+        assert [len(batch) for batch in batches] == [4, 4, 2]
+
+    def test_single_domain(self):
+        batches = benchmark._batches({0: 'data1', 1: 'data1'}, 8)
+        assert batches == [[0], [1]]
+
+
+class TestHistory():
+
+    def test_round_trip(self, tmpdir):
+        path = str(tmpdir.join('benchmark', 'baseline.json'))
+        benchmark._append_history(path, {0: 100.0, 1: 200.0})
+        benchmark._append_history(path, {0: 110.0})
+        entries = benchmark._read_history(path)
+        assert [entry['results'] for entry in entries] == [{0: 100.0, 1: 200.0},
+                                                           {0: 110.0}]
+        assert entries[0]['timestamp']
+
+    def test_missing(self, tmpdir):
+        assert benchmark._read_history(str(tmpdir.join('missing.json'))) == []
+
+    def test_regressions(self):
+        entries = [{'results': {0: 100.0, 1: 100.0}},
+                   {'results': {0: 104.0, 1: 98.0}},
+                   {'results': {0: 96.0}}]
+        regressions = benchmark._regressions(entries, {0: 80.0, 1: 95.0, 2: 10.0, 3: None}, 10)
+        assert regressions.keys() == [0]
+        assert regressions[0]['baseline'] == 100.0
+        assert regressions[0]['change'] == -20.0
+
+
+class TestBaseline():
+
+    @pytest.fixture
+    def cluster(self):
+        seen = {'bench': [], 'osds': {'data1': ['0', '1', '2'], 'data2': ['3', '4'],
+                                      'data3': ['5', '6']}}
+
+        def cmd(tgt, fun, args, expr_form=None):
+            if fun == 'osd.list':
+                return seen['osds']
+            if fun == 'pillar.get':
+                return {'admin': 'admin'}
+            if args == ['ceph osd tree -f json']:
+                return {'admin': json.dumps(TREE)}
+            osd_id = int(args[0].split()[2][4:])
+            seen['bench'].append(osd_id)
+            if osd_id == 6:
+                return {'admin': 'Error EIO'}
+            return {'admin': json.dumps({'bytes_per_sec': 100.0 * (osd_id + 1)})}
+
+        with patch.object(benchmark, 'local_client') as local_client, \
+                patch('salt.client.LocalClient') as localclient:
+            local_client.cmd.side_effect = cmd
+            localclient.return_value.cmd.side_effect = cmd
+            yield seen
+
+    def test_baseline(self, cluster, tmpdir):
+        path = str(tmpdir.join('baseline.json'))
+        assert benchmark.baseline(history=path) is True
+        assert sorted(cluster['bench']) == range(7)
+        entries = benchmark._read_history(path)
+        assert entries[0]['results'] == dict((osd_id, 100.0 * (osd_id + 1))
+                                             for osd_id in range(6))
+
+    def test_client_glob(self, cluster, tmpdir):
+        cluster['osds'] = {'data1': ['0', '1', '2']}
+        assert benchmark.baseline(history=str(tmpdir.join('baseline.json'))) is True
+        assert sorted(cluster['bench']) == [0, 1, 2]
+
+    def test_regression(self, cluster, tmpdir):
+        path = str(tmpdir.join('baseline.json'))
+        benchmark._append_history(path, {0: 100.0, 5: 1000.0})
+        assert benchmark.baseline(history=path, regression=10) is False
+        assert len(benchmark._read_history(path)) == 2
+
+
+def _fio_job(hostname, ios, iops, bw, mean, maximum, percentiles):
+    return {'jobname': 'rbd', 'hostname': hostname,
+            'read': {'total_ios': ios, 'iops': iops, 'bw': bw,
+                     'clat_ns': {'mean': mean, 'max': maximum,
+                                 'percentile': percentiles}},
+            'write': {'total_ios': 0, 'iops': 0, 'bw': 0, 'clat_ns': {}}}
+
+
+# fio 3 client mode output of two clients, latencies in nsec
+FIO_OUTPUT = {'fio version': 'fio-3.1', 'client_stats': [
+    _fio_job('10.0.0.1', 1000, 100.0, 400, 1000000.0, 5000000,
+             {'50.000000': 900000, '99.000000': 3000000}),
+    _fio_job('10.0.0.2', 3000, 300.0, 1200, 2000000.0, 8000000,
+             {'50.000000': 1800000, '99.000000': 6000000}),
+    _fio_job('All clients', 4000, 400.0, 1600, 1750000.0, 8000000, {})]}
+FIO_OUTPUT['client_stats'][-1]['jobname'] = 'All clients'
+
+FIO_LOGS = {'output_bw.1.log.10.0.0.1': '0, 400, 0, 4096\n1000, 400, 0, 4096\n',
+            'output_bw.1.log.10.0.0.2': '500, 1200, 0, 4096\n1500, 1000, 0, 4096\n',
+            'output_lat.1.log.10.0.0.1': '0, 1000000, 0, 4096\n',
+            'output_lat.1.log.10.0.0.2': '200, 3000000, 0, 4096\n',
+            'output_clat_hist.1.log.10.0.0.1': '0, 0, 0, 1, 2, 3\n'}
+
+
+def _fio_run(tmpdir, name, output=FIO_OUTPUT):
+    job_log_dir = tmpdir.mkdir(name)
+    job_log_dir.join('output.json').write(json.dumps(output))
+    for filename, content in FIO_LOGS.items():
+        job_log_dir.join(filename).write(content)
+    return str(job_log_dir)
+
+
+class TestFioSummary():
+
+    def test_combine(self, tmpdir):
+        result = benchmark.summary(_fio_run(tmpdir, 'run'))
+        assert result['clients'] == 2
+        assert result['jobs'] == 2
+        assert result['results'].keys() == ['read']
+        read = result['results']['read']
+        assert read['iops'] == 400.0
+        assert read['bw'] == 1600
+        assert read['ios'] == 4000
+        assert read['lat'] == {'mean': 1750.0, 'max': 8000.0,
+                               'p50': 1800.0, 'p99': 6000.0}
+
+    def test_timeseries(self, tmpdir):
+        series = benchmark.summary(_fio_run(tmpdir, 'run'))['timeseries']
+        assert series['read']['bw'] == {'seconds': 2, 'min': 1400, 'max': 1600,
+                                        'mean': 1500.0, 'stddev': 100.0}
+        assert series['read']['lat']['mean'] == 2000.0
+        assert 'clat' not in series['read']
+
+    def test_per_io_log(self, tmpdir):
+        """
+        Without log_avg_msec fio logs the bandwidth of every completed I/O
+        """
+        path = _fio_run(tmpdir, 'run')
+        with open('{}/output_bw.1.log.10.0.0.1'.format(path), 'w') as log_file:
+            log_file.write(''.join('{}, {}, 0, 4096\n'.format(msec, 390 + msec // 10 % 2 * 20)
+                                   for msec in range(0, 2000, 10)))
+        series = benchmark._timeseries(path)
+        assert [series['read']['bw'][key] for key in ('min', 'max')] == [1400, 1600]
+
+    def test_stored(self, tmpdir):
+        path = _fio_run(tmpdir, 'run')
+        result = benchmark.summary(path)
+        with open('{}/summary.json'.format(path)) as summary_file:
+            assert json.load(summary_file)['results']['read']['iops'] == \
+                result['results']['read']['iops']
+
+    def test_merge_percentiles(self):
+        curves = [(1, {'50.000000': 10, '99.000000': 20}),
+                  (1, {'50.000000': 30, '99.000000': 40})]
+        assert benchmark._merge_percentiles(curves, '50.000000') == 30
+        assert benchmark._merge_percentiles(curves, '99.000000') == 40
+        assert benchmark._merge_percentiles([], '50.000000') == 0.0
+
+    def test_compare(self, tmpdir):
+        faster = copy.deepcopy(FIO_OUTPUT)
+        for job in faster['client_stats']:
+            job['read']['iops'] *= 2
+            job['read']['clat_ns']['mean'] /= 2
+        deltas = benchmark.compare(_fio_run(tmpdir, 'before'),
+                                   _fio_run(tmpdir, 'after', faster))
+        assert deltas.keys() == ['read']
+        assert deltas['read']['iops'] == {'before': 400.0, 'after': 800.0, 'change': 100.0}
+        assert deltas['read']['lat_mean']['change'] == -50.0
+        assert deltas['read']['bw']['change'] == 0.0
@@ -0,0 +1,103 @@
+import os
+from mock import patch, call
+from srv.modules.runners import deepsea_minions
+
+
+class TestDeepseaMinions():
+
+    def _minions(self, localclient, target='I@roles:storage'):
+        local = localclient.return_value
+        local.cmd.side_effect = lambda tgt, fun, *args, **kwargs: {
+            'saltutil.pillar_refresh': {'minion1': True, 'minion2': True},
+            'pillar.get': ({'minion1': target, 'minion2': target}
+                           if args == (['deepsea_minions'],) else
+                           {'minion2': 'minion2', 'minion1': 'minion1'})}[fun]
+        return local
+
+    def _sources(self, tmpdir):
+        source = tmpdir.join('deepsea_minions.sls')
+        source.write('deepsea_minions: "*"\n')
+        return [str(source), str(tmpdir.join('keys'))]
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_cached(self, localclient, tmpdir):
+        """
+        Given a resolved target
+        Expect later instances to use the cached target without refreshing
+        the pillar, and to match the minions again
+        """
+        local = self._minions(localclient)
+        sources = self._sources(tmpdir)
+        target = deepsea_minions.DeepseaMinions(sources=sources)
+        assert target.deepsea_minions == 'I@roles:storage'
+        assert target.matches == ['minion1', 'minion2']
+        assert local.cmd.call_count == 3
+
+        target = deepsea_minions.DeepseaMinions(sources=sources)
+        assert target.deepsea_minions == 'I@roles:storage'
+        assert target.matches == ['minion1', 'minion2']
+        assert local.cmd.call_count == 4
+        assert local.cmd.call_args_list[3] == call('I@roles:storage', 'pillar.get', ['id'],
+                                                   expr_form="compound")
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_new_match(self, localclient, tmpdir):
+        """
+        Given a cached target
+        Expect a minion that starts matching the target to be listed
+        """
+        local = self._minions(localclient)
+        sources = self._sources(tmpdir)
+        deepsea_minions.DeepseaMinions(sources=sources)
+        local.cmd.side_effect = lambda tgt, fun, *args, **kwargs: {
+            'minion1': 'minion1', 'minion2': 'minion2', 'minion3': 'minion3'}
+        target = deepsea_minions.DeepseaMinions(sources=sources)
+        assert target.matches == ['minion1', 'minion2', 'minion3']
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_refresh(self, localclient, tmpdir):
+        local = self._minions(localclient)
+        sources = self._sources(tmpdir)
+        deepsea_minions.DeepseaMinions(sources=sources)
+        deepsea_minions.DeepseaMinions(sources=sources, refresh=True)
+        assert local.cmd.call_count == 6
+        assert local.cmd.call_args_list[3] == call('*', 'saltutil.pillar_refresh')
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_changed_source(self, localclient, tmpdir):
+        """
+        Given a cached target
+        Expect a modified pillar file or a new minion key to query the minions
+        """
+        local = self._minions(localclient)
+        sources = self._sources(tmpdir)
+        deepsea_minions.DeepseaMinions(sources=sources)
+        self._minions(localclient, 'I@roles:mon')
+        tmpdir.join('deepsea_minions.sls').write('deepsea_minions: "I@roles:mon"\n')
+        target = deepsea_minions.DeepseaMinions(sources=sources)
+        assert target.deepsea_minions == 'I@roles:mon'
+        assert local.cmd.call_count == 6
+
+        tmpdir.join('keys').ensure(dir=True)
+        deepsea_minions.DeepseaMinions(sources=sources)
+        assert local.cmd.call_count == 9
+        assert local.cmd.call_args_list[6] == call('*', 'saltutil.pillar_refresh')
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_unset_not_cached(self, localclient, tmpdir):
+        local = self._minions(localclient, '')
+        sources = self._sources(tmpdir)
+        target = deepsea_minions.DeepseaMinions(sources=sources)
+        assert target.deepsea_minions == []
+        assert target.matches == []
+        deepsea_minions.DeepseaMinions(sources=sources)
+        assert local.cmd.call_count == 4
+        assert not os.path.exists(deepsea_minions.DeepseaMinions.CACHE_FILE)
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_unwritable_cache(self, localclient, tmpdir):
+        self._minions(localclient)
+        tmpdir.join('file').write('')
+        target = deepsea_minions.DeepseaMinions(sources=self._sources(tmpdir),
+                                                cache_file=str(tmpdir.join('file', 'cache')))
+        assert target.matches == ['minion1', 'minion2']
@@ -0,0 +1,161 @@
+import threading
+import time
+from mock import patch
+from srv.modules.runners import net
+
+
+def _addresses(count, per_host=1):
+    return dict(('10.0.{}.{}'.format(nic, idx), 'node{}'.format(idx))
+                for idx in range(1, count + 1) for nic in range(per_host))
+
+
+class TestSchedule():
+
+    def test_every_pair_once(self):
+        """
+        Given addresses on several minions
+        Expect every ordered pair of different minions exactly once
+        """
+        for count, per_host in [(2, 1), (5, 1), (8, 1), (7, 2)]:
+            addresses = _addresses(count, per_host)
+            pairs = [pair for pairs in net._iperf_schedule(addresses) for pair in pairs]
+            expected = [(client, server) for client in addresses for server in addresses
+                        if addresses[client] != addresses[server]]
+            assert sorted(pairs) == sorted(expected)
+
+    def test_address_once_per_round(self):
+        rounds = net._iperf_schedule(_addresses(9, 2))
+        for pairs in rounds:
+            used = [address for pair in pairs for address in pair]
+            assert len(used) == len(set(used))
+        assert len(rounds) == 2 * 17
+
+    def test_ports(self):
+        ports = net._iperf_ports(_addresses(2, 2))
+        assert ports == {'10.0.0.1': 5200, '10.0.1.1': 5201,
+                         '10.0.0.2': 5200, '10.0.1.2': 5201}
+
+
+class FakeCluster(object):
+    """
+    Answer the salt calls of the iperf runner, tracking the addresses in use
+    """
+
+    def __init__(self, addresses, slow=(), missing=()):
+        self.addresses = addresses
+        self.slow = slow
+        self.missing = missing
+        self.active = set()
+        self.lock = threading.Lock()
+        self.overlaps = []
+        self.concurrent = 0
+        self.tests = 0
+        self.killed = False
+
+    def cmd(self, tgt, fun, args=(), expr_form=None, timeout=None):
+        if fun == 'multi.iperf_servers':
+            return dict((minion, {'ready': [port for port in args
+                                            if (minion, port) not in self.missing],
+                                  'missing': []})
+                        for minion in tgt)
+        if fun == 'multi.kill_iperf_cmd':
+            self.killed = True
+            return dict((minion, True) for minion in tgt)
+        client = tgt[2:]
+        server = args[0]
+        with self.lock:
+            if client in self.active or server in self.active:
+                self.overlaps.append((client, server))
+            self.active.update([client, server])
+            self.tests += 1
+            self.concurrent = max(self.concurrent, len(self.active) // 2)
+        time.sleep(0.01)
+        with self.lock:
+            self.active.difference_update([client, server])
+        rate = 100 if (client, server) in self.slow else 940
+        return {self.addresses[client]: {'server': server, 'succeeded': True,
+                                         'filter': '{} Mbits/sec'.format(rate)}}
+
+
+class TestMatrix():
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_matrix(self, localclient):
+        """
+        Given six minions and one slow link
+        Expect a full matrix from concurrent tests that never share an address
+        """
+        addresses = _addresses(6)
+        cluster = FakeCluster(addresses, slow=[('10.0.0.2', '10.0.0.5')])
+        localclient.return_value.cmd.side_effect = cluster.cmd
+        matrix = net._iperf_matrix(addresses)
+        assert cluster.overlaps == []
+        assert cluster.tests == 30
+        assert cluster.concurrent > 1
+        assert cluster.killed
+        assert all(len(row) == 5 for row in matrix.values())
+        assert matrix['10.0.0.2']['10.0.0.5'] == 100
+
+        report = net._iperf_report(matrix, output='full')
+        assert report['Slow links'] == ['10.0.0.2 -> 10.0.0.5 100 Mbits/sec']
+        assert report['Failed links'] == []
+        assert report['Slowest 2 hosts'][-1] == ['10.0.0.5', '772 Mbits/sec']
+        assert report['Matrix'] is matrix
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_server_not_ready(self, localclient):
+        addresses = _addresses(3)
+        cluster = FakeCluster(addresses, missing=[('node3', 5200)])
+        localclient.return_value.cmd.side_effect = cluster.cmd
+        matrix = net._iperf_matrix(addresses)
+        assert matrix['10.0.0.1']['10.0.0.3'] is None
+        assert matrix['10.0.0.3']['10.0.0.1'] == 940
+        assert cluster.tests == 4
+        assert net._iperf_report(matrix)['Failed links'] == ['10.0.0.1 -> 10.0.0.3',
+                                                             '10.0.0.2 -> 10.0.0.3']
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_single_minion(self, localclient):
+        matrix = net._iperf_matrix(_addresses(1, 2))
+        assert matrix == {'10.0.0.1': {}, '10.0.1.1': {}}
+        assert localclient.return_value.cmd.called is False
+
+    @patch('srv.modules.runners.net.deepsea_minions.DeepseaMinions')
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_iperf(self, localclient, deepsea_minions):
+        addresses = _addresses(4)
+        cluster = FakeCluster(addresses)
+        grains = {}
+        for address, minion in addresses.items():
+            grains.setdefault(minion, ['127.0.0.1']).append(address)
+
+        def cmd(tgt, fun, *args, **kwargs):
+            if fun == 'grains.get':
+                return grains
+            return cluster.cmd(tgt, fun, *args, **kwargs)
+
+        localclient.return_value.cmd.side_effect = cmd
+        report = net.iperf(exclude='10.0.0.4')
+        assert cluster.tests == 6
+        assert report['Fastest 2 hosts'] == [['10.0.0.1', '940 Mbits/sec'],
+                                             ['10.0.0.2', '940 Mbits/sec']]
+
+
+class TestLatency():
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_latency(self, localclient, capsys):
+        stats = {'succeeded': 2, 'avg': 0.5,
+                 'latency': {'p50': 0.5, 'p99': 2.0, 'max': 3.0, 'jitter': 0.1, 'loss': 0.0},
+                 'worst': [['10.0.0.2', 2.0], ['10.0.0.1', 0.6]]}
+        localclient.return_value.cmd.side_effect = [
+            {'node1': {'public_network': '10.0.0.0/24'}},
+            {'node1': ['10.0.0.1', '10.0.0.2']},
+            {'node1': stats}]
+        net.latency(cluster='ceph', count=50)
+        args = localclient.return_value.cmd.call_args[0]
+        assert args[1] == 'multi.ping_stats'
+        assert args[2] == ['10.0.0.1', '10.0.0.2', 'count=50']
+        out = capsys.readouterr()[0]
+        assert "Latency: p50 0.50 ms p99 2.00 ms max 3.00 ms" in out
+        assert "10.0.0.2 from node1 2.00 ms" in out
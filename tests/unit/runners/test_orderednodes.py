@@ -1,3 +1,5 @@
+import json
+from mock import patch
 from srv.modules.runners import orderednodes
 
 
@@ -12,3 +14,85 @@ class TestOrderedNodes():
         expect = ['mon1', 'mon2', 'mon3', 'data1',
                   'data2', 'data3', 'mds1', 'rgw1']
         assert orderednodes._preserve_order_sorted(inp) == expect
+
+
+ROLES = {'mon1': ['mon', 'mgr'], 'mon2': ['mon', 'mgr'], 'mon3': ['mon', 'mgr'],
+         'data1': ['storage'], 'data2': ['storage'], 'data3': ['storage', 'rgw'],
+         'data4': ['storage'], 'rgw1': ['rgw'], 'rgw2': ['rgw'],
+         'igw1': ['igw'], 'admin': ['master', 'admin']}
+
+
+class TestBatches():
+    """
+    Batches keep the quorum, one failure domain and half of each gateway
+    """
+
+    def test_mon_quorum(self):
+        roles = dict(('mon{}'.format(idx), ['mon']) for idx in range(1, 6))
+        assert orderednodes._batches(roles) == [['mon1', 'mon2'], ['mon3', 'mon4'], ['mon5']]
+
+    def test_tiers(self):
+        batches = orderednodes._batches(ROLES)
+        assert batches == [['mon1'], ['mon2'], ['mon3'],
+                           ['data1'], ['data2'], ['data3'], ['data4'],
+                           ['rgw1'], ['rgw2'], ['igw1']]
+
+    def test_failure_domain(self):
+        domains = {'data1': 'rack1', 'data2': 'rack1', 'data3': 'rack2', 'data4': 'rack2'}
+        batches = orderednodes._batches(ROLES, domains, exclude=['mon'])
+        # the monitors also run mgr
+        assert batches == [['mon1'], ['mon2'], ['mon3'], ['data1', 'data2'], ['data3', 'data4'],
+                           ['rgw1'], ['rgw2'], ['igw1']]
+
+    def test_colocated_exclude(self):
+        roles = {'a': ['mon', 'mgr', 'storage'], 'b': ['mon', 'mgr', 'storage'],
+                 'c': ['mon', 'storage'], 'd': ['storage'], 'e': ['storage', 'rgw'],
+                 'f': ['mon']}
+        batches = orderednodes._batches(roles, exclude=['mon'])
+        assert batches == [['a'], ['b'], ['c'], ['d'], ['e']]
+
+    def test_gateway_limit(self):
+        roles = dict(('rgw{}'.format(idx), ['rgw']) for idx in range(1, 5))
+        assert orderednodes._batches(roles) == [['rgw1', 'rgw2'], ['rgw3', 'rgw4']]
+
+    def test_max_batch(self):
+        domains = dict(('data{}'.format(idx), 'rack1') for idx in range(1, 5))
+        batches = orderednodes._batches(ROLES, domains, exclude=['mon', 'mgr', 'rgw', 'igw'],
+                                        max_batch=3)
+        assert batches == [['data1', 'data2', 'data3'], ['data4']]
+
+
+class TestRunners():
+
+    def _cmd(self, tgt, fun, args, expr_form=None):
+        if fun == 'pillar.get':
+            return {'admin': 'admin'}
+        if fun == 'cmd.run':
+            return {'admin': json.dumps(
+                {'nodes': [{'id': -1, 'name': 'default', 'type': 'root', 'children': [-2]},
+                           {'id': -2, 'name': 'rack1', 'type': 'rack', 'children': [-3, -4]},
+                           {'id': -3, 'name': 'data1', 'type': 'host', 'children': []},
+                           {'id': -4, 'name': 'data2', 'type': 'host', 'children': []}]})}
+        result = dict((minion, {'pillar.get': roles}) for minion, roles in ROLES.items())
+        if 'grains.get' in fun:
+            for minion in result:
+                result[minion]['grains.get'] = minion
+        return result
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_unique(self, localclient):
+        localclient.return_value.cmd.side_effect = self._cmd
+        with patch.object(orderednodes, '__opts__', {'conf_file': None}, create=True):
+            nodes = orderednodes.unique(exclude=['mon'])
+        assert nodes == ['mon1', 'mon2', 'mon3', 'data1', 'data2', 'data3',
+                         'data4', 'rgw1', 'rgw2', 'igw1']
+        assert localclient.return_value.cmd.call_count == 1
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_batches(self, localclient):
+        localclient.return_value.cmd.side_effect = self._cmd
+        with patch.object(orderednodes, '__opts__', {'conf_file': None}, create=True):
+            batches = orderednodes.batches(exclude=['mon'], failure_domain='rack')
+        assert batches[:3] == [['mon1'], ['mon2'], ['mon3']]
+        assert batches[3] == ['data1', 'data2']
+        assert batches[4:6] == [['data3'], ['data4']]
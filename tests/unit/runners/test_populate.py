@@ -0,0 +1,183 @@
+import ipaddress
+import pytest
+from mock import patch, MagicMock
+from srv.modules.runners import populate
+
+
+def _interfaces(*addresses):
+    return dict(('eth{}'.format(idx), {'inet': [{'address': address,
+                                                 'netmask': '255.255.255.0'}]})
+                for idx, address in enumerate(addresses))
+
+
+def _minion(addresses, hostname, master='admin'):
+    return {'network.interfaces': _interfaces('127.0.0.1', *addresses),
+            'cmd.run': hostname,
+            'grains.get': ['127.0.0.1'] + list(addresses),
+            'pillar.get': master}
+
+
+class TestNetworkIndex():
+
+    def test_containing(self):
+        networks = [ipaddress.ip_network(u'10.0.0.0/24'), ipaddress.ip_network(u'10.0.0.0/16'),
+                    ipaddress.ip_network(u'10.1.0.0/24'), ipaddress.ip_network(u'fd00::/64')]
+        index = populate.NetworkIndex(networks)
+        assert sorted(index.containing('10.0.0.5')) == sorted(networks[:2])
+        assert index.containing('10.0.1.5') == [networks[1]]
+        assert index.containing(u'10.1.0.255') == [networks[2]]
+        assert index.containing('fd00::1') == [networks[3]]
+        assert index.containing('192.168.0.1') == []
+
+
+class TestCephRoles():
+
+    @patch('srv.modules.runners.populate.deepsea_minions.DeepseaMinions')
+    @patch('salt.client.LocalClient', autospec=True)
+    def _roles(self, results, localclient, deepsea_minions):
+        local = localclient.return_value
+        local.cmd.return_value = results
+        settings = MagicMock(root_dir='/srv/pillar/ceph/proposals')
+        roles = populate.CephRoles(settings, 'ceph', sorted(results), MagicMock())
+        return roles, local
+
+    def test_single_broadcast(self):
+        """
+        Given minions with a public and a cluster network
+        Expect one broadcast and the network the master lacks as cluster network
+        """
+        results = {'admin': _minion(['10.0.0.1'], '10.0.0.1')}
+        for idx in range(2, 6):
+            results['data{}'.format(idx)] = _minion(['10.0.0.{}'.format(idx),
+                                                     '10.1.0.{}'.format(idx)],
+                                                    '10.0.0.{}'.format(idx))
+        roles, local = self._roles(results)
+        assert local.cmd.call_count == 1
+        assert roles.public_networks == [ipaddress.ip_network(u'10.0.0.0/24')]
+        assert roles.cluster_networks == [ipaddress.ip_network(u'10.1.0.0/24')]
+        assert roles._public_interface('data3') == '10.0.0.3'
+        assert roles._public_interface('missing') == ''
+
+    def test_single_network(self):
+        results = dict(('node{}'.format(idx), _minion(['10.0.0.{}'.format(idx)],
+                                                      '10.0.0.{}'.format(idx), 'node1'))
+                       for idx in range(1, 5))
+        roles, _ = self._roles(results)
+        assert roles.public_networks == [ipaddress.ip_network(u'10.0.0.0/24')]
+        assert roles.cluster_networks == roles.public_networks
+
+    def test_redundant_public_networks(self):
+        """
+        Given minions whose hostnames resolve in two networks
+        Expect only the public networks needed to reach every minion
+        """
+        results = {}
+        for idx in range(1, 5):
+            results['node{}'.format(idx)] = _minion(['10.0.0.{}'.format(idx),
+                                                     '10.2.0.{}'.format(idx)],
+                                                    '10.0.0.{} 10.2.0.{}'.format(idx, idx),
+                                                    'node1')
+        roles, _ = self._roles(results)
+        assert roles.public_networks == [ipaddress.ip_network(u'10.0.0.0/24')]
+
+    def test_master_outside_target(self):
+        results = dict(('node{}'.format(idx), _minion(['10.0.0.{}'.format(idx),
+                                                       '10.1.0.{}'.format(idx)],
+                                                      '10.0.0.{}'.format(idx), 'master'))
+                       for idx in range(1, 5))
+        with patch('salt.client.LocalClient', autospec=True) as localclient:
+            local = localclient.return_value
+            local.cmd.side_effect = [results, {'master': ['127.0.0.1', '10.1.0.100']}]
+            with patch('srv.modules.runners.populate.deepsea_minions.DeepseaMinions'):
+                roles = populate.CephRoles(MagicMock(root_dir='/tmp'), 'ceph',
+                                           sorted(results), MagicMock())
+        assert local.cmd.call_count == 2
+        assert roles.public_networks == [ipaddress.ip_network(u'10.0.0.0/24')]
+        assert roles.cluster_networks == [ipaddress.ip_network(u'10.1.0.0/24')]
+
+    def test_no_master_minion(self):
+        results = {'node1': _minion(['10.0.0.1'], '10.0.0.1', '')}
+        with pytest.raises(Exception) as excinfo:
+            self._roles(results)
+        assert 'master_minion' in str(excinfo.value)
+
+
+def _drive(host, index, vendor='SEAGATE', capacity='4 TB', rotational='1'):
+    return {'Vendor': vendor, 'Capacity': capacity, 'rotational': rotational,
+            'Driver': 'ahci', 'Device File': '/dev/sd{}'.format(chr(97 + index)),
+            'Device Files': '/dev/sd{0}, /dev/disk/by-id/ata-{1}-{0}'.format(chr(97 + index),
+                                                                             host)}
+
+
+def _chassis(host, hdds, ssds):
+    return ([_drive(host, idx) for idx in range(hdds)] +
+            [_drive(host, hdds + idx, 'INTEL SSDSC2BB48', '480 GB', '0') for idx in range(ssds)])
+
+
+class TestDiskConfiguration():
+
+    @patch('salt.utils.minions.mine_get')
+    def _generate(self, storage_nodes, mine_get):
+        mine_get.side_effect = lambda server, *args: {server: storage_nodes[server]}
+        options = MagicMock()
+        options.__opts__ = {}
+        dc = populate.DiskConfiguration(options, servers=sorted(storage_nodes))
+        dc.generate(populate.HardwareProfile())
+        return dc
+
+    def test_fingerprints(self):
+        """
+        Given hosts of two chassis types
+        Expect two fingerprints sharing the profile names
+        """
+        storage_nodes = dict(('data{}'.format(idx), _chassis('data{}'.format(idx), 12, 2))
+                             for idx in range(6))
+        storage_nodes['small'] = _chassis('small', 4, 0)
+        dc = self._generate(storage_nodes)
+        assert len(dc.hardware.fingerprints) == 2
+        assert dc.summary['hosts'] == 7
+        assert dc.summary['fingerprints'] == 2
+        assert dc.summary['saved'] >= 0.0
+        assert dc.hardware.profiles['data3'].keys() == ['2Intel480GB-12SEAGATE4TB']
+        assert dc.hardware.profiles['small'].keys() == ['4SEAGATE4TB']
+
+    def test_fanned_out_proposals(self):
+        """
+        Given hosts with the same chassis and different device ids
+        Expect the same proposals as computing each host separately
+        """
+        storage_nodes = dict(('data{}'.format(idx), _chassis('data{}'.format(idx), 10, 2))
+                             for idx in range(4))
+        dc = self._generate(storage_nodes)
+        for server in storage_nodes:
+            for configuration, drives in dc.hardware.profiles[server].items():
+                expected = dc._proposals(configuration, drives)
+                assert dc.proposals[server][configuration] == expected
+        proposal = dc.proposals['data2']['2Intel480GB-10SEAGATE4TB'][1]
+        assert proposal['data+journals'][0] == {'/dev/disk/by-id/ata-data2-a':
+                                                '/dev/disk/by-id/ata-data2-k'}
+
+    def test_translate_empty(self):
+        assert populate._translate({}, {}) == {}
+
+    @patch('salt.utils.minions.mine_get')
+    @patch('srv.modules.runners.populate.CephStorage')
+    @patch('srv.modules.runners.populate.CephCluster')
+    @patch('srv.modules.runners.populate.SaltWriter')
+    @patch('srv.modules.runners.populate.Settings')
+    def test_show(self, settings, writer, cluster, storage, mine_get, capsys):
+        """
+        Given three hosts of one chassis type
+        Expect show to generate the proposals and print the summary
+        """
+        storage_nodes = dict(('data{}'.format(idx), _chassis('data{}'.format(idx), 4, 1))
+                             for idx in range(3))
+        mine_get.side_effect = lambda server, *args: {server: storage_nodes[server]}
+        settings.return_value.__opts__ = {}
+        cluster.return_value.names = ['ceph']
+        cluster.return_value.minions = sorted(storage_nodes)
+        populate.show()
+        out = capsys.readouterr()[0]
+        assert '3 storage nodes, 1 hardware fingerprints, proposals in ' in out
+        assert 's saved' in out
+
@@ -1,6 +1,10 @@
 from pyfakefs import fake_filesystem as fake_fs
 from pyfakefs import fake_filesystem_glob as fake_glob
+import glob
+import json
+import os
 from mock import patch, mock_open, MagicMock
+import pytest
 from srv.modules.runners import push
 
 fs = fake_fs.FakeFilesystem()
@@ -105,3 +109,160 @@ class TestPush():
 
         organized = p_d.organize('policy.cfg_trailing_and_leading_whitespace_and_trailing_comment')
         assert len(organized.keys()) == len(nodes)
+
+
+class TestOutput():
+
+    def _write(self, filename, content):
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as yml:
+            yml.write(content)
+
+    def _pillar_data(self, tmpdir):
+        p_d = push.PillarData(False)
+        p_d.proposals_dir = str(tmpdir.join('proposals'))
+        p_d.pillar_dir = str(tmpdir.join('pillar'))
+        self._write(p_d.proposals_dir + '/config/stack/default/global.yml', 'a: 1\n')
+        self._write(p_d.proposals_dir + '/role-mon/stack/default/ceph/roles/mon.yml', 'b: 2\n')
+        self._write(p_d.proposals_dir + '/cluster-ceph/cluster/mon1.sls', 'cluster: ceph\n')
+        policy = p_d.proposals_dir + '/policy.cfg'
+        self._write(policy, 'config/stack/default/global.yml\n'
+                            'role-mon/stack/default/ceph/roles/mon.yml\n'
+                            'cluster-ceph/cluster/*.sls\n')
+        return p_d, policy
+
+    def test_output(self, tmpdir):
+        p_d, policy = self._pillar_data(tmpdir)
+        p_d.output(p_d.organize(policy))
+        with open(p_d.pillar_dir + '/stack/default/global.yml') as yml:
+            assert yml.read() == 'a: 1\n'
+        assert os.path.isfile(p_d.pillar_dir + '/cluster/mon1.sls')
+        assert os.path.isfile(p_d.pillar_dir + '/stack/ceph/minions/mon1.yml')
+        with open(p_d.pillar_dir + '/stack/default/.manifest.json') as manifest:
+            entries = json.load(manifest)
+        assert sorted(entries) == ['cluster/mon1.sls', 'stack/default/ceph/roles/mon.yml',
+                                   'stack/default/global.yml']
+        assert entries['cluster/mon1.sls']['cluster'] == 'ceph'
+
+    def test_output_unchanged(self, tmpdir):
+        p_d, policy = self._pillar_data(tmpdir)
+        p_d.output(p_d.organize(policy))
+        filename = p_d.pillar_dir + '/stack/default/global.yml'
+        inode = os.stat(filename).st_ino
+        with patch('srv.modules.runners.push._merge') as merge:
+            p_d.output(p_d.organize(policy))
+            assert merge.called is False
+        assert os.stat(filename).st_ino == inode
+
+    def test_output_changed_source(self, tmpdir):
+        p_d, policy = self._pillar_data(tmpdir)
+        p_d.output(p_d.organize(policy))
+        self._write(p_d.proposals_dir + '/config/stack/default/global.yml', 'a: 12\n')
+        mon = p_d.pillar_dir + '/stack/default/ceph/roles/mon.yml'
+        inode = os.stat(mon).st_ino
+        p_d.output(p_d.organize(policy))
+        with open(p_d.pillar_dir + '/stack/default/global.yml') as yml:
+            assert yml.read() == 'a: 12\n'
+        assert os.stat(mon).st_ino == inode
+
+    def test_output_same_content(self, tmpdir):
+        """
+        Given a source rewritten with the same data
+        Expect the merge to run but the output file to stay untouched
+        """
+        p_d, policy = self._pillar_data(tmpdir)
+        p_d.output(p_d.organize(policy))
+        filename = p_d.pillar_dir + '/stack/default/global.yml'
+        inode = os.stat(filename).st_ino
+        self._write(p_d.proposals_dir + '/config/stack/default/global.yml', 'a:   1\n')
+        p_d.output(p_d.organize(policy))
+        assert os.stat(filename).st_ino == inode
+
+    def test_output_removes_stale(self, tmpdir):
+        p_d, policy = self._pillar_data(tmpdir)
+        p_d.output(p_d.organize(policy))
+        self._write(policy, 'config/stack/default/global.yml\n')
+        p_d.output(p_d.organize(policy))
+        assert os.path.isfile(p_d.pillar_dir + '/stack/default/global.yml')
+        assert not os.path.exists(p_d.pillar_dir + '/stack/default/ceph')
+
+    def test_output_dryrun(self, tmpdir):
+        p_d, policy = self._pillar_data(tmpdir)
+        p_d.dryrun = True
+        p_d.output(p_d.organize(policy))
+        assert not os.path.exists(p_d.pillar_dir + '/stack/default/global.yml')
+        assert not os.path.exists(p_d.pillar_dir + '/stack/default/.manifest.json')
+
+
+class TestPathIndex():
+
+    def _tree(self, tmpdir):
+        root = tmpdir.join('proposals')
+        for path in ['role-mon/cluster/mon1.sls', 'role-mon/cluster/mon2.sls',
+                     'role-mon/stack/default/ceph/minions/mon1.yml',
+                     'role-mgr/cluster/mon1.sls', 'cluster-ceph/cluster/mon1.sls',
+                     'cluster-ceph/cluster/.hidden.sls', 'config/stack/default/global.yml',
+                     'profile-1/cluster/osd1.sls', 'profile-1/stack/default/ceph/minions/osd1.yml']:
+            root.join(path).write('x: 1\n', ensure=True)
+        return str(root)
+
+    def test_glob_matches_glob_module(self, tmpdir):
+        """
+        Given a proposals tree
+        Expect the index to return the same files as glob.glob, directories
+        are not indexed
+        """
+        root = self._tree(tmpdir)
+        index = push.PathIndex(root)
+        for pattern in ['role-*/cluster/*.sls', 'role-mon/cluster/mon[1,2].sls',
+                        'cluster-ceph/cluster/*.sls', 'cluster-ceph/cluster/.h*',
+                        'config/stack/default/global.yml', '*/cluster/mon1.sls',
+                        'profile-*/stack/default/ceph/minions/*.yml', 'role-*/cluster',
+                        'role-mds/cluster/*.sls', 'config/stack/default/missing.yml']:
+            pattern = root + '/' + pattern
+            assert sorted(index.glob(pattern)) == sorted(filter(os.path.isfile, glob.glob(pattern)))
+
+    def test_glob_outside_root(self, tmpdir):
+        root = self._tree(tmpdir)
+        index = push.PathIndex(root + '/role-mon')
+        pattern = root + '/cluster-ceph/cluster/*.sls'
+        assert index.glob(pattern) == glob.glob(pattern)
+
+    def test_slice(self):
+        files = list('abcdef')
+        assert push._slice(files, '[2:5]') == ['c', 'd', 'e']
+        assert push._slice(files, '[:-4]') == ['a', 'b']
+        assert push._slice(files, '[::2]') == ['a', 'c', 'e']
+        assert push._slice(files, '[ 1 : 3 ]') == ['b', 'c']
+        assert push._slice(files, '[-1]') == ['f']
+        assert push._slice(files, '[1]') == ['b']
+
+    def test_slice_invalid(self):
+        for value in ['[]', '[a:b]', '2:5', '[1:2:0]', '[__import__("os")]', '[1:2:3:4]']:
+            with pytest.raises(ValueError):
+                push._slice(list('abc'), value)
+
+    def test_organize_duplicates(self, tmpdir):
+        """
+        Given policy lines selecting the same file more than once
+        Expect each file to be listed once, at its last occurrence
+        """
+        root = self._tree(tmpdir)
+        policy = tmpdir.join('policy.cfg')
+        policy.write('role-mon/cluster/*.sls\n'
+                     'role-mon/cluster/mon1.sls\n'
+                     'role-*/cluster/*.sls\n'
+                     'cluster-ceph/cluster/*.sls slice=[0:5]\n'
+                     'cluster-ceph/cluster/*.sls slice=bad\n')
+        p_d = push.PillarData(False)
+        p_d.proposals_dir = root
+        common = p_d.organize(str(policy))
+        assert common['cluster/mon1.sls'] == [root + '/role-mgr/cluster/mon1.sls',
+                                               root + '/role-mon/cluster/mon1.sls',
+                                               root + '/cluster-ceph/cluster/mon1.sls']
+        assert common['cluster/mon2.sls'] == [root + '/role-mon/cluster/mon2.sls']
+        assert [(line, count) for line, count, _ in p_d.timings] == [
+            ('role-mon/cluster/*.sls', 2), ('role-mon/cluster/mon1.sls', 1),
+            ('role-*/cluster/*.sls', 3), ('cluster-ceph/cluster/*.sls slice=[0:5]', 1),
+            ('cluster-ceph/cluster/*.sls slice=bad', 0)]
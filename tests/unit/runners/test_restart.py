@@ -0,0 +1,136 @@
+import json
+from mock import patch
+from srv.modules.runners import restart
+
+
+# two racks holding two hosts each, data5 is outside any rack
+TREE = {'nodes': [
+    {'id': -1, 'name': 'default', 'type': 'root', 'children': [-2, -3, -8]},
+    {'id': -2, 'name': 'rack1', 'type': 'rack', 'children': [-4, -5]},
+    {'id': -3, 'name': 'rack2', 'type': 'rack', 'children': [-6, -7]},
+    {'id': -4, 'name': 'data1', 'type': 'host', 'children': [0]},
+    {'id': -5, 'name': 'data2', 'type': 'host', 'children': [1]},
+    {'id': -6, 'name': 'data3', 'type': 'host', 'children': [2]},
+    {'id': -7, 'name': 'data4', 'type': 'host', 'children': [3]},
+    {'id': -8, 'name': 'data5', 'type': 'host', 'children': [4]},
+    {'id': 0, 'name': 'osd.0', 'type': 'osd'},
+    {'id': 1, 'name': 'osd.1', 'type': 'osd'},
+    {'id': 2, 'name': 'osd.2', 'type': 'osd'},
+    {'id': 3, 'name': 'osd.3', 'type': 'osd'},
+    {'id': 4, 'name': 'osd.4', 'type': 'osd'}],
+    'stray': []}
+
+HOSTS = dict(('data{}.ceph'.format(idx), 'data{}'.format(idx)) for idx in range(1, 6))
+
+
+class TestPlan():
+
+    def test_host(self):
+        batches = restart._plan(TREE, HOSTS)
+        assert [batch['hosts'] for batch in batches] == [[minion] for minion in sorted(HOSTS)]
+
+    def test_rack(self):
+        batches = restart._plan(TREE, HOSTS, 'rack')
+        assert batches == [{'domain': 'data5', 'hosts': ['data5.ceph']},
+                           {'domain': 'rack1', 'hosts': ['data1.ceph', 'data2.ceph']},
+                           {'domain': 'rack2', 'hosts': ['data3.ceph', 'data4.ceph']}]
+
+    def test_max_batch(self):
+        batches = restart._plan(TREE, HOSTS, 'rack', max_batch=1)
+        assert len(batches) == 5
+        assert [batch['domain'] for batch in batches][1:3] == ['rack1', 'rack1']
+
+    def test_unknown_host(self):
+        hosts = {'data1.ceph': 'data1', 'new.ceph': 'new'}
+        batches = restart._plan(TREE, hosts, 'rack')
+        assert batches == [{'domain': 'new.ceph', 'hosts': ['new.ceph']},
+                           {'domain': 'rack1', 'hosts': ['data1.ceph']}]
+
+
+class FakeCluster(object):
+    """
+    Answers the calls of the runner, the degraded ratio and the number of
+    peering pgs are read from a list of ceph status results
+    """
+
+    def __init__(self, degraded, peering=None):
+        self.degraded = list(degraded)
+        self.peering = list(peering or [0])
+        self.applied = []
+        self.checked = []
+        self.polls = 0
+
+    def cmd(self, tgt, fun, args, expr_form=None):
+        if fun == 'pillar.get':
+            return {'admin.ceph': 'admin.ceph'}
+        if fun == 'grains.get':
+            return HOSTS
+        if fun == 'cmd.run' and args == ['ceph osd tree -f json']:
+            return {'admin.ceph': json.dumps(TREE)}
+        if fun == 'cmd.run':
+            ratio = self.degraded.pop(0) if len(self.degraded) > 1 else self.degraded[0]
+            peering = self.peering.pop(0) if len(self.peering) > 1 else self.peering[0]
+            self.polls += 1
+            status = {'health': {'status': 'HEALTH_WARN'},
+                      'pgmap': {'pgs_by_state': [
+                          {'state_name': 'active+clean', 'count': 100 - peering}]}}
+            if peering:
+                status['pgmap']['pgs_by_state'].append({'state_name': 'peering',
+                                                        'count': peering})
+            if ratio:
+                status['pgmap']['degraded_ratio'] = ratio
+            return {'admin.ceph': json.dumps(status)}
+        if fun == 'state.apply':
+            self.applied.append(tgt)
+            return dict((host, {'cmd_|-restart_|-x_|-run': {'result': True}})
+                        for host in tgt)
+        if fun == 'cephprocesses.wait':
+            self.checked.append(tgt)
+            return dict((host, True) for host in tgt)
+
+
+class TestRollingRestart():
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_osd(self, localclient):
+        cluster = FakeCluster([0.002, 0])
+        localclient.return_value.cmd.side_effect = cluster.cmd
+        assert restart.osd(failure_domain='rack', delay=0) is True
+        assert cluster.applied == [['data5.ceph'], ['data1.ceph', 'data2.ceph'],
+                                   ['data3.ceph', 'data4.ceph']]
+        assert cluster.checked == cluster.applied
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_abort_on_degradation(self, localclient):
+        cluster = FakeCluster([0, 0.5])
+        localclient.return_value.cmd.side_effect = cluster.cmd
+        rolling = restart.RollingRestart(failure_domain='rack', delay=0, timeout=0, check=1)
+        result = rolling.run(rolling.plan())
+        assert result['restarted'] == ['data5.ceph']
+        assert 'before rack1: HEALTH_WARN, 50.00% degraded objects' in result['aborted']
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_consecutive_checks(self, localclient):
+        cluster = FakeCluster([0, 0.01, 0, 0, 0])
+        localclient.return_value.cmd.side_effect = cluster.cmd
+        rolling = restart.RollingRestart(delay=0)
+        assert rolling.settle()[1] is True
+        assert cluster.polls == 4
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_abort_on_peering(self, localclient):
+        cluster = FakeCluster([0], [12])
+        localclient.return_value.cmd.side_effect = cluster.cmd
+        rolling = restart.RollingRestart(delay=0, timeout=0)
+        state, settled = rolling.settle()
+        assert settled is False
+        assert '12 inactive or peering pgs' in state
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_abort_on_failed_state(self, localclient):
+        cluster = FakeCluster([0])
+        localclient.return_value.cmd.side_effect = cluster.cmd
+        rolling = restart.RollingRestart(delay=0)
+        rolling.local.cmd.side_effect = None
+        rolling.local.cmd.return_value = {'data1.ceph': ['Rendering SLS failed']}
+        assert rolling.restart(['data1.ceph']) is False
@@ -0,0 +1,101 @@
+import pytest
+from mock import patch, call
+from srv.modules.runners import select
+
+
+GRAINS = {'rgw1': {'host': 'rgw1', 'fqdn': 'rgw1.ceph'},
+          'rgw2': {'host': 'rgw2', 'fqdn': 'rgw2.ceph'},
+          'mon1': {'host': 'mon1', 'fqdn': 'mon1.ceph'}}
+ROLES = {'rgw1': ['rgw', 'storage'], 'rgw2': ['silver'], 'mon1': ['mon']}
+
+
+def _cmd(search, fun, args, expr_form=None):
+    if fun == 'grains.item':
+        return dict((minion, dict((name, GRAINS[minion][name]) for name in args))
+                    for minion in search)
+    if search == 'I@roles:master':
+        return {'master': ['rgw', 'silver']}
+    if fun == 'pillar.get' and args == ['roles']:
+        return dict((minion, roles) for minion, roles in ROLES.items()
+                    if any('I@roles:{}'.format(role) in search.split(' or ')
+                           for role in roles))
+    if fun == 'pillar.item':
+        return {'mon1': dict((name, name.upper()) for name in args)}
+    matched = search.split(':')[1]
+    return dict((minion, minion) for minion, roles in ROLES.items() if matched in roles)
+
+
+@pytest.fixture(autouse=True)
+def memo():
+    select._MEMO.clear()
+
+
+class TestSelect():
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_from_batched(self, localclient):
+        """
+        Given two roles from a pillar variable
+        Expect the grains of all minions fetched with one query
+        """
+        local = localclient.return_value
+        local.cmd.side_effect = _cmd
+        result = select.from_('rgw_configurations', 'rgw', attr='host, fqdn')
+        assert result == [['rgw', 'rgw1', 'rgw1.ceph'], ['silver', 'rgw2', 'rgw2.ceph']]
+        grain_calls = [c for c in local.cmd.call_args_list if c[0][1] == 'grains.item']
+        assert grain_calls == [call(['rgw1', 'rgw2'], 'grains.item', ['host', 'fqdn'],
+                                    expr_form='list')]
+        assert local.cmd.call_count == 3
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_from_no_minions(self, localclient):
+        local = localclient.return_value
+        local.cmd.return_value = {}
+        assert select.from_('missing', 'ganesha', 'host') == [[None, None]]
+
+    @patch('srv.modules.runners.select._cached_grains')
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_cached_grains(self, localclient, cached_grains):
+        """
+        Given grains in the master cache for one of two minions
+        Expect only the other minion to be queried
+        """
+        local = localclient.return_value
+        local.cmd.side_effect = _cmd
+        cached_grains.return_value = {'rgw1': GRAINS['rgw1']}
+        result = select.from_('rgw_configurations', 'rgw', attr='host')
+        assert result == [['rgw', 'rgw1'], ['silver', 'rgw2']]
+        assert call(['rgw2'], 'grains.item', ['host'], expr_form='list') in \
+            local.cmd.call_args_list
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_memo(self, localclient):
+        local = localclient.return_value
+        local.cmd.side_effect = _cmd
+        assert select.minions(roles='rgw', host=True) == ['rgw1']
+        assert select.minions(roles='rgw', host=True) == ['rgw1']
+        assert select.minions(roles='mon') == ['mon1']
+        assert local.cmd.call_count == 3
+
+    @patch('srv.modules.runners.select.time')
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_memo_expires(self, localclient, mock_time):
+        local = localclient.return_value
+        local.cmd.side_effect = _cmd
+        mock_time.time.side_effect = [100, 105, 100 + select.MEMO_TTL]
+        for _ in range(3):
+            select.minions(roles='mon')
+        assert local.cmd.call_count == 2
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_attrs(self, localclient):
+        local = localclient.return_value
+        local.cmd.side_effect = _cmd
+        assert select.attrs(attrs='public_network,cluster_network', roles='mon') == \
+            [['mon1', 'PUBLIC_NETWORK', 'CLUSTER_NETWORK']]
+
+    @patch('salt.client.LocalClient', autospec=True)
+    def test_grains(self, localclient):
+        local = localclient.return_value
+        local.cmd.side_effect = _cmd
+        assert select.grains(grains='host,fqdn', roles='rgw') == [['rgw1', 'rgw1', 'rgw1.ceph']]